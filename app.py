@@ -1,54 +1,134 @@
 import os
-from re import match, findall, sub, split, escape as re_escape
-from datetime import datetime
-from flask import Flask, render_template, request, flash, session, redirect, url_for, abort, jsonify, escape, get_flashed_messages
+import atexit
+import hmac
+from time import monotonic
+from re import match, findall, escape as re_escape
+from datetime import datetime, timedelta
+from flask import Flask, render_template, request, flash, session, redirect, url_for, abort, jsonify, escape, get_flashed_messages, \
+    after_this_request, make_response, has_request_context, has_app_context, g
+from functools import wraps
 from flask_pymongo import PyMongo
-from PIL import Image
-from base64 import b64decode
-from io import BytesIO
+from base64 import b64decode, urlsafe_b64encode, urlsafe_b64decode
+from hashlib import sha1
+from binascii import Error as BinasciiError
+from bson import json_util
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
 import boto3
-import botocore
+import click
+from cache import TTLCache, query_key
+from counters import ViewCounter
+from render import render_fields, minutes, NO_TOTAL_TIME
+from indexes import ensure_indexes, find_collection_scans
+from slugs import allocate_urn
+from images import LocalStorage, S3Storage, ImageJobs, check_image
+from migrations import migrate_comments, migrate_edges, backfill_render_fields, migrate_datetimes, DATETIME_FORMAT
+from edges import add_edge, remove_edge, has_edge, edge_ends
+import feeds
+from projections import PROJECTIONS, projection, ProjectedDocument
+from search import SearchIndex, Suggestions, record_change, build_index, apply_changes
+from bitmaps import TagBitmaps
+from versions import bump_versions, get_versions
+from vocabulary import Vocabulary
+from parallel import QueryExecutor
+from database import Metrics, MetricsStore, client_options
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
-s3 = boto3.client('s3')
 s3_bucket = os.getenv('AWS_BUCKET')
 
 app = Flask(__name__)
 app.config['MONGO_URI'] = os.getenv('MONGO_URI')
+# MongoDB pool and timeout options, options set to 0 or None are taken from MONGO_URI or the driver's defaults
+app.config['MONGO_MAX_POOL_SIZE'] = int(os.getenv('MONGO_MAX_POOL_SIZE', 32)) or None  # Most connections per worker, enough for its threads and query workers
+app.config['MONGO_MIN_POOL_SIZE'] = int(os.getenv('MONGO_MIN_POOL_SIZE', 0)) or None  # Connections kept open when idle
+app.config['MONGO_WAIT_QUEUE_TIMEOUT_MS'] = int(os.getenv('MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000)) or None  # Fail rather than wait longer for a connection
+app.config['MONGO_CONNECT_TIMEOUT_MS'] = int(os.getenv('MONGO_CONNECT_TIMEOUT_MS', 0)) or None
+app.config['MONGO_SOCKET_TIMEOUT_MS'] = int(os.getenv('MONGO_SOCKET_TIMEOUT_MS', 0)) or None
+app.config['MONGO_SERVER_SELECTION_TIMEOUT_MS'] = int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', 0)) or None
+app.config['MONGO_READ_PREFERENCE'] = os.getenv('MONGO_READ_PREFERENCE') or None  # eg. secondaryPreferred to read from secondaries
+app.config['MONGO_SLOW_MS'] = int(os.getenv('MONGO_SLOW_MS', 100))  # Commands slower than this many milliseconds are logged
+app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')  # /metrics requires it as a bearer token, and is off if unset
+app.config['METRICS_DIR'] = os.getenv('METRICS_DIR')  # Directory gunicorn workers share metrics through, set by gunicorn.conf.py
+app.config['METRICS_SAVE_INTERVAL'] = float(os.getenv('METRICS_SAVE_INTERVAL', 5))  # Seconds between each worker saving its metrics
 app.secret_key = os.getenv('SECRET_KEY')
+app.config['COUNT_CACHE_TIMEOUT'] = int(os.getenv('COUNT_CACHE_TIMEOUT', 60))  # Seconds to cache recipe counts for, 0 disables
+app.config['HOME_CACHE_TIMEOUT'] = int(os.getenv('HOME_CACHE_TIMEOUT', 300))  # Seconds to cache home page recipe lists for, 0 disables
+app.config['HOME_CACHE_SIZE'] = int(os.getenv('HOME_CACHE_SIZE', 128))  # Number of sets of preferences to cache home page lists for
+app.config['PAGE_CACHE_TIMEOUT'] = int(os.getenv('PAGE_CACHE_TIMEOUT', 60))  # Seconds to cache whole pages for anonymous users for, 0 disables
+app.config['PAGE_CACHE_SIZE'] = int(os.getenv('PAGE_CACHE_SIZE', 512))  # Number of pages to cache for anonymous users
+app.config['VIEW_FLUSH_SIZE'] = int(os.getenv('VIEW_FLUSH_SIZE', 100))  # Number of buffered recipe views to write at once
+app.config['VIEW_FLUSH_INTERVAL'] = float(os.getenv('VIEW_FLUSH_INTERVAL', 10))  # Maximum seconds to buffer recipe views for
+app.config['IMAGE_WORKERS'] = int(os.getenv('IMAGE_WORKERS', 2))  # Number of threads processing uploaded images
+app.config['FEED_BACKFILL_SIZE'] = int(os.getenv('FEED_BACKFILL_SIZE', 100))  # Number of a user's recipes added to a feed when they are followed
+app.config['FEED_SIZE'] = int(os.getenv('FEED_SIZE', 500))  # Most entries kept in each user's feed, older ones are deleted
+app.config['PROJECTION_WARNINGS'] = os.getenv('PROJECTION_WARNINGS') is not None  # Warn when templates read recipe fields that weren't fetched
+app.config['SEARCH_INDEX_PATH'] = os.getenv('SEARCH_INDEX_PATH', os.path.join(app.root_path, 'search-index.seg'))  # Search index segment file
+app.config['SEARCH_LIMIT'] = int(os.getenv('SEARCH_LIMIT', 1000))  # Maximum number of ranked matches a search returns
+app.config['SEARCH_REFRESH_INTERVAL'] = float(os.getenv('SEARCH_REFRESH_INTERVAL', 1))  # Seconds between checks for other processes' changes
+app.config['SEARCH_REBUILD_AGE'] = int(os.getenv('SEARCH_REBUILD_AGE', 7))  # Days before a saved index is rebuilt, must be less than the change log is kept
+app.config['SUGGEST_LIMIT'] = int(os.getenv('SUGGEST_LIMIT', 8))  # Number of suggestions returned as a search is typed
+app.config['SUGGEST_REBUILD_AGE'] = int(os.getenv('SUGGEST_REBUILD_AGE', 3600))  # Seconds before suggestions are rebuilt to update their popularity
+app.config['TAG_BITMAP_LIMIT'] = int(os.getenv('TAG_BITMAP_LIMIT', 1000))  # Most recipes matching tag and meal filters to look up by urn
+app.config['QUERY_WORKERS'] = int(os.getenv('QUERY_WORKERS', 8))  # Number of threads running a page's independent queries concurrently, 0 disables
+app.config['VOCABULARY_REFRESH_INTERVAL'] = float(os.getenv('VOCABULARY_REFRESH_INTERVAL', 30))  # Seconds between checks for changed tags and meals
 
 app.jinja_env.trim_blocks = True
 app.jinja_env.lstrip_blocks = True
 
-mongo = PyMongo(app)
+db_metrics = Metrics(route=lambda: request.endpoint if has_request_context() else g.get('endpoint') if has_app_context() else None,
+                     slow_ms=app.config['MONGO_SLOW_MS'])
+metrics_store = MetricsStore(app.config['METRICS_DIR'], app.config['METRICS_SAVE_INTERVAL']) if app.config['METRICS_DIR'] else None
+
+
+def start_metrics():
+    '''
+    Starts saving this process's metrics to METRICS_DIR if it is set, so /metrics can add up every worker's. Like create_clients
+    this is called again in each worker after it forks, see gunicorn.conf.py.
+    '''
+    if metrics_store is not None:
+        metrics_store.start(db_metrics)
+
+
+def create_clients():
+    '''
+    Creates the MongoDB and S3 clients, and the image storage that uses them. Clients can't be shared with forked processes, so
+    when gunicorn preloads the app this is called again in each worker after it forks, see gunicorn.conf.py.
+    '''
+    global mongo, s3, image_storage
+    mongo = PyMongo(app, connect=False, **client_options(app.config, db_metrics))  # Connect on first use, so no monitoring threads are started before forking
+    s3 = boto3.client('s3')
+    if s3_bucket is not None:  # If S3 is set up store images there, otherwise save them locally
+        image_storage = S3Storage(s3, s3_bucket)
+    else:
+        image_storage = LocalStorage(os.path.join(app.root_path, 'static', 'user-images'), app.static_url_path + '/user-images/')
+
+
+create_clients()
+start_metrics()
+
+recipe_counts = TTLCache(maxsize=1024)
+home_recipes_cache = TTLCache(maxsize=app.config['HOME_CACHE_SIZE'])
+page_cache = TTLCache(maxsize=app.config['PAGE_CACHE_SIZE'])
+view_counter = ViewCounter(lambda: mongo.db.recipes, flush_size=app.config['VIEW_FLUSH_SIZE'],
+                           flush_interval=app.config['VIEW_FLUSH_INTERVAL'])
+atexit.register(view_counter.flush)  # Write any buffered views when a worker shuts down
+image_jobs = ImageJobs(lambda: image_storage, lambda: mongo.db.recipes, workers=app.config['IMAGE_WORKERS'],
+                       on_update=lambda: recipes_changed())
+atexit.register(image_jobs.shutdown)  # Finish processing queued images when a worker shuts down
+search_index = SearchIndex(app.config['SEARCH_INDEX_PATH'])
+atexit.register(lambda: search_index.save())  # Merge recipes indexed since the segment was written into it when a worker shuts down
+suggestions = Suggestions()
+tag_bitmaps = TagBitmaps()
+vocabulary = Vocabulary()
+query_executor = QueryExecutor(workers=app.config['QUERY_WORKERS'])
+atexit.register(query_executor.shutdown)
 
 
 ####################
 # Helper Functions #
 ####################
 
-def hours_mins_to_string(hours_mins):
-    '''
-    Helper function to convert stored times to strings
-    '''
-    if hours_mins == '00:00' or not match('^[0-9]{2}:[0-5][0-9]$', hours_mins):
-        return '0 minutes'
-    hours, mins = hours_mins.split(':')
-    hours = int(hours)
-    mins = int(mins)
-    string = ''
-    if hours > 1:
-        string += str(hours) + ' hours'
-    elif hours == 1:
-        string += str(hours) + ' hour'
-    if hours > 0 and mins > 0:
-        string += ' '
-    if mins > 1:
-        string += str(mins) + ' minutes'
-    elif mins == 1:
-        string += '1 minute'
-    return string
-
-
 def exists(variable, key=None):
     '''
     Helper function to check a variable is declared and not None
@@ -61,23 +141,288 @@ def exists(variable, key=None):
     return variable is not None and variable != ''
 
 
+def as_datetime(value):
+    '''
+    Helper function to read a date that may still be stored as a string, until the migrate-datetimes command has been run
+    '''
+    if isinstance(value, datetime):
+        return value
+    return datetime.strptime(value, DATETIME_FORMAT)
+
+
+def projected(document, view, *extra):
+    '''
+    Helper function to track reads of a document fetched with a view's projection, if projection warnings are enabled
+    '''
+    if document is not None and app.config['PROJECTION_WARNINGS']:
+        return ProjectedDocument(document, view, extra)
+    return document
+
+
+def encode_cursor(recipe, sort):
+    '''
+    Helper function to create an opaque cursor from the sort key and _id of the last recipe on a page
+    '''
+    position = json_util.dumps([recipe.get(sort), str(recipe['_id'])])
+    return urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(after):
+    '''
+    Helper function to decode a cursor back to its sort key and _id, returns None if the cursor is invalid
+    '''
+    try:
+        value, _id = json_util.loads(urlsafe_b64decode(after.encode()).decode())
+        return value, ObjectId(_id)
+    except (BinasciiError, UnicodeDecodeError, ValueError, TypeError, InvalidId):
+        return None
+
+
+def keyset_query(sort, order, value, _id):
+    '''
+    Helper function to build the query for recipes that come after a cursor, using _id as a tiebreaker.
+    Missing or null sort keys are sorted before everything else by MongoDB, so they are handled separately.
+    '''
+    compare = '$gt' if order == 1 else '$lt'
+    if value is None:
+        if order == 1:  # Ascending from null, the rest of the nulls then all the values
+            return [{sort: None, '_id': {'$gt': _id}}, {sort: {'$ne': None}}]
+        return [{sort: None, '_id': {'$lt': _id}}]  # Descending from null, only nulls remain
+    after = [{sort: {compare: value}}, {sort: value, '_id': {compare: _id}}]
+    if order == -1:
+        after.append({sort: None})
+    return after
+
+
+def cache_page(max_age, on_hit=None):
+    '''
+    Decorator setting a route's cache policy. Anonymous users' GET responses can be reused by browsers and shared caches for
+    max_age seconds, and are kept in the page cache for PAGE_CACHE_TIMEOUT seconds so repeat requests skip the database and
+    templates. With a max_age of 0 caches must revalidate the page against its Last-Modified date on every request, so each
+    request still reaches the app. Pages for users with a session depend on it, so they are private and revalidated on every
+    request. on_hit is called with the route's arguments when a page is served from the page cache, eg. to count a view.
+    '''
+    def decorator(view):
+        @wraps(view)
+        def cached_view(**kwargs):
+            anonymous = request.method == 'GET' and not session
+            cached = page_cache.get(request.full_path) if anonymous else None
+            if cached is not None:
+                if on_hit is not None:
+                    on_hit(**kwargs)
+                body, mimetype, last_modified = cached
+                response = app.response_class(body, mimetype=mimetype)
+                response.last_modified = last_modified
+            else:
+                response = make_response(view(**kwargs))
+            if anonymous and not session and response.status_code == 200:  # Still anonymous, eg. no messages were flashed
+                if cached is None:
+                    page_cache.set(request.full_path, (response.get_data(), response.mimetype, response.last_modified),
+                                   app.config['PAGE_CACHE_TIMEOUT'])
+                response.cache_control.public = True
+                if max_age:
+                    response.cache_control.max_age = max_age
+                else:
+                    response.cache_control.no_cache = True
+                response.make_conditional(request)
+            else:
+                response.headers.pop('Last-Modified', None)
+                response.cache_control.private = True
+                response.cache_control.no_cache = True
+            response.vary.add('Cookie')  # The header shows who is logged in
+            return response
+        return cached_view
+    return decorator
+
+
 ####################
 # Shared Functions #
 ####################
 
+def recipes_changed():
+    '''
+    Invalidates cached data derived from the recipes collection, and bumps its change version. Should be called after any write to recipes.
+    Writes that change what a recipe's page shows should also set its modified time, which is sent as its Last-Modified header.
+    '''
+    recipe_counts.clear()
+    home_recipes_cache.clear()
+    data_changed('recipes')
+
+
+def data_changed(*collections):
+    '''
+    Bumps the change versions of collections after writing to them, and clears the page cache.
+    '''
+    bump_versions(mongo.db, *collections)
+    page_cache.clear()
+
+
+def vocabulary_changed(collection):
+    '''
+    Reloads this process's tags and meals after the Admin page changes them. Other processes reload them once they see the new version.
+    '''
+    data_changed(collection)
+    vocabulary.clear()
+
+
+def get_vocabulary():
+    '''
+    Returns the lists of all tags and all meals from the in-memory vocabulary, checking for changes at most every
+    VOCABULARY_REFRESH_INTERVAL seconds.
+    '''
+    return vocabulary.get(mongo.db, app.config['VOCABULARY_REFRESH_INTERVAL'])
+
+
+def viewer():
+    '''
+    Returns the session values that queries depend on: the user's username, preferences and exclusions. Queries run by
+    run_queries have no request, so read the values it passed them instead.
+    '''
+    keys = ('username', 'preferences', 'exclusions')
+    if has_request_context():
+        return {key: session.get(key) for key in keys}
+    return g.get('viewer') or dict.fromkeys(keys)
+
+
+def run_queries(**queries):
+    '''
+    Runs independent queries concurrently on the query executor, returning a dictionary of their results by name.
+    Each query is a function without arguments, run in an app context rather than the request's, so it must not read the request.
+    The session values it needs are read beforehand and available from viewer().
+    How long each query took, and when it started, is sent in the Server-Timing header.
+    '''
+    values, endpoint = viewer(), request.endpoint
+
+    def in_app_context(query):
+        def run():
+            with app.app_context():
+                g.viewer, g.endpoint = values, endpoint
+                return query()
+        return run
+
+    group = query_executor.group()
+    for name, query in queries.items():
+        group.submit(name, in_app_context(query))
+    results = group.results()
+
+    @after_this_request
+    def server_timing(response):
+        response.headers.add('Server-Timing', ', '.join('{};desc="start {:.1f}ms";dur={:.1f}'.format(name, start * 1000, duration * 1000)
+                                                        for name, (start, duration) in group.timings.items()))
+        return response
+    return results
+
+
+def count_recipes(query):
+    '''
+    Counts recipes matching a query, caching the result per normalised query.
+    Unfiltered counts use the estimated collection size less any deleted recipes rather than a full count.
+    '''
+    key = query_key(query)
+    no_recipes = recipe_counts.get(key)
+    if no_recipes is None:
+        if query == {'deleted': {'$ne': True}}:
+            no_recipes = max(mongo.db.recipes.estimated_document_count() - mongo.db.recipes.count_documents({'deleted': True}), 0)
+        else:
+            no_recipes = mongo.db.recipes.count_documents(query)
+        recipe_counts.set(key, no_recipes, app.config['COUNT_CACHE_TIMEOUT'])
+    return no_recipes
+
+
+def refresh_index(index, max_age):
+    '''
+    Loads or builds an in-memory recipe index the first time it's used, or if it was built longer than max_age ago.
+    Otherwise applies changes made by other processes at most every SEARCH_REFRESH_INTERVAL seconds.
+    Threads only wait for each other to load an index that hasn't been loaded yet. Once it has, if another thread is already
+    rebuilding or updating it the index is used as it is, rather than waiting.
+    '''
+    if index.built is None:
+        with index.refresh_lock:
+            if index.built is None and not index.load():
+                build_index(mongo.db, index)
+    expired = datetime.utcnow() - index.built > max_age
+    if (expired or monotonic() - index.refreshed >= app.config['SEARCH_REFRESH_INTERVAL']) and index.refresh_lock.acquire(blocking=False):
+        try:
+            if datetime.utcnow() - index.built > max_age:
+                build_index(mongo.db, index)
+            elif monotonic() - index.refreshed >= app.config['SEARCH_REFRESH_INTERVAL']:
+                apply_changes(mongo.db, index)
+        finally:
+            index.refresh_lock.release()
+
+
+def search_recipes(text):
+    '''
+    Finds the urns of recipes matching search text, best match first. The index is rebuilt before the changes since it was built expire.
+    '''
+    refresh_index(search_index, timedelta(days=app.config['SEARCH_REBUILD_AGE']))
+    return search_index.search(text, limit=app.config['SEARCH_LIMIT'])
+
+
+def index_recipe(urn, recipe=None):
+    '''
+    Logs a change to a recipe for every process's in-memory indexes, and applies it to this process's indexes straight away.
+    If no recipe is given it has been deleted and is removed from the indexes.
+    '''
+    record_change(mongo.db, urn)
+    for index in (search_index, suggestions, tag_bitmaps):
+        if recipe is not None:
+            index.add(dict(recipe, urn=urn))
+        else:
+            index.remove(urn)
+
+
+def filter_by_tags(query):
+    '''
+    Matches a query's tag and meal filters against the tag bitmaps, so the query is found by urn instead of scanning for recipes
+    without excluded tags. Favourites or search results are narrowed to those that match. Otherwise if no more than
+    TAG_BITMAP_LIMIT recipes match their urns are added to the query, and the tag filters stay in it so the database still has
+    the final say. If more match the query is left to the database, as excluding the rest by urn would be no more selective than
+    the excluded tags. If tags and meals are the query's only filters the number of matching recipes is returned as its count,
+    otherwise None.
+    '''
+    refresh_index(tag_bitmaps, timedelta(days=app.config['SEARCH_REBUILD_AGE']))
+    tags_only = set(query) <= {'deleted', 'tags', 'meals'}
+    tags = query.get('tags', {})
+    matched = tag_bitmaps.match(tags.get('$all', []), tags.get('$nin', []), query.get('meals', {}).get('$all', []))
+    count = tag_bitmaps.count(matched)
+    limit = app.config['TAG_BITMAP_LIMIT']
+    if 'urn' in query:  # Keep only the favourites or search results that match, in their order
+        query['urn'] = {'$in': tag_bitmaps.keep_matching(matched, query['urn']['$in'])}
+        return None
+    if count <= limit:
+        query['urn'] = {'$in': tag_bitmaps.urns_of(matched)}
+        return None
+    return count if tags_only else None
+
+
 def find_recipes(page='1', tags=None, exclude=None, meals=None, username=None, forks=None, search=None, featured=None,
-                 following=None, favourites=None, preferences=None, sort='views', order='-1', **kwargs):
+                 following=None, favourites=None, preferences=None, max_time=None, since=None, sort=None, order='-1',
+                 after=None, count=True, **kwargs):
     '''
     Search function to find recipes based on a set of queries.
+    max_time limits recipes to those taking at most that many minutes in total, since to those added in the last number of days.
+    If an after cursor is supplied the page is found by keyset rather than skipping, so deep pages cost the same as the first.
+    If count is False recipes aren't counted, one extra recipe is fetched to tell if there is a next page and no_recipes is None.
+    Recipes by followed users sorted by date are read from the user's feed, then their cards are looked up by urn.
+    Tag and meal filters are first matched against the tag bitmaps, see filter_by_tags.
+    Searches are matched by the search index and sorted by relevance unless another sort is given. Quoted phrases must appear exactly.
     '''
     query = {'deleted': {'$ne': True}}
-    user = session.get('username')
+    session_values = viewer()
+    user = session_values['username']
+    if not exists(sort):
+        sort = 'relevance' if exists(search) else 'views'
+    elif sort == 'relevance' and not exists(search):
+        sort = 'views'
+    use_feed = (following is not None and sort == 'date' and not exists(favourites) and not exists(forks)
+                and not exists(featured) and not exists(search) and not exists(max_time))
     if preferences == '-1':  # Ignore preferences if preferences set to -1
         user_preferences = None
         user_exclusions = None
     else:
-        user_preferences = session.get('preferences')
-        user_exclusions = session.get('exclusions')
+        user_preferences = session_values['preferences']
+        user_exclusions = session_values['exclusions']
     if exists(user_preferences):  # If user preferences are set, add them to the tags
         if exists(tags):
             tags = tags + ' ' + user_preferences
@@ -104,35 +449,50 @@ def find_recipes(page='1', tags=None, exclude=None, meals=None, username=None, f
 
     if exists(meals):
         query['meals'] = {'$all': meals.split(' ')}
-    if exists(favourites):
-        query['favouriting-users'] = user
-    if following is not None:  # If we are looking only for users we follow the recipe author should be in the list of users we follow
-        following_user = mongo.db.users.find_one({'username': user}, {'following': 1})
-        if isinstance(following_user.get('following'), list):
-            query['username'] = {'$in': following_user['following']}
+    if exists(favourites):  # Look up the urns the user has favourited from their edges
+        query['urn'] = {'$in': edge_ends(mongo.db.favourites, {'username': user}, 'urn')}
+    if use_feed:  # The user's feed only contains recipes by users they follow that haven't been deleted
+        query.pop('deleted')
+        query['owner'] = user
+    elif following is not None:  # If we are looking only for users we follow the recipe author should be one of the users we follow
+        followees = edge_ends(mongo.db.follows, {'follower': user}, 'followee')
+        if len(followees) > 0:
+            query['username'] = {'$in': followees}
         else:
             if page != '1':  # If we don't follow anybody return no recipes, if the page is greater than one it's out of bounds
                 abort(404)
             else:
-                return {'recipes': [], 'no_recipes': 0, 'page': 1}
+                return {'recipes': [], 'no_recipes': 0, 'page': 1, 'next_page': None}
     elif exists(username):
         query['username'] = username
     if exists(forks):
         query['parent'] = forks
     if exists(featured):
         query['featured'] = {'$exists': True}
-    if exists(search):  # If there is a search string, find any parts in double quotes and seperate them out
-        search_strings = None
-        if '"' in search:
-            search_strings = findall('".+"', search)
-            for search_string in search_strings:
-                search = sub(' *' + re_escape(search_string) + ' *', '', search)
-        if ' ' in search:
-            search = split(' +', search)
-            search = '"' + '" "'.join(search) + '"'
-        if search_strings is not None:
-            search += ' ' + ' '.join(search_strings)
-        query['$text'] = {'$search': search}
+    if exists(max_time):
+        try:
+            query['total-time'] = {'$lte': int(max_time)}
+        except ValueError:
+            pass
+    if exists(since):  # Count days from midnight, so the query and its cached count are the same all day
+        try:
+            today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+            query['date'] = {'$gte': today - timedelta(days=int(since))}
+        except (ValueError, OverflowError):
+            pass
+    if exists(search):  # Find the recipes matching every word, then check any parts in double quotes appear as they are
+        ranked = search_recipes(search)
+        if exists(favourites):
+            favourite_urns = set(query['urn']['$in'])
+            ranked = [urn for urn in ranked if urn in favourite_urns]
+        query['urn'] = {'$in': ranked}
+        phrases = findall('"([^"]+)"', search)
+        if len(phrases) > 0:
+            query['$and'] = [{'$or': [{field: {'$regex': re_escape(phrase.strip()), '$options': 'i'}}
+                                      for field in ('title', 'ingredients', 'methods')]} for phrase in phrases]
+    tag_count = None
+    if not use_feed and ('tags' in query or 'meals' in query):
+        tag_count = filter_by_tags(query)
 
     try:
         order = int(order)
@@ -145,39 +505,192 @@ def find_recipes(page='1', tags=None, exclude=None, meals=None, username=None, f
     except ValueError:
         page = 1
     offset = (page - 1) * 10
-    no_recipes = mongo.db.recipes.count_documents(query)  # Count recipes matching query, if there's at least one and our page number is in bounds find the recipes
-    if page < 1 or (page != 1 and offset >= no_recipes):
-        abort(404)  # Out of bounds error
-    if no_recipes > 0:
-        recipes = (
-            mongo.db.recipes.find(query, {'urn': 1, 'title': 1, 'username': 1, 'image': 1, 'comment-count': 1, 'favourites': 1})
-            .sort(sort, order)
-            .skip(offset)
-            .limit(10)
-        )
+    if sort == 'relevance':
+        return find_ranked_recipes(query, ranked, page)
+    position = decode_cursor(after) if exists(after) else None
+    card_projection = projection('card', sort)
+    if use_feed:
+        collection = mongo.db.feeds
+        entry_projection = {'urn': 1, sort: 1}
+    else:
+        collection = mongo.db.recipes
+        entry_projection = card_projection
+    if count:
+        if use_feed:  # Feed counts aren't cached, as following a user changes them
+            no_recipes = mongo.db.feeds.count_documents(query)
+        elif tag_count is not None:
+            no_recipes = tag_count
+        else:
+            no_recipes = count_recipes(query)  # Count recipes matching query, if there's at least one and our page number is in bounds find the recipes
+        if page < 1 or (page != 1 and position is None and offset >= no_recipes):
+            abort(404)  # Out of bounds error
+    else:
+        no_recipes = None
+        if page < 1:
+            abort(404)
+    if no_recipes is None or no_recipes > 0:
+        if position is not None:  # If there is a cursor start after it, otherwise fall back to skipping to the page
+            page_query = dict(query)
+            page_query['$or'] = keyset_query(sort, order, *position)
+            cursor = collection.find(page_query, entry_projection)
+        else:
+            cursor = collection.find(query, entry_projection).skip(offset)
+        recipes = list(cursor.sort([(sort, order), ('_id', order)]).limit(10 if count else 11))
+        if (position is not None or not count) and len(recipes) == 0 and page != 1:
+            abort(404)  # Page is beyond the last recipe
     else:
         recipes = []
+    if count:
+        has_next = len(recipes) == 10 and offset + 10 < no_recipes
+    else:  # Without a count the extra recipe tells us if there is a next page
+        has_next = len(recipes) > 10
+        recipes = recipes[:10]
+    if has_next:  # If there are more recipes create a cursor for the next page
+        next_page = encode_cursor(recipes[-1], sort)
+    else:
+        next_page = None
+    if use_feed and len(recipes) > 0:  # Swap the feed entries for their recipe cards, keeping the feed's order
+        cards = {recipe['urn']: recipe for recipe in mongo.db.recipes.find({'urn': {'$in': [entry['urn'] for entry in recipes]}}, card_projection)}
+        recipes = [cards[entry['urn']] for entry in recipes if entry['urn'] in cards]
+    recipes = [projected(recipe, 'card', sort) for recipe in recipes]
+
+    return {'recipes': recipes, 'no_recipes': no_recipes, 'page': page, 'next_page': next_page}
+
+
+def find_ranked_recipes(query, ranked, page):
+    '''
+    Finds a page of recipes matching a query in the order of ranked, a list of urns from the search index. Only the urns of
+    matching recipes are fetched to count and order them, then the cards for the page are looked up.
+    '''
+    matches = {recipe['urn'] for recipe in mongo.db.recipes.find(query, {'urn': 1, '_id': 0})}
+    ranked = [urn for urn in ranked if urn in matches]
+    offset = (page - 1) * 10
+    if page < 1 or (page != 1 and offset >= len(ranked)):
+        abort(404)  # Out of bounds error
+    page_urns = ranked[offset:offset + 10]
+    cards = {recipe['urn']: recipe for recipe in mongo.db.recipes.find({'urn': {'$in': page_urns}}, projection('card'))}
+    recipes = [projected(cards[urn], 'card') for urn in page_urns if urn in cards]
+    return {'recipes': recipes, 'no_recipes': len(ranked), 'page': page, 'next_page': None}
+
+
+def find_users(page='1', following=None, followers=None, sort='joined', order='-1', **kwargs):
+    '''
+    Finds a page of users, optionally only those followed by or following a user.
+    '''
+    query = {}
+    usernames = None
+    if exists(following):  # If looking for users followed by a user, find them from the user's follows
+        usernames = set(edge_ends(mongo.db.follows, {'follower': following}, 'followee'))
+    if exists(followers):  # If looking for users following a user, find them from follows of the user
+        follower_names = set(edge_ends(mongo.db.follows, {'followee': followers}, 'follower'))
+        usernames = follower_names if usernames is None else usernames & follower_names
+    if usernames is not None:
+        query['username'] = {'$in': sorted(usernames)}
+    no_users = mongo.db.users.count_documents(query)
+    try:
+        page = int(page)
+    except ValueError:
+        page = 1
+    offset = (page - 1) * 10
+    if page < 1 or (page != 1 and offset >= no_users):  # Check the page is within bounds
+        abort(404)
+    try:
+        order = int(order)
+    except ValueError:
+        order = -1
+    users = mongo.db.users.find(query, {'username': 1, 'follower-count': 1, 'following-count': 1}).sort(sort, order).skip(offset).limit(10)  # Find user info for matching users
+    return {'users': list(users), 'no_users': no_users, 'page': page}
+
+
+def find_comments(urn, after=None):
+    '''
+    Finds a page of comments on a recipe, oldest first, starting after the cursor if there is one.
+    Returns the comments, with their ids and times as strings, and a cursor for the next page or None if it's the last.
+    '''
+    query = {'urn': urn}
+    position = decode_cursor(after) if exists(after) else None
+    if position is not None:
+        query['$or'] = keyset_query('time', 1, *position)
+    comments = list(mongo.db.comments.find(query, {'urn': 0}).sort([('time', 1), ('_id', 1)]).limit(21))
+    next_page = encode_cursor(comments[19], 'time') if len(comments) > 20 else None
+    comments = comments[:20]
+    for comment in comments:
+        comment['id'] = str(comment.pop('_id'))
+        comment['time'] = as_datetime(comment['time']).strftime('%Y-%m-%d %H:%M:%S')
+    return comments, next_page
+
+
+def comment_payload(comment, username):
+    '''
+    Prepares a comment for a JSON response, escaping its text and marking if the user can delete it
+    '''
+    payload = {field: comment[field] for field in ('id', 'username', 'time')}
+    payload['comment'] = escape(comment['comment'])
+    if username == 'Admin' or username == comment['username']:
+        payload['delete'] = True
+    return payload
+
 
-    return {'recipes': recipes, 'no_recipes': no_recipes, 'page': page}
+def api_etag(collections):
+    '''
+    Computes a strong ETag for an API response from the endpoint, the query, the session values find_recipes reads and the change
+    versions of the collections the response is built from.
+    '''
+    key = [request.endpoint, sorted(request.args.items(multi=True)), session.get('username'), session.get('preferences'),
+           session.get('exclusions'), get_versions(mongo.db, *collections)]
+    return sha1(json_util.dumps(key).encode()).hexdigest()
+
+
+def conditional_json(collections, payload):
+    '''
+    Returns the result of payload, a function building an API response's data, as JSON with an ETag from api_etag.
+    If the request's If-None-Match already has the ETag a 304 Not Modified is returned without building it. The versions are
+    read before the data, so a write in between can only make the ETag older than the data, never newer.
+    If collections is None the response can change without any version changing, so it is sent without an ETag.
+    '''
+    if collections is None:
+        response = jsonify(payload())
+    else:
+        etag = api_etag(collections)
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            response = jsonify(payload())
+        response.set_etag(etag)
+    response.vary.add('Cookie')  # Responses depend on the logged in user and their preferences
+    return response
+
+
+def card_payload(recipe, sort):
+    '''
+    Returns the fields of a recipe card for the API, with the field being sorted on. View counts are left out, as views don't
+    bump the recipes version, so they would go stale behind an unchanged ETag.
+    '''
+    fields = PROJECTIONS['card'] + (sort,) if sort != 'views' else PROJECTIONS['card']
+    return {field: recipe[field] for field in fields if field in recipe}
+
+
+def home_recipes(**kwargs):
+    '''
+    Finds recipes for the home page lists, caching the results. The results depend on the user's preferences, so they are part of the key.
+    '''
+    session_values = viewer()
+    key = query_key(dict(kwargs, preferences=session_values['preferences'], exclusions=session_values['exclusions']))
+    results = home_recipes_cache.get(key)
+    if results is None:
+        results = find_recipes(count=False, **kwargs)
+        home_recipes_cache.set(key, results, app.config['HOME_CACHE_TIMEOUT'])
+    return dict(results)
 
 
 def create_recipe_data(recipe_data):
     '''
     Prepares recipe data for submission
     '''
-    if exists(recipe_data, 'prep-time'):  # Add cook time and prep time together as 00:00 string to order redipes by
-        prep_time = recipe_data['prep-time'].split(':')
-        if exists(recipe_data, 'cook-time'):
-            cook_time = recipe_data['cook-time'].split(':')
-        else:
-            cook_time = ['00', '00']
-        mins = int(prep_time[1]) + int(cook_time[1])
-        hours = int(prep_time[0]) + int(cook_time[0])
-        hours += mins // 60
-        mins = mins % 60
-        recipe_data['total-time'] = '{:0>2}:{:0>2}'.format(hours, mins)
+    if exists(recipe_data, 'prep-time'):  # Add cook time and prep time together as minutes to order and filter recipes by
+        recipe_data['total-time'] = minutes(recipe_data['prep-time']) + minutes(recipe_data.get('cook-time') or '00:00')
     else:
-        recipe_data['total-time'] = '99:59'
+        recipe_data['total-time'] = NO_TOTAL_TIME
     if exists(recipe_data, 'tags'):  # If tags exists convert them back to a list
         recipe_data['tags'] = recipe_data.get('tags', '').split('/')
     else:
@@ -187,45 +700,50 @@ def create_recipe_data(recipe_data):
     else:
         recipe_data.pop('meals', '')
     if exists(recipe_data, 'image'):  # If there is an image included decode it back to bytes
-        imageBytes = b64decode(recipe_data['image'])
         try:
-            image = Image.open(BytesIO(imageBytes))  # Open the image and check its type and size are correct
-            if image.format == 'JPEG' and image.size == (1200, 700):
-                filename = recipe_data['urn'] + '.jpg'
-                if s3_bucket is not None:  # If S3 is set up, upload it and return an unsigned url
-                    s3.upload_fileobj(BytesIO(imageBytes), s3_bucket, filename)
-                    # Snippet for unsigned url for S3 object from https://github.com/boto/boto3/issues/110
-                    config = s3._client_config
-                    config.signature_version = botocore.UNSIGNED
-                    recipe_data['image'] = boto3.client('s3', config=config) \
-                        .generate_presigned_url('get_object', ExpiresIn=0,
-                                                Params={'Bucket': s3_bucket, 'Key': filename})
-                else:  # Otherwise save it locally
-                    f = open(os.path.join('static', 'user-images', filename), 'wb')
-                    f.write(imageBytes)
-                    f.close()
-                    recipe_data['image'] = url_for('static', filename='user-images/' + filename)
-            else:
-                recipe_data.pop('image', '')
-                flash('Failed to upload image.')
-            image.close()
-        except IOError:
+            image_bytes = b64decode(recipe_data['image'])
+        except ValueError:
+            image_bytes = b''
+        if check_image(image_bytes):  # Check its type and size are correct, then process and store it in the background
+            urn = recipe_data['urn']
+            job = ImageJobs.new_job()
+            recipe_data['image'] = url_for('static', filename='images/placeholder.jpg')  # Placeholder until the job completes
+            recipe_data['images'] = None
+            recipe_data['image-job'] = job
+            g.image_upload = (urn, job, image_bytes)  # Queued by queue_image once the recipe has been saved
+        else:
             recipe_data.pop('image', '')
             flash('Failed to upload image.')
+    elif recipe_data.get('old-image') == url_for('static', filename='images/placeholder.jpg'):
+        recipe_data.pop('image', '')  # The old image is still being processed, so leave its job to replace the placeholder
+        recipe_data.pop('old-image', '')
     elif exists(recipe_data, 'old-image'):  # Otherwise if there is an old image url, use that
         recipe_data['image'] = recipe_data['old-image']
+        recipe_data['image-job'] = None  # Stop any queued job replacing the image
         recipe_data.pop('old-image', '')
     else:
         recipe_data['image'] = None
+        recipe_data['images'] = None
+        recipe_data['image-job'] = None
+    recipe_data.update(render_fields(recipe_data))  # Render the fields the recipe page shows now, rather than on every view
+    recipe_data['modified'] = datetime.utcnow()
     return recipe_data
 
 
+def queue_image():
+    '''
+    Queues the image uploaded with a recipe for processing, once the recipe has been saved with its job
+    '''
+    upload = g.pop('image_upload', None)
+    if upload is not None:
+        image_jobs.submit(*upload)
+
+
 def prepare_recipe_template(action, recipe_data=None, urn=None):
     '''
     Calls render template for add/edit-recipe. Gets tags and meals and prefills recipe data if it exists.
     '''
-    all_tags = mongo.db.tags.find()
-    all_meals = mongo.db.meals.find()
+    all_tags, all_meals = get_vocabulary()
     if isinstance(recipe_data, dict):
         recipe_data['prep-time'] = recipe_data['prep-time'].split(':')
         recipe_data['cook-time'] = recipe_data['cook-time'].split(':')
@@ -243,20 +761,25 @@ def prepare_recipe_template(action, recipe_data=None, urn=None):
 #########
 
 @app.route('/')
+@cache_page(60)
 def index():
-    featured_recipes = find_recipes(featured='1', sort='featured', order='-1').get('recipes')
-    recent_recipes = find_recipes(sort='date', order='-1')
-    recent_recipes['query'] = {'sort': 'date', 'order': '-1'}
-    popular_recipes = find_recipes(sort='favourites', order='-1')
-    popular_recipes['query'] = {'sort': 'favourites', 'order': '-1'}
     username = session.get('username')
+    queries = {'featured': lambda: home_recipes(featured='1', sort='featured', order='-1'),
+               'recent': lambda: home_recipes(sort='date', order='-1'),
+               'popular': lambda: home_recipes(sort='favourites', order='-1')}
     if username is not None:
-        following_recipes = find_recipes(following='1', sort='date', order='-1')
+        queries['following'] = lambda: find_recipes(following='1', sort='date', order='-1', count=False)
+    results = run_queries(**queries)  # The lists don't depend on each other, so are found concurrently
+    featured_recipes = results['featured'].get('recipes')
+    recent_recipes = results['recent']
+    recent_recipes['query'] = {'sort': 'date', 'order': '-1'}
+    popular_recipes = results['popular']
+    popular_recipes['query'] = {'sort': 'favourites', 'order': '-1'}
+    following_recipes = results.get('following')
+    if following_recipes is not None:
         following_recipes['query'] = {'following': '1', 'sort': 'date', 'order': '-1'}
-        if following_recipes['no_recipes'] == 0:
+        if len(following_recipes['recipes']) == 0:
             following_recipes = None
-    else:
-        following_recipes = None
     return render_template('index.html', username=username, featured_recipes=featured_recipes,
                            recent_recipes=recent_recipes, popular_recipes=popular_recipes,
                            following_recipes=following_recipes)
@@ -283,7 +806,8 @@ def new_user():
             flash('Username "{}" is already taken, please choose another.'.format(username))
         else:  # Otherwise add the usernamed to the logins collection, and create a document for the user in the users collection
             mongo.db.logins.insert_one({'username': username})
-            mongo.db.users.insert_one({'username': username, 'joined': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')})
+            mongo.db.users.insert_one({'username': username, 'joined': datetime.utcnow()})
+            data_changed('users')
             return redirect(url_for('login'), code=307)
     return render_template('new-user.html')
 
@@ -326,30 +850,33 @@ def admin():
             if exists(request.form, 'add-tag'):  # Validate and added tags or meals and add them to the mongo collection
                 if match('^[A-Za-z-]+$', request.form['add-tag']):
                     mongo.db.tags.insert_one({'name': request.form['add-tag']})
+                    vocabulary_changed('tags')
                     flash('Added tag "{}"'.format(request.form['add-tag']))
                 else:
                     flash('Failed to add tag.')
             if exists(request.form, 'add-meal'):
                 if match('^[A-Za-z-]+$', request.form['add-meal']):
                     mongo.db.meals.insert_one({'name': request.form['add-meal']})
+                    vocabulary_changed('meals')
                     flash('Added meal "{}"'.format(request.form['add-meal']))
                 else:
                     flash('Failed to add meal.')
             if exists(request.form, 'remove-tag'):  # Remove any deleted tags from their collections if they exist
                 response = mongo.db.tags.delete_one({'name': request.form['remove-tag']}).deleted_count
                 if response == 1:
+                    vocabulary_changed('tags')
                     flash('Deleted tag "{}"'.format(request.form['remove-tag']))
                 else:
                     flash('Failed to delete tag.')
             if exists(request.form, 'remove-meal'):
                 response = mongo.db.meals.delete_one({'name': request.form['remove-meal']}).deleted_count
                 if response == 1:
+                    vocabulary_changed('meals')
                     flash('Deleted meal "{}"'.format(request.form['remove-meal']))
                 else:
                     flash('Failed to delete meal.')
 
-        all_tags = mongo.db.tags.find()
-        all_meals = mongo.db.meals.find()
+        all_tags, all_meals = get_vocabulary()
         return render_template('admin.html', username='Admin', tags=all_tags, meals=all_meals)
 
 
@@ -374,7 +901,6 @@ def preferences():
     '''
     username = session.get('username')
     if session.get('username') is not None:
-        all_tags = mongo.db.tags.find()
         if request.method == 'POST':
             tags = request.form.get('tags')
             exclude = request.form.get('exclude')
@@ -395,54 +921,44 @@ def preferences():
                 session['preferences'] = tags
                 session['exclusions'] = exclude
                 flash('Preferences updated!')
-        all_tags = list(mongo.db.tags.find())
+        all_tags = get_vocabulary()[0]
         return render_template('preferences.html', username=username, all_tags=all_tags,
                                preferences=session.get('preferences'), exclusions=session.get('exclusions'))
     abort(403)  # If user not logged in return forbidden
 
 
 @app.route('/users/<user>')
+@cache_page(60)
 def user_page(user):
     '''
     User page. Displays details on a user and a list of recipes
     '''
-    user_details = mongo.db.users.find_one({'username': user})
+    username = session.get('username')
+    page, after = request.args.get('page', '1'), request.args.get('after')  # Read before the queries, which run without the request
+    queries = {'details': lambda: mongo.db.users.find_one({'username': user}),
+               'recipes': lambda: find_recipes(username=user, preferences='-1', page=page, after=after)}
+    if username is not None:
+        queries['following'] = lambda: has_edge(mongo.db.follows, {'follower': username, 'followee': user})
+    results = run_queries(**queries)
+    user_details = results['details']
     if user_details is None:
         abort(404)
-    user_details['joined'] = datetime.strptime(user_details['joined'], '%Y-%m-%d %H:%M:%S').strftime('%b \'%y')
-    user_recipes = find_recipes(username=user, preferences='-1')
-    return render_template('user.html', username=session.get('username'), user_details=user_details, user_recipes=user_recipes)
+    user_details['joined'] = as_datetime(user_details['joined']).strftime('%b \'%y')
+    user_recipes = results['recipes']
+    following = results.get('following', False)
+    return render_template('user.html', username=username, user_details=user_details, user_recipes=user_recipes, following=following)
 
 
 @app.route('/users')
+@cache_page(60)
 def user_list():
     '''
     Users list, returns a list of users matching the current query
     '''
-    query = {}
-    if exists(request.args, 'following'):  # If looking for users followed by a user, search for users with their username in the followers list
-        query['followers'] = request.args['following']
-    if exists(request.args, 'followers'):  # If looking for users following a user, search for users with their username in the following list
-        query['following'] = request.args['followers']
-    no_users = mongo.db.users.count_documents(query)
-    try:
-        page = int(request.args.get('page', '1'))
-    except ValueError:
-        page = 1
-    offset = (page - 1) * 10
-    if page < 1 or (page != 1 and offset >= no_users):  # Check the page is within bounds
-        abort(404)
-    sort = request.args.get('sort', 'joined')  # If the query doesn't specify a sort or order default to joined descending
-    order = request.args.get('order', '-1')
-    try:
-        order = int(order)
-    except ValueError:
-        order = -1
-    users = mongo.db.users.find(query, {'username': 1, 'follower-count': 1, 'following-count': 1}).sort(sort, order).skip(offset).limit(10)  # Find user info for matching users
+    results = find_users(**request.args.to_dict())
     current_query = request.args.to_dict()
     current_query.pop('page', '')  # Remove the page number from the current query before passing it to the template
-    return render_template('users.html', username=session.get('username'), page=page, no_users=no_users,
-                           users=users, current_query=current_query)
+    return render_template('users.html', username=session.get('username'), current_query=current_query, **results)
 
 
 @app.route('/follow/<user>')
@@ -450,23 +966,29 @@ def follow(user):
     '''
     Adds or removes a logged in user to another users followers
     '''
-    followee = mongo.db.users.find_one({'username': user}, {'followers': 1})
+    followee = mongo.db.users.find_one({'username': user}, {'_id': 1})
     if followee is None:
         return abort(404)
     follower = session.get('username')
     if follower is None or follower == user:
         return abort(403)
     else:
-        if follower not in followee.get('followers', []):
-            mongo.db.users.update_one({'username': user}, {'$inc': {'follower-count': 1}, '$addToSet': {'followers': follower}})
-            mongo.db.users.update_one({'username': follower}, {'$inc': {'following-count': 1}, '$addToSet': {'following': user}})
-            following = True
-            flash('Following {}'.format(user))
-        else:
-            mongo.db.users.update_one({'username': user}, {'$inc': {'follower-count': -1}, '$pull': {'followers': follower}})
-            mongo.db.users.update_one({'username': follower}, {'$inc': {'following-count': -1}, '$pull': {'following': user}})
+        edge = {'follower': follower, 'followee': user}
+        if remove_edge(mongo.db.follows, edge):  # If the user was already following, unfollow
+            mongo.db.users.update_one({'username': user}, {'$inc': {'follower-count': -1}})
+            mongo.db.users.update_one({'username': follower}, {'$inc': {'following-count': -1}})
+            feeds.unfollow_feed(mongo.db, follower, user)
+            data_changed('users')
             following = False
             flash('No longer following {}'.format(user))
+        else:
+            if add_edge(mongo.db.follows, edge):  # Only count the follow if this request added it
+                mongo.db.users.update_one({'username': user}, {'$inc': {'follower-count': 1}})
+                mongo.db.users.update_one({'username': follower}, {'$inc': {'following-count': 1}})
+                feeds.follow_feed(mongo.db, follower, user, app.config['FEED_BACKFILL_SIZE'], app.config['FEED_SIZE'])
+                data_changed('users')
+            following = True
+            flash('Following {}'.format(user))
         if request.is_json:
             return jsonify(following=following)
         return redirect(url_for('user_page', user=user))
@@ -488,12 +1010,9 @@ def add_recipe():
     if request.method == 'POST':
         recipe_data = request.form.to_dict()
         if exists(recipe_data, 'title') and exists(recipe_data, 'ingredients') and exists(recipe_data, 'methods'):  # If valida data has been supplied
-            recipe_data['urn'] = '-'.join(findall('[a-z-]+', recipe_data['title'].lower()))  # Create a slug/urn from the title
-            count = mongo.db.recipes.count_documents({'urn': {'$regex': '^' + recipe_data['urn'] + '[0-9]*'}})  # Count how many of that slug exists
-            if count != 0:  # if one or more already exist, add the number onto the slug
-                recipe_data['urn'] += str(count)
+            recipe_data['urn'] = allocate_urn(mongo.db, recipe_data['title'])  # Create a unique slug/urn from the title
             recipe_data['username'] = session.get('username')
-            recipe_data['date'] = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+            recipe_data['date'] = datetime.utcnow()
 
             recipe_data = create_recipe_data(recipe_data)
 
@@ -508,12 +1027,22 @@ def add_recipe():
                     else:
                         mongo.db.recipes.update_one({'urn': recipe_data['parent']},
                                                     {'$addToSet': {'children': {'urn': recipe_data['urn'],
-                                                                                'title': recipe_data['title']}}})
+                                                                                'title': recipe_data['title']}},
+                                                     '$set': {'modified': recipe_data['modified']}})
                 else:
                     recipe_data['parent'] = None
                     flash('Parent recipe does not exist!')
-            mongo.db.recipes.insert_one(recipe_data)
+            try:
+                mongo.db.recipes.insert_one(recipe_data)
+            except DuplicateKeyError:  # The unique index on urn should never be hit, but fail safely if it is
+                flash('Failed to add recipe!')
+                return prepare_recipe_template(action, recipe_data)
+            queue_image()
             mongo.db.users.update_one({'username': recipe_data['username']}, {'$inc': {'recipe-count': 1}})
+            data_changed('users')
+            feeds.fan_out(mongo.db, recipe_data, app.config['FEED_SIZE'])
+            index_recipe(recipe_data['urn'], recipe_data)
+            recipes_changed()
             flash('Recipe "{}" successfully created.'.format(recipe_data['title']))
             return redirect(url_for('recipe', urn=recipe_data['urn']))
         else:
@@ -521,9 +1050,7 @@ def add_recipe():
     elif request.args.get('fork') is not None:  # If this is a fork, find the parent and add its recipe data to the template
         action = 'Fork'
         parent = request.args.get('fork')
-        recipe_data = mongo.db.recipes.find_one({'urn': parent},
-                                                {'title': 1, 'ingredients': 1, 'methods': 1, 'tags': 1,
-                                                'meals': 1, 'prep-time': 1, 'cook-time': 1, 'image': 1})
+        recipe_data = projected(mongo.db.recipes.find_one({'urn': parent}, projection('fork')), 'fork')
         if recipe_data is not None and not recipe_data.get('deleted', False):
             recipe_data['parent'] = parent
             if recipe_data.get('image') is not None:
@@ -541,8 +1068,7 @@ def edit_recipe(urn):
     '''
     Edit recipe page. Post route updates recipe.
     '''
-    recipe_data = mongo.db.recipes.find_one({'urn': urn}, {'_id': -1, 'title': 1, 'username': 1, 'ingredients': 1, 'methods': 1,
-                                                           'prep-time': 1, 'cook-time': 1, 'tags': 1, 'meals': 1, 'image': 1, 'deleted': 1})
+    recipe_data = projected(mongo.db.recipes.find_one({'urn': urn}, projection('edit')), 'edit')
     username = session.get('username')
     action = 'Edit'
     if recipe_data is None or recipe_data.get('deleted', False):
@@ -555,6 +1081,10 @@ def edit_recipe(urn):
                 updated_recipe = create_recipe_data(updated_recipe)
                 updated_recipe.pop('urn', '')
                 mongo.db.recipes.update_one({'urn': urn}, {'$set': updated_recipe})
+                queue_image()
+                feeds.update_entries(mongo.db, urn, updated_recipe)
+                index_recipe(urn, updated_recipe)
+                recipes_changed()
                 flash('Successfully edited recipe!')
                 return redirect(url_for('recipe', urn=urn))
         else:
@@ -570,7 +1100,7 @@ def delete_recipe(urn):
     '''
     Delete recipe page. Post route deletes recipe.
     '''
-    recipe_data = mongo.db.recipes.find_one({'urn': urn}, {'title': 1, 'username': 1, 'parent': 1, 'children': 1, 'deleted': 1})
+    recipe_data = projected(mongo.db.recipes.find_one({'urn': urn}, projection('delete')), 'delete')
     username = session.get('username')
     if recipe_data is None or recipe_data.get('deleted', False):
         abort(404)
@@ -579,11 +1109,18 @@ def delete_recipe(urn):
             if request.form.get('confirm') == recipe_data['title']:
                 mongo.db.recipes.replace_one({'urn': urn}, {'urn': urn, 'deleted': True})
                 mongo.db.users.update_one({'username': recipe_data['username']}, {'$inc': {'recipe-count': -1}})
+                data_changed('users')
                 if recipe_data.get('parent') is not None:
                     mongo.db.recipes.update_one({'urn': recipe_data['parent']},
-                                                {'$pull': {'children': {'urn': urn, 'title': recipe_data['title']}}})
+                                                {'$pull': {'children': {'urn': urn, 'title': recipe_data['title']}},
+                                                 '$set': {'modified': datetime.utcnow()}})
                 if recipe_data.get('children') is not None:
-                    mongo.db.recipes.update_many({'parent': urn}, {'$set': {'parent': None}})
+                    mongo.db.recipes.update_many({'parent': urn}, {'$set': {'parent': None, 'modified': datetime.utcnow()}})
+                mongo.db.comments.delete_many({'urn': urn})
+                mongo.db.favourites.delete_many({'urn': urn})
+                feeds.remove_recipe(mongo.db, urn)
+                index_recipe(urn)
+                recipes_changed()
                 flash('Successfully deleted recipe "{}".'.format(recipe_data['title']))
                 return redirect(url_for('index'))
             else:
@@ -595,6 +1132,7 @@ def delete_recipe(urn):
 
 
 @app.route('/recipes')
+@cache_page(60)
 def recipes():
     '''
     Recipes list page. returns a list of recipes matching the query.
@@ -605,7 +1143,8 @@ def recipes():
     results = find_recipes(**query_args)  # Pass the query to find recipes
     if query_args.get('following') is not None:  # Following overrides username as it uses the same field
         query_args.pop('username', '')
-    query_args.pop('page', '')  # Remove the page from the query, as it will be replaced in the template
+    query_args.pop('page', '')  # Remove the page and cursor from the query, as they will be replaced in the template
+    query_args.pop('after', '')
     if not query_args.get('preferences'):
         if exists(preferences):  # Add preferences and exclusions to query string
             tags = query_args.pop('tags', '')
@@ -626,36 +1165,40 @@ def recipes():
     else:
         parent_title = None
 
-    all_tags = list(mongo.db.tags.find())
-    all_meals = mongo.db.meals.find()
+    all_tags, all_meals = get_vocabulary()
 
     return render_template('recipes.html', current_query=query_args, username=session.get('username'),
                            parent_title=parent_title, all_meals=all_meals, all_tags=all_tags, **results)
 
 
 @app.route('/recipes/<urn>')
+@cache_page(0, on_hit=lambda urn: view_counter.add(urn))  # Revalidated so every view is counted
 def recipe(urn):
     '''
     Individual recipe page
     '''
-    recipe = mongo.db.recipes.find_one({'urn': urn})
+    recipe = projected(mongo.db.recipes.find_one({'urn': urn}, projection('detail')), 'detail')
     favourite = None
     if recipe is None or recipe.get('deleted', False):
         abort(404)
     else:  # If recipe exists, prepare it for the template, and check if the user has favourited it.
         username = session.get('username')
         if recipe['username'] != username:
-            mongo.db.recipes.update_one({'urn': urn}, {'$inc': {'views': 1}})
+            view_counter.add(urn)
             if username is not None:
-                favourite = username in recipe.get('favouriting-users', [])
-        recipe['ingredients'] = recipe['ingredients'].split('\n')
-        recipe['methods'] = recipe['methods'].split('\n')
-        recipe['date'] = datetime.strptime(recipe['date'], '%Y-%m-%d %H:%M:%S').strftime('%a %d %b \'%y')
-        recipe['prep-time'] = hours_mins_to_string(recipe['prep-time'])
-        recipe['cook-time'] = hours_mins_to_string(recipe['cook-time'])
+                favourite = has_edge(mongo.db.favourites, {'username': username, 'urn': urn})
         if recipe.get('children') is not None:
             recipe['forks'] = len(recipe['children'])
-    return render_template('recipe.html', recipe=recipe, urn=urn, username=username, favourite=favourite)
+        if recipe.get('comment-count'):
+            comments, next_page = find_comments(urn)
+        else:
+            comments, next_page = [], None
+    response = make_response(render_template('recipe.html', recipe=recipe, urn=urn, username=username, favourite=favourite,
+                                             comments=comments, next_page=next_page))
+    last_modified = recipe.get('modified') or recipe.get('date')  # Older recipes have no modified time, and may have a string date
+    if last_modified is not None:
+        response.last_modified = as_datetime(last_modified)
+    return response
 
 
 @app.route('/recipes/<urn>/favourite')
@@ -663,19 +1206,22 @@ def favourite_recipe(urn):
     '''
     Add or remove a recipe to a users favourites
     '''
-    recipe = mongo.db.recipes.find_one({'urn': urn}, {'username': 1, 'favouriting-users': 1})
+    recipe = mongo.db.recipes.find_one({'urn': urn}, {'username': 1, 'deleted': 1})
     if recipe is None or recipe.get('deleted', False):
         abort(404)
     username = session.get('username')
     if username is None or username == recipe.get('username', username):
         abort(403)
     else:
-        if username in recipe.get('favouriting-users', []):  # If a user is in the list of favouriting users, remove them
-            mongo.db.recipes.update_one({'urn': urn}, {'$inc': {'favourites': -1}, '$pull': {'favouriting-users': username}})
+        edge = {'username': username, 'urn': urn}
+        if remove_edge(mongo.db.favourites, edge):  # If the user has favourited the recipe, remove it
+            mongo.db.recipes.update_one({'urn': urn}, {'$inc': {'favourites': -1}, '$set': {'modified': datetime.utcnow()}})
             favourite = False
-        else:  # Otheriwse add them
-            mongo.db.recipes.update_one({'urn': urn}, {'$inc': {'favourites': 1}, '$addToSet': {'favouriting-users': username}})
+        else:  # Otheriwse add it, only counting it if this request added it
+            if add_edge(mongo.db.favourites, edge):
+                mongo.db.recipes.update_one({'urn': urn}, {'$inc': {'favourites': 1}, '$set': {'modified': datetime.utcnow()}})
             favourite = True
+        recipes_changed()
     if request.is_json:
         return jsonify(favourite=favourite)
     else:
@@ -693,12 +1239,12 @@ def feature_recipe(urn):
     if recipe is None or recipe.get('deleted', False):
         abort(404)
     if recipe.get('featured') is None:
-        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-        mongo.db.recipes.update_one({'urn': urn}, {'$set': {'featured': now}})
+        mongo.db.recipes.update_one({'urn': urn}, {'$set': {'featured': datetime.utcnow(), 'modified': datetime.utcnow()}})
         feature = True
     else:
-        mongo.db.recipes.update_one({'urn': urn}, {'$unset': {'featured': ''}})
+        mongo.db.recipes.update_one({'urn': urn}, {'$unset': {'featured': ''}, '$set': {'modified': datetime.utcnow()}})
         feature = False
+    recipes_changed()
     if request.is_json:
         return jsonify(feature=feature)
     else:
@@ -708,9 +1254,9 @@ def feature_recipe(urn):
 @app.route('/recipes/<urn>/comments', methods=['POST', 'GET'])
 def comments(urn):
     '''
-    Comments page. Post route adds comment.
+    Comments page, paginated with an after cursor. Post route adds comment.
     '''
-    recipe = mongo.db.recipes.find_one({'urn': urn}, {'username': 1, 'title': 1, 'comment-count': 1, 'comments': 1})
+    recipe = mongo.db.recipes.find_one({'urn': urn}, {'username': 1, 'title': 1, 'comment-count': 1, 'deleted': 1})
     username = session.get('username')
     if recipe is None or recipe.get('deleted', False):
         abort(404)
@@ -723,34 +1269,34 @@ def comments(urn):
             else:
                 comment = request.form.get('comment', '')
             if comment != '' and comment is not None:
-                now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-                comment_doc = {'username': username, 'time': now, 'comment': comment}
-                mongo.db.recipes.update_one({'urn': urn}, {'$addToSet': {'comments': comment_doc},
-                                                           '$inc': {'comment-count': 1}})
+                new_comment = {'urn': urn, 'username': username, 'time': datetime.utcnow(), 'comment': comment}
+                mongo.db.comments.insert_one(new_comment)
+                mongo.db.recipes.update_one({'urn': urn}, {'$inc': {'comment-count': 1}, '$set': {'modified': datetime.utcnow()}})
+                data_changed('recipes')
                 success = True
                 if isinstance(recipe.get('comment-count'), int):
                     recipe['comment-count'] += 1
                 else:
                     recipe['comment-count'] = 1
-                if not isinstance(recipe.get('comments'), list):
-                    recipe['comments'] = []
-                recipe['comments'].append(comment_doc)
                 flash('Added comment to {}'.format(recipe['title']))
             else:
                 flash('Failed to add comment to {}'.format(recipe['title']))
                 success = False
     else:
         success = None
+    if request.method == 'POST' and request.is_json:  # Only the new comment is returned, to be added below those already shown
+        if success:
+            new_comment = comment_payload(dict(new_comment, id=str(new_comment['_id']),
+                                               time=new_comment['time'].strftime('%Y-%m-%d %H:%M:%S')), username)
+        else:
+            new_comment = None
+        return jsonify(comment=new_comment, count=recipe.get('comment-count', 0), success=success, messages=get_flashed_messages())
+    comments, next_page = find_comments(urn, request.args.get('after'))
     if request.is_json:
-        for index, comment in enumerate(recipe.get('comments', [])):
-            if not comment.get('deleted', False):
-                comment['comment'] = escape(comment['comment'])
-                comment['index'] = index
-                if username == 'Admin' or username == comment['username']:
-                    comment['delete'] = True
-        return jsonify(comments=recipe.get('comments', []), success=success, messages=get_flashed_messages())
+        return jsonify(comments=[comment_payload(comment, username) for comment in comments], count=recipe.get('comment-count', 0),
+                       next=next_page, success=success, messages=get_flashed_messages())
     else:
-        return render_template('comments.html', username=username, recipe=recipe, urn=urn)
+        return render_template('comments.html', username=username, recipe=recipe, urn=urn, comments=comments, next_page=next_page)
 
 
 @app.route('/recipes/<urn>/delete-comment', methods=['POST'])
@@ -764,65 +1310,213 @@ def delete_comment(urn):
     else:
         try:
             if request.is_json:
-                index = int(request.json.get('comment-index'))
+                comment_id = ObjectId(request.json.get('comment-id'))
             else:
-                index = int(request.form.get('comment-index'))
-        except ValueError:
+                comment_id = ObjectId(request.form.get('comment-id'))
+        except (InvalidId, TypeError):
             abort(403)
-        recipe = mongo.db.recipes.find_one({'urn': urn}, {'comments': 1, 'deleted': 1})
+        recipe = mongo.db.recipes.find_one({'urn': urn}, {'deleted': 1, 'comment-count': 1})
         if recipe is None or recipe.get('deleted', False):
             abort(404)
         else:
-            if len(recipe.get('comments', [])) <= index:  # If the index is out of bounds return forbidden
+            comment = mongo.db.comments.find_one({'_id': comment_id, 'urn': urn}, {'username': 1})
+            if comment is None:  # If the comment doesn't exist return forbidden
                 abort(403)
-            else:
-                comment = recipe['comments'][index]
             if username == 'Admin' or username == comment['username']:  # If the user is admin, or the comment author, delete the comment
-                mongo.db.recipes.update_one({'urn': urn}, {'$set': {'comments.{}'.format(index): {'deleted': True}},
-                                                           '$inc': {'comment-count': -1}})  # Mark comment as deleted and reduce comment count
+                if mongo.db.comments.delete_one({'_id': comment_id}).deleted_count == 1:  # Delete the comment and reduce comment count
+                    recipe = mongo.db.recipes.find_one_and_update({'urn': urn}, {'$inc': {'comment-count': -1}, '$set': {'modified': datetime.utcnow()}},
+                                                                  {'comment-count': 1}, return_document=ReturnDocument.AFTER)
+                    data_changed('recipes')
                 if username == 'Admin':
                     flash('Successfully deleted comment from {}.'.format(comment['username']))
                 else:
                     flash('Successfully deleted your comment.')
                 if request.is_json:
-                    return jsonify(success=True, index=index, messages=get_flashed_messages())
+                    return jsonify(success=True, id=str(comment_id), count=recipe.get('comment-count', 0), messages=get_flashed_messages())
                 else:
                     return redirect(url_for('comments', urn=urn))
             else:
                 abort(403)
 
 
+##############
+# API routes #
+##############
+
+@app.route('/api/suggest')
+def suggest():
+    '''
+    Suggests recipe titles, ingredients and usernames starting with the q query as it is typed, most popular first. Returns JSON.
+    '''
+    refresh_index(suggestions, timedelta(seconds=app.config['SUGGEST_REBUILD_AGE']))
+    return jsonify(suggestions=suggestions.suggest(request.args.get('q', ''), limit=app.config['SUGGEST_LIMIT']))
+
+
+@app.route('/api/v1/recipes')
+def api_recipes():
+    '''
+    Recipes list as JSON, taking the same query as the recipes page. Recipes are compact cards, with the field being sorted on.
+    Following lists also depend on who the user follows, so they are revalidated when users change too. Lists sorted by views
+    have no ETag, as flushed views reorder them without bumping the recipes version.
+    '''
+    query_args = request.args.to_dict()
+    sort = query_args.get('sort') or 'relevance'
+    if sort == 'relevance' and not exists(query_args, 'search'):  # As find_recipes does
+        sort = 'views'
+    if sort == 'views':
+        collections = None
+    elif exists(query_args, 'following'):
+        collections = ('recipes', 'users')
+    else:
+        collections = ('recipes',)
+
+    def payload():
+        results = find_recipes(**query_args)
+        return {'recipes': [card_payload(recipe, sort) for recipe in results['recipes']], 'count': results['no_recipes'],
+                'page': results['page'], 'next': results['next_page']}
+    return conditional_json(collections, payload)
+
+
+@app.route('/api/v1/users')
+def api_users():
+    '''
+    Users list as JSON, taking the same query as the users page.
+    '''
+    def payload():
+        results = find_users(**request.args.to_dict())
+        return {'users': [{field: user.get(field, 0) for field in ('username', 'follower-count', 'following-count')}
+                          for user in results['users']], 'count': results['no_users'], 'page': results['page']}
+    return conditional_json(('users',), payload)
+
+
+@app.route('/metrics')
+def metrics():
+    '''
+    MongoDB command, route and connection pool metrics in the Prometheus text format, added up across every gunicorn worker if
+    METRICS_DIR is set, otherwise for this process only. Only served to requests with the METRICS_TOKEN bearer token, and not at all
+    if no token is set.
+    '''
+    token = app.config['METRICS_TOKEN']
+    if not token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), ('Bearer ' + token).encode()):
+        abort(403)
+    metrics = metrics_store.combined(db_metrics) if metrics_store is not None else db_metrics
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 ################
 # Static pages #
 ################
 
 @app.route('/cookies')
+@cache_page(3600)
 def cookies():
     return render_template('cookies.html', username=session.get('username'))
 
 
 @app.route('/about')
+@cache_page(3600)
 def about():
     return render_template('about.html', username=session.get('username'))
 
 
+################
+# CLI commands #
+################
+
+@app.cli.command('ensure-indexes')
+def ensure_indexes_command():
+    '''
+    Creates the indexes used by the app's queries, then reports any queries that still scan a whole collection.
+    '''
+    for collection, name, error in ensure_indexes(mongo.db):
+        if error is None:
+            click.echo('{}: {}'.format(collection, name))
+        else:
+            click.echo('{}: failed to create {} ({})'.format(collection, name, error), err=True)
+    scans = find_collection_scans(mongo.db)
+    for collection, query, sort in scans:
+        click.echo('COLLSCAN on {}: find({}) sort({})'.format(collection, query, sort), err=True)
+    if not scans:
+        click.echo('No queries are doing collection scans.')
+
+
+@app.cli.command('migrate-comments')
+def migrate_comments_command():
+    '''
+    Moves comments embedded in recipe documents into the comments collection.
+    '''
+    click.echo('Moved {} comments.'.format(migrate_comments(mongo.db)))
+
+
+@app.cli.command('migrate-edges')
+def migrate_edges_command():
+    '''
+    Moves favouriting users and followers out of recipe and user documents into the favourites and follows collections.
+    '''
+    click.echo('Added {} favourites and {} follows.'.format(*migrate_edges(mongo.db)))
+
+
+@app.cli.command('backfill-render-fields')
+def backfill_render_fields_command():
+    '''
+    Stores recipe dates as datetimes and adds the rendered fields recipe pages show to existing recipes.
+    '''
+    click.echo('Updated {} recipes.'.format(backfill_render_fields(mongo.db)))
+
+
+@app.cli.command('migrate-datetimes')
+def migrate_datetimes_command():
+    '''
+    Converts dates and times stored as strings to datetimes, and recipe total times to minutes.
+    '''
+    click.echo('Updated {} documents.'.format(migrate_datetimes(mongo.db)))
+
+
+@app.cli.command('backfill-feeds')
+def backfill_feeds_command():
+    '''
+    Adds the latest recipes of everybody a user follows to their feed, for follows made before feeds existed.
+    '''
+    click.echo('Backfilled feeds for {} follows.'.format(feeds.backfill_feeds(mongo.db, app.config['FEED_BACKFILL_SIZE'], app.config['FEED_SIZE'])))
+
+
+@app.cli.command('build-search-index')
+def build_search_index_command():
+    '''
+    Rebuilds the search index segment from every recipe.
+    '''
+    build_index(mongo.db, search_index)
+    click.echo('Indexed {} recipes.'.format(len(search_index.segment.lengths)))
+
+
 ######################
 # Custom error pages #
 ######################
 
+def api_error(status, message):
+    '''
+    Returns an error as JSON for API routes, or None for other routes.
+    '''
+    if request.path.startswith('/api/'):
+        return jsonify({'error': message, 'status': status}), status
+    return None
+
+
 @app.errorhandler(404)
 def page_not_found(e):
-    return render_template('404.html', username=session.get('username')), 404
+    return api_error(404, 'Not Found') or (render_template('404.html', username=session.get('username')), 404)
 
 
 @app.errorhandler(403)
 def page_forbidden(e):
-    return render_template('403.html', username=session.get('username')), 403
+    return api_error(403, 'Forbidden') or (render_template('403.html', username=session.get('username')), 403)
 
 
 @app.errorhandler(500)
 def server_error(e):
-    return render_template('500.html', username=session.get('username')), 500
+    return api_error(500, 'Internal Server Error') or (render_template('500.html', username=session.get('username')), 500)
 
 
 if __name__ == '__main__':
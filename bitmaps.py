@@ -0,0 +1,126 @@
+from datetime import datetime
+from threading import Lock
+
+BITMAP_PROJECTION = {'urn': 1, 'tags': 1, 'meals': 1, '_id': 0}
+BITMAP_FIELDS = ('tags', 'meals')
+
+
+class TagBitmaps:
+    '''
+    Bitmap index of the tags and meals of every recipe that hasn't been deleted. Each recipe is given an ordinal, and each tag
+    and meal has a bitmap, stored as an int, with the bits of the recipes that have it set. Filtering by tags and meals is then
+    a bitwise AND for each one that is required, and AND NOT for each one that is excluded.
+    '''
+    projection = BITMAP_PROJECTION
+
+    def __init__(self):
+        self.lock = Lock()
+        self.refresh_lock = Lock()  # Held while loading, rebuilding or updating the bitmaps from the database
+        self.ordinals = {}  # Urn: ordinal, kept when a recipe is removed until the bitmaps are rebuilt
+        self.urns = []  # Urn of each ordinal
+        self.values = {}  # Urn: (field, value) of each of the recipe's tags and meals
+        self.bitmaps = {}  # (field, value): bitmap of recipes with that tag or meal
+        self.recipes = 0  # Bitmap of every recipe
+        self.built = None
+        self.last_change = None
+        self.refreshed = 0
+
+    def load(self):
+        '''
+        Bitmaps aren't saved, so there is never anything to load.
+        '''
+        return False
+
+    def build(self, recipes, last_change=None):
+        '''
+        Rebuilds the bitmaps from an iterable of recipes, giving them new ordinals.
+        '''
+        with self.lock:
+            self.ordinals, self.urns, self.values, self.bitmaps, self.recipes = {}, [], {}, {}, 0
+            for recipe in recipes:
+                self._add(recipe)
+            self.built, self.last_change = datetime.utcnow(), last_change
+
+    def add(self, recipe):
+        '''
+        Adds or replaces a recipe. Tags or meals the recipe doesn't include are kept from before, as edits without them don't change them.
+        '''
+        with self.lock:
+            previous = self.values.get(recipe['urn'], ())
+            recipe = dict(recipe)
+            for field in BITMAP_FIELDS:
+                if field not in recipe:
+                    recipe[field] = [value for value_field, value in previous if value_field == field]
+            self._remove(recipe['urn'])
+            self._add(recipe)
+
+    def remove(self, urn):
+        '''
+        Removes a recipe.
+        '''
+        with self.lock:
+            self._remove(urn)
+
+    def _add(self, recipe):
+        urn = recipe['urn']
+        ordinal = self.ordinals.get(urn)
+        if ordinal is None:
+            ordinal = self.ordinals[urn] = len(self.urns)
+            self.urns.append(urn)
+        bit = 1 << ordinal
+        values = {(field, value) for field in BITMAP_FIELDS for value in recipe.get(field) or []}
+        for key in values:
+            self.bitmaps[key] = self.bitmaps.get(key, 0) | bit
+        self.values[urn] = values
+        self.recipes |= bit
+
+    def _remove(self, urn):
+        ordinal = self.ordinals.get(urn)
+        if ordinal is None:
+            return
+        mask = ~(1 << ordinal)
+        for key in self.values.pop(urn, ()):
+            self.bitmaps[key] &= mask
+            if self.bitmaps[key] == 0:
+                del self.bitmaps[key]
+        self.recipes &= mask
+
+    def match(self, tags=(), exclude=(), meals=()):
+        '''
+        Returns the bitmap of recipes with all of the tags and meals and none of the excluded tags.
+        '''
+        with self.lock:
+            matched = self.recipes
+            for tag in tags:
+                matched &= self.bitmaps.get(('tags', tag), 0)
+            for meal in meals:
+                matched &= self.bitmaps.get(('meals', meal), 0)
+            for tag in exclude:
+                matched &= ~self.bitmaps.get(('tags', tag), 0)
+            return matched
+
+    def keep_matching(self, bitmap, urns):
+        '''
+        Returns the urns of a list that are in a bitmap, in the same order.
+        '''
+        with self.lock:
+            return [urn for urn in urns if urn in self.ordinals and bitmap >> self.ordinals[urn] & 1]
+
+    @staticmethod
+    def count(bitmap):
+        '''
+        Returns the number of recipes in a bitmap.
+        '''
+        return bin(bitmap).count('1')
+
+    def urns_of(self, bitmap):
+        '''
+        Returns the urns of the recipes in a bitmap.
+        '''
+        bits = bin(bitmap)[:1:-1]  # Lowest bit first, so each character's position is an ordinal
+        urns = []
+        ordinal = bits.find('1')
+        while ordinal != -1:
+            urns.append(self.urns[ordinal])
+            ordinal = bits.find('1', ordinal + 1)
+        return urns
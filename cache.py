@@ -0,0 +1,70 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from bson import json_util
+
+
+def query_key(query):
+    '''
+    Helper function to normalise a MongoDB query into a hashable cache key.
+    Keys are sorted, and so are the values of operators where order doesn't matter.
+    '''
+    def normalise(value, unordered=False):
+        if isinstance(value, dict):
+            return {key: normalise(item, key in ('$all', '$in', '$nin')) for key, item in value.items()}
+        if isinstance(value, list):
+            value = [normalise(item) for item in value]
+            if unordered:
+                value.sort(key=json_util.dumps)
+        return value
+
+    return json_util.dumps(normalise(query), sort_keys=True)
+
+
+class TTLCache:
+    '''
+    Thread safe, size bounded least recently used cache where each entry expires after a timeout in seconds.
+    '''
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        '''
+        Returns the value stored for key, or default if it is missing or has expired.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires <= monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        '''
+        Stores value for key for timeout seconds, evicting the least recently used entry if the cache is full.
+        A timeout of 0 or less disables caching.
+        '''
+        if not timeout or timeout <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (monotonic() + timeout, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
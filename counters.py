@@ -0,0 +1,76 @@
+import logging
+from collections import Counter
+from threading import Lock, Timer
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError, BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+
+class ViewCounter:
+    '''
+    Accumulates recipe view increments in memory and writes them to MongoDB as a single bulk write,
+    either once flush_size views are pending or flush_interval seconds after the first pending view.
+    collection is a function returning the recipes collection, so the current database is always used.
+    '''
+    def __init__(self, collection, flush_size=100, flush_interval=10):
+        self.collection = collection
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._counts = Counter()
+        self._pending = 0
+        self._lock = Lock()
+        self._timer = None
+
+    def add(self, urn, views=1):
+        '''
+        Adds views to a recipe, flushing if enough views are pending.
+        '''
+        with self._lock:
+            self._counts[urn] += views
+            self._pending += views
+            flush = self._pending >= self.flush_size
+            if not flush and self._timer is None:  # Start the timer for the first pending view
+                self._timer = Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if flush:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes all pending views to the database. If the write fails the views are kept to be retried on the next flush.
+        The write is unordered, so if some updates fail the others have still been applied, and only the failed ones are retried.
+        '''
+        with self._lock:
+            counts = self._counts
+            self._counts = Counter()
+            self._pending = 0
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not counts:
+            return
+        urns = list(counts)
+        try:
+            self.collection().bulk_write([UpdateOne({'urn': urn}, {'$inc': {'views': counts[urn]}}) for urn in urns], ordered=False)
+        except BulkWriteError as e:
+            failed = Counter({urns[error['index']]: counts[urns[error['index']]] for error in e.details.get('writeErrors', [])})
+            self._retry(failed)
+        except PyMongoError:
+            self._retry(counts)
+
+    def _retry(self, counts):
+        if not counts:
+            return
+        logger.exception('Failed to write %d recipe views, will retry.', sum(counts.values()))
+        with self._lock:
+            self._counts.update(counts)
+            self._pending += sum(counts.values())
+
+    def pending(self, urn):
+        '''
+        Returns the number of views for a recipe that haven't been written yet.
+        '''
+        with self._lock:
+            return self._counts.get(urn, 0)
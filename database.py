@@ -0,0 +1,351 @@
+import os
+import json
+import logging
+import tempfile
+from contextlib import contextmanager
+from threading import Lock, Thread, local
+from time import monotonic, sleep
+from pymongo import monitoring
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, where the app is only run by the development server
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# App config keys for MongoClient pool and timeout options, left to the driver's defaults when a key is None
+CLIENT_OPTIONS = (
+    ('MONGO_MAX_POOL_SIZE', 'maxPoolSize'),
+    ('MONGO_MIN_POOL_SIZE', 'minPoolSize'),
+    ('MONGO_WAIT_QUEUE_TIMEOUT_MS', 'waitQueueTimeoutMS'),
+    ('MONGO_CONNECT_TIMEOUT_MS', 'connectTimeoutMS'),
+    ('MONGO_SOCKET_TIMEOUT_MS', 'socketTimeoutMS'),
+    ('MONGO_SERVER_SELECTION_TIMEOUT_MS', 'serverSelectionTimeoutMS'),
+    ('MONGO_READ_PREFERENCE', 'readPreference'),
+)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)  # Upper bounds in seconds
+
+
+def client_options(config, metrics=None):
+    '''
+    Returns the keyword arguments for MongoClient set in the app config, with the listeners recording metrics if given.
+    '''
+    options = {option: config[key] for key, option in CLIENT_OPTIONS if config.get(key) is not None}
+    if metrics is not None:
+        options['event_listeners'] = metrics.listeners()
+    return options
+
+
+def label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels) + '}'
+
+
+class Histogram:
+    '''
+    Counts of observed values in cumulative buckets, with their sum, for each set of labels.
+    '''
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.series = {}  # Labels: [bucket counts, sum, count]
+
+    def observe(self, labels, value):
+        series = self.series.setdefault(labels, [[0] * len(self.buckets), 0, 0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def lines(self, name):
+        for labels, (counts, total, count) in sorted(self.series.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield '{}_bucket{} {}'.format(name, label_text(labels + (('le', bound),)), bucket_count)
+            yield '{}_bucket{} {}'.format(name, label_text(labels + (('le', '+Inf'),)), count)
+            yield '{}_sum{} {}'.format(name, label_text(labels), total)
+            yield '{}_count{} {}'.format(name, label_text(labels), count)
+
+    def state(self):
+        return [[list(labels), counts, total, count] for labels, (counts, total, count) in self.series.items()]
+
+    def merge(self, state):
+        for labels, counts, total, count in state:
+            series = self.series.setdefault(tuple(tuple(label) for label in labels), [[0] * len(self.buckets), 0, 0])
+            series[0] = [a + b for a, b in zip(series[0], counts)]
+            series[1] += total
+            series[2] += count
+
+
+class Metrics:
+    '''
+    Records MongoDB command latencies, the number of commands each route makes, and how long threads wait for a pooled connection.
+    route is a function returning the name of the route being served, or None outside of a request.
+    Commands taking longer than slow_ms milliseconds are counted and logged.
+    Metrics are recorded per process, gunicorn workers share them through a MetricsStore so they can be reported together.
+    '''
+    def __init__(self, route=lambda: None, slow_ms=100):
+        self.route = route
+        self.slow_ms = slow_ms
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        '''
+        Clears the metrics, eg. in a worker forked from a process that recorded some.
+        '''
+        self.commands = Histogram()  # Labelled by command
+        self.failed = {}  # Command: count
+        self.slow = {}  # Command: count
+        self.route_commands = {}  # Route: count
+        self.pool_waits = Histogram()
+        self.checkouts = 0
+        self.checkout_failures = {}  # Reason: count
+        self.checked_out = 0
+
+    def listeners(self):
+        '''
+        Returns the event listeners to register with MongoClient.
+        '''
+        return [CommandMetrics(self), PoolMetrics(self)]
+
+    def command(self, name, seconds, failed=False):
+        route = self.route() or 'none'
+        with self.lock:
+            self.commands.observe((('command', name),), seconds)
+            self.route_commands[route] = self.route_commands.get(route, 0) + 1
+            if failed:
+                self.failed[name] = self.failed.get(name, 0) + 1
+            if seconds * 1000 >= self.slow_ms:
+                self.slow[name] = self.slow.get(name, 0) + 1
+        if seconds * 1000 >= self.slow_ms:
+            logger.warning('Slow MongoDB %s command on route %s took %.1fms', name, route, seconds * 1000)
+
+    def checkout(self, wait):
+        with self.lock:
+            self.pool_waits.observe((), wait)
+            self.checkouts += 1
+            self.checked_out += 1
+
+    def checkout_failed(self, reason):
+        with self.lock:
+            self.checkout_failures[reason] = self.checkout_failures.get(reason, 0) + 1
+
+    def checkin(self):
+        with self.lock:
+            self.checked_out -= 1
+
+    def state(self):
+        '''
+        Returns the metrics as a dictionary that can be saved as JSON and merged into another process's metrics.
+        '''
+        with self.lock:
+            return {'commands': self.commands.state(), 'failed': dict(self.failed), 'slow': dict(self.slow),
+                    'route-commands': dict(self.route_commands), 'pool-waits': self.pool_waits.state(),
+                    'checkouts': self.checkouts, 'checkout-failures': dict(self.checkout_failures), 'checked-out': self.checked_out}
+
+    def merge(self, state, live=True):
+        '''
+        Adds the metrics of another process, from its state. Connections checked out by processes that are no longer live are left out.
+        '''
+        with self.lock:
+            self.commands.merge(state['commands'])
+            self.pool_waits.merge(state['pool-waits'])
+            for counts, key in ((self.failed, 'failed'), (self.slow, 'slow'), (self.route_commands, 'route-commands'),
+                                (self.checkout_failures, 'checkout-failures')):
+                for name, count in state[key].items():
+                    counts[name] = counts.get(name, 0) + count
+            self.checkouts += state['checkouts']
+            if live:
+                self.checked_out += state['checked-out']
+
+    def render(self):
+        '''
+        Returns the metrics in the Prometheus text exposition format.
+        '''
+        def counter(name, help_text, values, label):
+            yield '# HELP {} {}'.format(name, help_text)
+            yield '# TYPE {} counter'.format(name)
+            for key, value in sorted(values.items()):
+                yield '{}{} {}'.format(name, label_text(((label, key),)), value)
+
+        with self.lock:
+            lines = ['# HELP mongo_command_duration_seconds Time taken by MongoDB commands.',
+                     '# TYPE mongo_command_duration_seconds histogram']
+            lines.extend(self.commands.lines('mongo_command_duration_seconds'))
+            lines.extend(counter('mongo_command_failures_total', 'MongoDB commands that failed.', self.failed, 'command'))
+            lines.extend(counter('mongo_slow_commands_total', 'MongoDB commands slower than {}ms.'.format(self.slow_ms), self.slow, 'command'))
+            lines.extend(counter('mongo_route_commands_total', 'MongoDB commands made while serving each route.', self.route_commands, 'route'))
+            lines.extend(['# HELP mongo_pool_wait_seconds Time spent waiting to check out a pooled connection.',
+                          '# TYPE mongo_pool_wait_seconds histogram'])
+            lines.extend(self.pool_waits.lines('mongo_pool_wait_seconds'))
+            lines.extend(['# HELP mongo_pool_checkouts_total Connections checked out of the pool.',
+                          '# TYPE mongo_pool_checkouts_total counter',
+                          'mongo_pool_checkouts_total {}'.format(self.checkouts)])
+            lines.extend(counter('mongo_pool_checkout_failures_total', 'Failed connection checkouts.', self.checkout_failures, 'reason'))
+            lines.extend(['# HELP mongo_pool_checked_out Connections currently checked out of the pool.',
+                          '# TYPE mongo_pool_checked_out gauge',
+                          'mongo_pool_checked_out {}'.format(self.checked_out)])
+        return '\n'.join(lines) + '\n'
+
+
+class CommandMetrics(monitoring.CommandListener):
+    '''
+    Records the duration of each command. Events are published on the thread running the command, so the route is the one it serves.
+    '''
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.metrics.command(event.command_name, event.duration_micros / 1e6)
+
+    def failed(self, event):
+        self.metrics.command(event.command_name, event.duration_micros / 1e6, failed=True)
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    '''
+    Records how long each checkout waited for a connection, timed from the thread's check out started event.
+    '''
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.started = local()
+
+    def connection_check_out_started(self, event):
+        self.started.time = monotonic()
+
+    def connection_checked_out(self, event):
+        self.metrics.checkout(monotonic() - getattr(self.started, 'time', monotonic()))
+
+    def connection_check_out_failed(self, event):
+        self.metrics.checkout_failed(event.reason)
+
+    def connection_checked_in(self, event):
+        self.metrics.checkin()
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # The process exists but belongs to another user
+        return True
+    return True
+
+
+class MetricsStore:
+    '''
+    Shares metrics between gunicorn workers through files in a directory, so whichever worker serves /metrics reports them all.
+    Without it each scrape would see a different worker's counters, which monitoring would read as resets.
+    Each process saves its metrics to a file named after its pid every interval seconds, and when the metrics are combined.
+    Files of processes that have exited, eg. workers restarted after max_requests, are folded into one so their counts are kept.
+    '''
+    def __init__(self, directory, interval=5):
+        self.directory = directory
+        self.interval = interval
+
+    def path(self, name):
+        return os.path.join(self.directory, name + '.json')
+
+    def start(self, metrics):
+        '''
+        Saves the metrics every interval seconds on a daemon thread. Threads don't survive forking, so each worker starts its own.
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        Thread(target=self._save_every_interval, args=(metrics,), daemon=True).start()
+
+    def _save_every_interval(self, metrics):
+        while True:
+            sleep(self.interval)
+            try:
+                self.save(metrics)
+            except OSError:
+                logger.exception('Failed to save metrics to %s', self.directory)
+
+    def save(self, metrics):
+        self._write(self.path(str(os.getpid())), metrics.state())
+
+    def combined(self, metrics):
+        '''
+        Saves this process's metrics, then returns a Metrics with those of every process that has saved them added together.
+        '''
+        self.save(metrics)
+        combined = Metrics(slow_ms=metrics.slow_ms)
+        with self._lock():
+            retired = Metrics()
+            retired_state = self._read(self.path('retired'))
+            if retired_state is not None:
+                retired.merge(retired_state, live=False)
+            exited = []
+            for name in os.listdir(self.directory):
+                pid = name[:-len('.json')]
+                if not name.endswith('.json') or not pid.isdigit():
+                    continue
+                state = self._read(os.path.join(self.directory, name))
+                if state is None:
+                    continue
+                if process_alive(int(pid)):
+                    combined.merge(state)
+                elif fcntl is not None:  # Folding needs the lock, so two workers don't both fold the same file
+                    retired.merge(state, live=False)
+                    exited.append(name)
+                else:
+                    combined.merge(state, live=False)
+            if len(exited) > 0:
+                self._write(self.path('retired'), retired.state())
+                for name in exited:
+                    os.remove(os.path.join(self.directory, name))
+            combined.merge(retired.state(), live=False)
+        return combined
+
+    @contextmanager
+    def _lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, 'lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self, path):
+        try:
+            with open(path) as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, path, state):
+        # Written to a temporary file then moved into place, so other processes never read a partly written file
+        descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(descriptor, 'w') as state_file:
+                json.dump(state, state_file)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
@@ -0,0 +1,36 @@
+from pymongo.errors import DuplicateKeyError
+
+# Relationships are stored one document per edge, so membership checks use the unique index instead of loading arrays.
+# favourites edges are {'username', 'urn'}, follows edges are {'follower', 'followee'}.
+
+
+def add_edge(collection, edge):
+    '''
+    Adds an edge, returns True if it was added or False if it already existed.
+    '''
+    try:
+        collection.insert_one(dict(edge))
+        return True
+    except DuplicateKeyError:
+        return False
+
+
+def remove_edge(collection, edge):
+    '''
+    Removes an edge, returns True if it was removed or False if it didn't exist.
+    '''
+    return collection.delete_one(edge).deleted_count == 1
+
+
+def has_edge(collection, edge):
+    '''
+    Checks if an edge exists, using only the unique index.
+    '''
+    return collection.find_one(edge, {'_id': 1}) is not None
+
+
+def edge_ends(collection, query, field):
+    '''
+    Returns the values of field for all edges matching the query, eg. the urns a user has favourited.
+    '''
+    return [edge[field] for edge in collection.find(query, {field: 1, '_id': 0})]
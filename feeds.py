@@ -0,0 +1,128 @@
+from pymongo.errors import BulkWriteError
+from edges import edge_ends
+
+# Each user's feed holds an entry for the newest recipes by the users they follow, written when the recipe is added or the user followed.
+# Feeds are capped. Each user's feed-count tracks their number of entries, and once it passes size the feed is trimmed to its newest
+# nine tenths of size, so a full feed is trimmed once every size / 10 new entries rather than on every one.
+# Entries copy the fields the feed can be filtered and sorted on, recipe cards are then looked up by urn.
+FEED_FIELDS = ('urn', 'username', 'date', 'tags', 'meals')
+
+
+def feed_entry(owner, recipe):
+    '''
+    Creates a feed entry for a recipe in the owner's feed.
+    '''
+    entry = {field: recipe[field] for field in FEED_FIELDS if field in recipe}
+    entry['owner'] = owner
+    return entry
+
+
+def insert_entries(db, entries):
+    '''
+    Inserts feed entries, skipping any that are already in their owner's feed, and adds them to their owners' feed counts.
+    Returns the owners that had entries added.
+    '''
+    if len(entries) == 0:
+        return []
+    skipped = set()
+    try:
+        db.feeds.insert_many(entries, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details.get('writeErrors', [])
+        if any(error.get('code') != 11000 for error in errors):  # Only ignore duplicate key errors
+            raise
+        skipped = {error['index'] for error in errors}
+    added = {}  # Owner: number of entries added
+    for index, entry in enumerate(entries):
+        if index not in skipped:
+            added[entry['owner']] = added.get(entry['owner'], 0) + 1
+    owners_by_count = {}  # Number of entries added: owners
+    for owner, count in added.items():
+        owners_by_count.setdefault(count, []).append(owner)
+    for count, owners in owners_by_count.items():
+        db.users.update_many({'username': {'$in': owners}}, {'$inc': {'feed-count': count}})
+    return list(added)
+
+
+def trim_feed(db, owner, size):
+    '''
+    Deletes the entries in the owner's feed older than its newest size entries.
+    '''
+    old_entries = [entry['_id'] for entry in db.feeds.find({'owner': owner}, {'_id': 1}).sort([('date', -1), ('_id', -1)]).skip(size)]
+    if len(old_entries) > 0:
+        deleted = db.feeds.delete_many({'_id': {'$in': old_entries}}).deleted_count
+        db.users.update_one({'username': owner}, {'$inc': {'feed-count': -deleted}})
+
+
+def trim_full_feeds(db, owners, size):
+    '''
+    Trims the feeds of the owners whose feed count has passed size, with a single query to find them.
+    '''
+    for user in db.users.find({'username': {'$in': owners}, 'feed-count': {'$gt': size}}, {'username': 1}):
+        trim_feed(db, user['username'], size - size // 10)
+
+
+def fan_out(db, recipe, size):
+    '''
+    Adds a new recipe to the feed of everybody following its author, keeping each feed to size entries.
+    '''
+    followers = edge_ends(db.follows, {'followee': recipe['username']}, 'follower')
+    trim_full_feeds(db, insert_entries(db, [feed_entry(follower, recipe) for follower in followers]), size)
+
+
+def update_entries(db, urn, recipe):
+    '''
+    Updates the copied fields of a recipe's entries in every feed after it is edited.
+    '''
+    fields = {field: recipe[field] for field in FEED_FIELDS if field in recipe and field != 'urn'}
+    if len(fields) > 0:
+        db.feeds.update_many({'urn': urn}, {'$set': fields})
+
+
+def remove_recipe(db, urn):
+    '''
+    Removes a deleted recipe from every feed.
+    '''
+    owners = db.feeds.distinct('owner', {'urn': urn})
+    if len(owners) > 0:
+        db.feeds.delete_many({'urn': urn})
+        db.users.update_many({'username': {'$in': owners}}, {'$inc': {'feed-count': -1}})
+
+
+def follow_feed(db, follower, followee, limit, size):
+    '''
+    Adds the followee's latest recipes to the follower's feed when they follow them, keeping the feed to size entries.
+    '''
+    recipes = db.recipes.find({'username': followee, 'deleted': {'$ne': True}},
+                              {field: 1 for field in FEED_FIELDS}).sort([('date', -1), ('_id', -1)]).limit(limit)
+    trim_full_feeds(db, insert_entries(db, [feed_entry(follower, recipe) for recipe in recipes]), size)
+
+
+def unfollow_feed(db, follower, followee):
+    '''
+    Removes the followee's recipes from the follower's feed when they unfollow them.
+    '''
+    deleted = db.feeds.delete_many({'owner': follower, 'username': followee}).deleted_count
+    if deleted > 0:
+        db.users.update_one({'username': follower}, {'$inc': {'feed-count': -deleted}})
+
+
+def backfill_feeds(db, limit, size):
+    '''
+    Recounts every feed, then rebuilds every follower's feed from the follows collection. Returns the number of follows backfilled.
+    '''
+    count_feeds(db)
+    backfilled = 0
+    for edge in db.follows.find({}, {'follower': 1, 'followee': 1}):
+        follow_feed(db, edge['follower'], edge['followee'], limit, size)
+        backfilled += 1
+    return backfilled
+
+
+def count_feeds(db):
+    '''
+    Sets every user's feed count from their feed, eg. for feeds written before feed counts were kept.
+    '''
+    db.users.update_many({}, {'$set': {'feed-count': 0}})
+    for feed in db.feeds.aggregate([{'$group': {'_id': '$owner', 'count': {'$sum': 1}}}]):
+        db.users.update_one({'username': feed['_id']}, {'$set': {'feed-count': feed['count']}})
@@ -0,0 +1,43 @@
+# Gunicorn settings used by the Procfile. Each can be overridden on the command line, or by the environment variables below.
+import os
+import shutil
+import tempfile
+from multiprocessing import cpu_count
+
+worker_class = 'gthread'  # Threaded workers, so one worker serves many slow clients at once
+workers = int(os.getenv('WEB_CONCURRENCY', cpu_count()))
+threads = int(os.getenv('WEB_THREADS', 8))
+keepalive = 5
+
+# Import the app once in the master process, so workers start quickly and share its code pages until they write to them
+preload_app = True
+
+# Restart workers after a number of requests to release any memory they have built up. The jitter staggers the restarts,
+# so workers that started together don't all restart at once.
+max_requests = int(os.getenv('MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.getenv('MAX_REQUESTS_JITTER', 100))
+
+# Workers save their metrics to files in this directory, so whichever worker serves /metrics adds up all of them. Unless
+# METRICS_DIR is set a new directory is made for each run of the server, and removed when it exits.
+metrics_dir_created = not os.getenv('METRICS_DIR')
+if metrics_dir_created:
+    os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='cookbook-metrics-')
+
+
+def post_fork(server, worker):
+    '''
+    Gives each worker its own MongoDB and S3 clients, rather than those created when the master process imported the app.
+    Each worker also records and saves its own metrics, the master process saves those recorded before it forked.
+    '''
+    import app
+    app.db_metrics.reset()
+    app.create_clients()
+    app.start_metrics()
+
+
+def on_exit(server):
+    '''
+    Removes the metrics directory made for this run.
+    '''
+    if metrics_dir_created:
+        shutil.rmtree(os.environ['METRICS_DIR'], ignore_errors=True)
@@ -0,0 +1,185 @@
+import os
+import logging
+from io import BytesIO
+from uuid import uuid4
+from datetime import datetime
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import quote
+from PIL import Image
+import boto3
+import botocore
+from botocore.config import Config
+
+logger = logging.getLogger(__name__)
+
+IMAGE_SIZE = (1200, 700)  # Size of uploaded images, as cropped by add-recipe.js
+DERIVATIVE_SIZES = {'card': (600, 350), 'thumb': (300, 175)}  # Smaller versions of the image for recipe lists
+# Formats to save derivatives in as (name, Pillow format, content type, extension, save options), if Pillow can write them
+DERIVATIVE_FORMATS = [
+    ('jpeg', 'JPEG', 'image/jpeg', 'jpg', {'quality': 85, 'optimize': True, 'progressive': True}),
+    ('webp', 'WEBP', 'image/webp', 'webp', {'quality': 80, 'method': 4}),
+    ('avif', 'AVIF', 'image/avif', 'avif', {'quality': 60}),
+]
+
+
+class LocalStorage:
+    '''
+    Stores images in a local directory served as static files, for use without S3.
+    '''
+    def __init__(self, directory, url_prefix):
+        self.directory = directory
+        self.url_prefix = url_prefix
+
+    def save(self, key, data, content_type):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, key), 'wb') as f:
+            f.write(data)
+        return self.url_prefix + key
+
+
+class S3Storage:
+    '''
+    Stores images in an S3 bucket and returns their unsigned public urls.
+    The signed client for uploads and an unsigned client for public access are both built once up front,
+    as building clients is slow and not thread safe, whereas using them is.
+    '''
+    def __init__(self, client, bucket):
+        self.client = client
+        self.bucket = bucket
+        self.region = client.meta.region_name
+        self.endpoint_url = client.meta.endpoint_url
+        self.unsigned_client = boto3.session.Session().client('s3', region_name=self.region, endpoint_url=self.endpoint_url,
+                                                              config=Config(signature_version=botocore.UNSIGNED))
+
+    def save(self, key, data, content_type):
+        self.client.upload_fileobj(BytesIO(data), self.bucket, key, ExtraArgs={'ContentType': content_type})
+        return self.url(key)
+
+    def url(self, key):
+        '''
+        Returns the public url for a key. For AWS this is built from the bucket, region and key,
+        for other S3 compatible endpoints the unsigned client creates it.
+        '''
+        if not self.endpoint_url.endswith('.amazonaws.com'):
+            return self.unsigned_client.generate_presigned_url('get_object', ExpiresIn=0, Params={'Bucket': self.bucket, 'Key': key})
+        if self.region in (None, 'us-east-1'):
+            host = 's3.amazonaws.com'
+        else:
+            host = 's3.{}.amazonaws.com'.format(self.region)
+        if '.' in self.bucket:  # Buckets with dots in their names don't match S3's certificate as a subdomain, so use a path
+            return 'https://{}/{}/{}'.format(host, self.bucket, quote(key))
+        return 'https://{}.{}/{}'.format(self.bucket, host, quote(key))
+
+
+def check_image(data):
+    '''
+    Checks the header of uploaded image data is a JPEG of the right size, without decoding the whole image.
+    '''
+    try:
+        image = Image.open(BytesIO(data))
+        valid = image.format == 'JPEG' and image.size == IMAGE_SIZE
+        image.close()
+        return valid
+    except IOError:
+        return False
+
+
+def derivative_formats():
+    '''
+    Returns the derivative formats the installed version of Pillow can save. JPEG is always supported.
+    '''
+    Image.init()
+    return [image_format for image_format in DERIVATIVE_FORMATS if image_format[1] in Image.SAVE]
+
+
+def create_derivatives(data):
+    '''
+    Fully decodes an uploaded image and returns a dictionary of smaller versions of it for each derivative size,
+    each a dictionary of (data, content type, extension) for each supported format.
+    Raises IOError if the image is corrupt.
+    '''
+    image = Image.open(BytesIO(data))
+    image.load()
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    formats = derivative_formats()
+    derivatives = {}
+    for name, size in DERIVATIVE_SIZES.items():
+        resized = image.resize(size, Image.LANCZOS)
+        derivatives[name] = {}
+        for format_name, pillow_format, content_type, extension, options in formats:
+            output = BytesIO()
+            resized.save(output, pillow_format, **options)
+            derivatives[name][format_name] = (output.getvalue(), content_type, extension)
+    image.close()
+    return derivatives
+
+
+class ImageJobs:
+    '''
+    Processes and uploads recipe images on a thread pool, so requests don't wait for image processing or storage.
+    storage and collection are functions returning the image storage and the recipes collection.
+    on_update, if given, is called after a recipe's image has been swapped.
+    '''
+    def __init__(self, storage, collection, workers=2, on_update=None):
+        self.storage = storage
+        self.collection = collection
+        self.on_update = on_update
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._futures = set()
+        self._lock = Lock()
+
+    @staticmethod
+    def new_job():
+        '''
+        Returns a new job id to store on a recipe, so only the latest job for a recipe updates it.
+        '''
+        return uuid4().hex
+
+    def submit(self, urn, job, data):
+        '''
+        Queues an uploaded image to be processed and stored for the recipe with urn.
+        '''
+        future = self._executor.submit(self.process, urn, job, data)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def process(self, urn, job, data):
+        '''
+        Creates derivatives for an image and stores them, then swaps the recipe's placeholder for the real urls.
+        Files are named after the job as well as the recipe, so replacing an image never overwrites one that is still in use.
+        If anything fails the recipe's image is removed.
+        '''
+        key = '{}-{}'.format(urn, job[:8])
+        try:
+            derivatives = create_derivatives(data)
+            storage = self.storage()
+            update = {'image': storage.save(key + '.jpg', data, 'image/jpeg'), 'images': {}}
+            for name, versions in derivatives.items():
+                update['images'][name] = {format_name: storage.save('{}-{}.{}'.format(key, name, extension), derivative, content_type)
+                                          for format_name, (derivative, content_type, extension) in versions.items()}
+        except Exception:
+            logger.exception('Failed to process image for recipe "%s".', urn)
+            update = {'image': None, 'images': None}
+        update['modified'] = datetime.utcnow()  # The recipe's page changes
+        result = self.collection().update_one({'urn': urn, 'image-job': job}, {'$set': update, '$unset': {'image-job': ''}})
+        if result.modified_count > 0 and self.on_update is not None:
+            self.on_update()
+
+    def wait(self, timeout=None):
+        '''
+        Waits for all queued jobs to finish.
+        '''
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures, timeout)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
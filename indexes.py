@@ -0,0 +1,140 @@
+from datetime import datetime
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+# Indexes for each collection, as (keys, options). Recipe sorts use _id as a tiebreaker, so sort indexes include it.
+# Sort indexes are followed by the max_time and since range fields, so those filters are applied to index keys while walking the sort.
+# MongoDB partial indexes can't use $ne, so deleted recipes are filtered after the index scan rather than by a partial filter.
+INDEXES = {
+    'recipes': [
+        ([('urn', ASCENDING)], {'unique': True}),
+        ([('deleted', ASCENDING)], {'partialFilterExpression': {'deleted': True}}),
+        ([('views', DESCENDING), ('_id', DESCENDING), ('total-time', ASCENDING), ('date', DESCENDING)], {}),
+        ([('date', DESCENDING), ('_id', DESCENDING), ('total-time', ASCENDING)], {}),
+        ([('favourites', DESCENDING), ('_id', DESCENDING), ('total-time', ASCENDING), ('date', DESCENDING)], {}),
+        ([('total-time', ASCENDING), ('_id', ASCENDING), ('date', DESCENDING)], {}),
+        ([('featured', DESCENDING), ('_id', DESCENDING)], {'partialFilterExpression': {'featured': {'$exists': True}}}),
+        ([('username', ASCENDING), ('views', DESCENDING), ('_id', DESCENDING)], {}),
+        ([('username', ASCENDING), ('date', DESCENDING), ('_id', DESCENDING)], {}),
+        ([('tags', ASCENDING), ('views', DESCENDING), ('_id', DESCENDING)], {}),
+        ([('meals', ASCENDING), ('views', DESCENDING), ('_id', DESCENDING)], {}),
+        ([('parent', ASCENDING), ('views', DESCENDING), ('_id', DESCENDING)], {}),
+    ],
+    'users': [
+        ([('username', ASCENDING)], {'unique': True}),
+        ([('joined', DESCENDING)], {}),
+        ([('follower-count', DESCENDING)], {}),
+        ([('recipe-count', DESCENDING)], {}),
+    ],
+    'logins': [
+        ([('username', ASCENDING)], {'unique': True}),
+    ],
+    'comments': [
+        ([('urn', ASCENDING), ('time', ASCENDING), ('_id', ASCENDING)], {}),
+    ],
+    'favourites': [
+        ([('username', ASCENDING), ('urn', ASCENDING)], {'unique': True}),
+        ([('urn', ASCENDING)], {}),
+    ],
+    'follows': [
+        ([('follower', ASCENDING), ('followee', ASCENDING)], {'unique': True}),
+        ([('followee', ASCENDING), ('follower', ASCENDING)], {}),
+    ],
+    'feeds': [
+        ([('owner', ASCENDING), ('urn', ASCENDING)], {'unique': True}),
+        ([('owner', ASCENDING), ('date', DESCENDING), ('_id', DESCENDING)], {}),
+        ([('owner', ASCENDING), ('username', ASCENDING)], {}),
+        ([('urn', ASCENDING)], {}),
+    ],
+    'search_changes': [  # Changes are kept for longer than SEARCH_REBUILD_AGE, so saved search indexes can catch up
+        ([('time', ASCENDING)], {'expireAfterSeconds': 14 * 24 * 60 * 60}),
+        ([('number', ASCENDING)], {'unique': True, 'partialFilterExpression': {'number': {'$exists': True}}}),
+    ],
+}
+
+# Indexes that have been replaced, dropped by ensure_indexes if they exist
+DROPPED_INDEXES = {
+    'recipes': ['title_text_ingredients_text'],  # Replaced by the search index
+}
+
+NOT_DELETED = {'deleted': {'$ne': True}}
+RECIPE_SORTS = [[('views', -1), ('_id', -1)], [('date', -1), ('_id', -1)],
+                [('favourites', -1), ('_id', -1)], [('total-time', 1), ('_id', 1)]]
+
+# Example queries for each shape issued by find_recipes, user_list and the edge lookups, as (collection, query, sort)
+QUERY_SHAPES = (
+    [('recipes', {'urn': 'example'}, None)] +
+    [('recipes', NOT_DELETED, sort) for sort in RECIPE_SORTS] +
+    [('recipes', dict(NOT_DELETED, featured={'$exists': True}), [('featured', -1), ('_id', -1)]),
+     ('recipes', dict(NOT_DELETED, **{'total-time': {'$lte': 30}}), [('views', -1), ('_id', -1)]),
+     ('recipes', dict(NOT_DELETED, date={'$gte': datetime(2019, 1, 1)}), [('favourites', -1), ('_id', -1)]),
+     ('recipes', dict(NOT_DELETED, date={'$gte': datetime(2019, 1, 1)}), [('date', -1), ('_id', -1)]),
+     ('recipes', dict(NOT_DELETED, username='example'), [('views', -1), ('_id', -1)]),
+     ('recipes', dict(NOT_DELETED, username={'$in': ['example']}), [('date', -1), ('_id', -1)]),
+     ('recipes', dict(NOT_DELETED, tags={'$all': ['example']}), [('views', -1), ('_id', -1)]),
+     ('recipes', dict(NOT_DELETED, tags={'$all': ['example'], '$nin': ['example']}), [('views', -1), ('_id', -1)]),
+     ('recipes', dict(NOT_DELETED, meals={'$all': ['example']}), [('views', -1), ('_id', -1)]),
+     ('recipes', dict(NOT_DELETED, parent='example'), [('views', -1), ('_id', -1)]),
+     ('recipes', dict(NOT_DELETED, urn={'$in': ['example']}), [('views', -1), ('_id', -1)]),
+     ('recipes', {'deleted': True}, None),
+     ('users', {'username': 'example'}, None),
+     ('users', {}, [('joined', -1)]),
+     ('users', {}, [('follower-count', -1)]),
+     ('users', {}, [('recipe-count', -1)]),
+     ('users', {'username': {'$in': ['example']}}, [('joined', -1)]),
+     ('users', {'username': {'$in': ['example']}, 'feed-count': {'$gt': 0}}, None),
+     ('logins', {'username': 'example'}, None),
+     ('comments', {'urn': 'example'}, [('time', 1), ('_id', 1)]),
+     ('favourites', {'username': 'example'}, None),
+     ('follows', {'follower': 'example'}, None),
+     ('follows', {'followee': 'example'}, None),
+     ('feeds', {'owner': 'example'}, [('date', -1), ('_id', -1)]),
+     ('feeds', {'owner': 'example', 'tags': {'$all': ['example']}}, [('date', -1), ('_id', -1)]),
+     ('search_changes', {'number': {'$gt': 0}}, [('number', 1)])]
+)
+
+
+def ensure_indexes(db):
+    '''
+    Creates any missing indexes and drops replaced ones. Returns a list of (collection, index name, error) tuples, error is None if it was created.
+    '''
+    for collection, names in DROPPED_INDEXES.items():
+        existing = db[collection].index_information()
+        for name in names:
+            if name in existing:
+                db[collection].drop_index(name)
+    results = []
+    for collection, indexes in INDEXES.items():
+        for keys, options in indexes:
+            try:
+                name = db[collection].create_index(keys, **options)
+                results.append((collection, name, None))
+            except OperationFailure as e:  # Eg. existing duplicates prevent creating a unique index
+                results.append((collection, '_'.join('{}_{}'.format(*key) for key in keys), e.details.get('errmsg', str(e))))
+    return results
+
+
+def plan_stages(plan):
+    '''
+    Returns the names of all the stages in a query plan.
+    '''
+    stages = [plan.get('stage')]
+    for child in [plan.get('inputStage')] + plan.get('inputStages', []):
+        if child is not None:
+            stages += plan_stages(child)
+    return stages
+
+
+def find_collection_scans(db):
+    '''
+    Explains each query shape and returns a list of (collection, query, sort) for those whose winning plan is a COLLSCAN.
+    '''
+    scans = []
+    for collection, query, sort in QUERY_SHAPES:
+        cursor = db[collection].find(query)
+        if sort is not None:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain().get('queryPlanner', {}).get('winningPlan', {})
+        if 'COLLSCAN' in plan_stages(plan):
+            scans.append((collection, query, sort))
+    return scans
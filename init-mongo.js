@@ -30,5 +30,3 @@ db.meals.insertMany([{'name' : 'Breakfast'},
                      {'name' : 'Side'},
                      {'name' : 'Dessert'},
                      {'name': 'Drink'}]);
-// Create text index for recipe name and ingredients search.
-db.recipes.createIndex({'title':'text','ingredients':'text'})
@@ -0,0 +1,88 @@
+'''
+One-off data migrations, run through the app's CLI commands.
+'''
+from datetime import datetime
+from render import render_fields, minutes
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'  # Format dates were stored as strings in
+
+
+def migrate_comments(db):
+    '''
+    Moves comments embedded in recipes into the comments collection, skipping deleted comments.
+    Comments are upserted so the migration can safely be run again if it is interrupted. Returns the number of comments moved.
+    '''
+    moved = 0
+    for recipe in db.recipes.find({'comments': {'$exists': True}}, {'urn': 1, 'comments': 1}):
+        for comment in recipe.get('comments') or []:
+            if comment.get('deleted', False):
+                continue
+            time = comment['time']
+            if isinstance(time, str):
+                time = datetime.strptime(time, DATETIME_FORMAT)
+            comment_doc = {'urn': recipe['urn'], 'username': comment['username'], 'time': time, 'comment': comment['comment']}
+            db.comments.update_one(comment_doc, {'$setOnInsert': comment_doc}, upsert=True)
+            moved += 1
+        db.recipes.update_one({'_id': recipe['_id']}, {'$unset': {'comments': ''}})
+    return moved
+
+
+def migrate_edges(db):
+    '''
+    Moves the favouriting-users arrays on recipes and the followers and following arrays on users into the favourites and follows collections.
+    Edges are upserted so the migration can safely be run again. Returns the number of favourites and follows added.
+    '''
+    favourites = 0
+    for recipe in db.recipes.find({'favouriting-users': {'$exists': True}}, {'urn': 1, 'favouriting-users': 1}):
+        for username in recipe.get('favouriting-users') or []:
+            edge = {'username': username, 'urn': recipe['urn']}
+            if db.favourites.update_one(edge, {'$setOnInsert': edge}, upsert=True).upserted_id is not None:
+                favourites += 1
+        db.recipes.update_one({'_id': recipe['_id']}, {'$unset': {'favouriting-users': ''}})
+    follows = 0
+    query = {'$or': [{'followers': {'$exists': True}}, {'following': {'$exists': True}}]}
+    for user in db.users.find(query, {'username': 1, 'followers': 1, 'following': 1}):
+        edges = [{'follower': follower, 'followee': user['username']} for follower in user.get('followers') or []]
+        edges += [{'follower': user['username'], 'followee': followee} for followee in user.get('following') or []]
+        for edge in edges:  # Each follow is on both users, the upsert only inserts it once
+            if db.follows.update_one(edge, {'$setOnInsert': edge}, upsert=True).upserted_id is not None:
+                follows += 1
+        db.users.update_one({'_id': user['_id']}, {'$unset': {'followers': '', 'following': ''}})
+    return favourites, follows
+
+
+def backfill_render_fields(db):
+    '''
+    Converts recipe dates stored as strings to datetimes, and adds the rendered fields recipe pages show to recipes created before they were stored.
+    Returns the number of recipes updated.
+    '''
+    updated = 0
+    for recipe in db.recipes.find({'deleted': {'$ne': True}}, {'date': 1, 'urn': 1, 'ingredients': 1, 'methods': 1,
+                                                               'prep-time': 1, 'cook-time': 1}):
+        if isinstance(recipe.get('date'), str):
+            recipe['date'] = datetime.strptime(recipe['date'], DATETIME_FORMAT)
+            db.feeds.update_many({'urn': recipe['urn']}, {'$set': {'date': recipe['date']}})  # Keep the dates copied to feeds sortable with new ones
+        fields = render_fields(recipe)
+        if isinstance(recipe.get('date'), datetime):
+            fields['date'] = recipe['date']
+        db.recipes.update_one({'_id': recipe['_id']}, {'$set': fields})
+        updated += 1
+    return updated
+
+
+def migrate_datetimes(db):
+    '''
+    Converts user joined dates, recipe featured dates and comment times stored as strings to datetimes, and recipe total times
+    stored as 00:00 strings to minutes. Only string values are converted, so the migration can safely be run again.
+    Returns the number of documents updated.
+    '''
+    updated = 0
+    conversions = [('users', 'joined', lambda value: datetime.strptime(value, DATETIME_FORMAT)),
+                   ('recipes', 'featured', lambda value: datetime.strptime(value, DATETIME_FORMAT)),
+                   ('comments', 'time', lambda value: datetime.strptime(value, DATETIME_FORMAT)),
+                   ('recipes', 'total-time', minutes)]
+    for collection, field, convert in conversions:
+        for document in db[collection].find({field: {'$type': 'string'}}, {field: 1}):
+            db[collection].update_one({'_id': document['_id']}, {'$set': {field: convert(document[field])}})
+            updated += 1
+    return updated
@@ -0,0 +1,74 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, Future
+from time import perf_counter
+
+logger = logging.getLogger(__name__)
+
+
+class QueryExecutor:
+    '''
+    Thread pool shared by a worker's requests for running independent database queries concurrently.
+    At most workers queries run at once however many requests are using it, with 0 workers queries run one after another.
+    '''
+    def __init__(self, workers=8):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='query') if workers > 0 else None
+
+    def group(self):
+        '''
+        Returns a new QueryGroup for the queries of a single request.
+        '''
+        return QueryGroup(self._executor)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+
+class QueryGroup:
+    '''
+    Named queries run on a QueryExecutor for one request. Each query's start, relative to when the group was created, and duration
+    are recorded in timings, so the query on the critical path can be seen.
+    '''
+    def __init__(self, executor):
+        self._executor = executor
+        self.futures = {}
+        self.timings = {}  # Name: (start, duration) in seconds
+        self.created = perf_counter()
+
+    def submit(self, name, function, *args, **kwargs):
+        '''
+        Starts running function(*args, **kwargs) as the query name.
+        '''
+        def timed():
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.timings[name] = (start - self.created, perf_counter() - start)
+
+        if self._executor is not None:
+            self.futures[name] = self._executor.submit(timed)
+        else:
+            future = self.futures[name] = Future()
+            try:
+                future.set_result(timed())
+            except Exception as e:
+                future.set_exception(e)
+
+    def results(self):
+        '''
+        Waits for every query, returning a dictionary of their results by name. Re-raises the exception of a query that failed.
+        '''
+        results = {name: future.result() for name, future in self.futures.items()}
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Queries finished after %.1fms, critical path %s', (perf_counter() - self.created) * 1000, self.critical_path())
+        return results
+
+    def critical_path(self):
+        '''
+        Returns the name of the query that finished last, which the request waited on.
+        '''
+        if not self.timings:
+            return None
+        return max(self.timings, key=lambda name: sum(self.timings[name]))
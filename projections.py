@@ -0,0 +1,53 @@
+import warnings
+
+# Named sets of recipe fields fetched for each view, so pages don't load fields that grow with the document.
+PROJECTIONS = {
+    'card': ('urn', 'title', 'username', 'image', 'images', 'comment-count', 'favourites'),
+    'detail': ('urn', 'title', 'username', 'date-text', 'image', 'images', 'ingredient-list', 'method-list', 'tags', 'meals',
+               'prep-time-text', 'cook-time-text', 'parent', 'parent-title', 'children', 'featured', 'favourites', 'comment-count',
+               'deleted', 'date', 'modified'),
+    'edit': ('title', 'username', 'ingredients', 'methods', 'prep-time', 'cook-time', 'tags', 'meals', 'image', 'deleted'),
+    'delete': ('title', 'username', 'parent', 'children', 'deleted'),
+    'fork': ('title', 'ingredients', 'methods', 'tags', 'meals', 'prep-time', 'cook-time', 'image', 'deleted'),
+}
+
+# Fields templates check for that aren't fetched for a view, because the view adds them or they're only set for other views.
+TEMPLATE_FIELDS = {
+    'detail': ('forks',),
+    'edit': ('old-image', 'parent'),
+    'fork': ('old-image', 'parent'),
+}
+
+
+class ProjectionWarning(UserWarning):
+    pass
+
+
+def projection(view, *extra):
+    '''
+    Returns the projection for a view, with any extra fields, eg. the field being sorted on.
+    '''
+    return {field: 1 for field in PROJECTIONS[view] + extra}
+
+
+class ProjectedDocument(dict):
+    '''
+    Document fetched with a view's projection, that warns when a field outside the projection is read.
+    Used in debug mode to catch templates that need fields the view doesn't fetch.
+    '''
+    def __init__(self, document, view, extra=()):
+        super().__init__(document)
+        self.view = view
+        self.fields = set(PROJECTIONS[view]) | set(TEMPLATE_FIELDS.get(view, ())) | set(extra)
+
+    def check(self, key):
+        if key not in self and key not in self.fields:
+            warnings.warn('"{}" is not in the {} projection'.format(key, self.view), ProjectionWarning, stacklevel=3)
+
+    def __getitem__(self, key):
+        self.check(key)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.check(key)
+        return super().get(key, default)
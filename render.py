@@ -0,0 +1,55 @@
+from re import match
+from datetime import datetime
+
+DATE_FORMAT = '%a %d %b \'%y'  # Format recipe dates are shown in, eg. Mon 01 Apr '19
+NO_TOTAL_TIME = 99 * 60 + 59  # Total time in minutes for recipes without times, so they sort after quicker recipes
+
+
+def minutes(hours_mins):
+    '''
+    Helper function to convert stored 00:00 times to a number of minutes
+    '''
+    hours, mins = hours_mins.split(':')
+    return int(hours) * 60 + int(mins)
+
+
+def hours_mins_to_string(hours_mins):
+    '''
+    Helper function to convert stored times to strings
+    '''
+    if hours_mins == '00:00' or not match('^[0-9]{2}:[0-5][0-9]$', hours_mins):
+        return '0 minutes'
+    hours, mins = hours_mins.split(':')
+    hours = int(hours)
+    mins = int(mins)
+    string = ''
+    if hours > 1:
+        string += str(hours) + ' hours'
+    elif hours == 1:
+        string += str(hours) + ' hour'
+    if hours > 0 and mins > 0:
+        string += ' '
+    if mins > 1:
+        string += str(mins) + ' minutes'
+    elif mins == 1:
+        string += '1 minute'
+    return string
+
+
+def render_fields(recipe):
+    '''
+    Creates the fields the recipe page displays from the submitted recipe fields, so they are only worked out when a recipe is written.
+    Only fields that are in the recipe are rendered, so edits that don't change a field leave its rendered version alone.
+    '''
+    fields = {}
+    if isinstance(recipe.get('ingredients'), str):
+        fields['ingredient-list'] = recipe['ingredients'].split('\n')
+    if isinstance(recipe.get('methods'), str):
+        fields['method-list'] = recipe['methods'].split('\n')
+    if isinstance(recipe.get('prep-time'), str):
+        fields['prep-time-text'] = hours_mins_to_string(recipe['prep-time'])
+    if isinstance(recipe.get('cook-time'), str):
+        fields['cook-time-text'] = hours_mins_to_string(recipe['cook-time'])
+    if isinstance(recipe.get('date'), datetime):
+        fields['date-text'] = recipe['date'].strftime(DATE_FORMAT)
+    return fields
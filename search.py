@@ -0,0 +1,506 @@
+import os
+import json
+import logging
+import mmap
+import struct
+import tempfile
+from math import log
+from re import findall
+from bisect import bisect_left, insort
+from heapq import nlargest
+from threading import Lock
+from time import monotonic
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+# Fields that are searched, and how many times each occurrence of a term in them counts
+SEARCH_FIELDS = {'title': 3, 'ingredients': 1, 'methods': 1}
+STOPWORDS = {'a', 'an', 'and', 'as', 'at', 'by', 'for', 'in', 'into', 'of', 'on', 'or', 'the', 'then', 'to', 'with'}
+PREFIX_WEIGHT = 0.5  # Score multiplier for terms that only start with a query word
+FUZZY_WEIGHT = 0.3  # Score multiplier for terms that are a typo away from a query word
+K1 = 1.2  # BM25 term frequency saturation
+B = 0.75  # BM25 document length normalisation
+POSTING = struct.Struct('<II')  # Document number and term frequency
+HEADER_LENGTH = struct.Struct('<I')
+SEARCH_PROJECTION = {'urn': 1, 'title': 1, 'ingredients': 1, 'methods': 1, '_id': 0}
+CHANGE_GAP_TIMEOUT = timedelta(seconds=60)  # How long a missing change number is waited for before its write is assumed to have failed
+SUGGEST_PROJECTION = {'urn': 1, 'title': 1, 'ingredients': 1, 'username': 1, 'views': 1, '_id': 0}
+
+
+def stem(word):
+    '''
+    Strips plural and trailing e endings so eg. apples and apple, or cookies and cookie, index as the same term.
+    '''
+    if word.endswith('s') and not word.endswith(('ss', 'us', 'is')) and len(word) > 3:
+        word = word[:-1]
+    if word.endswith('e') and len(word) > 3:
+        word = word[:-1]
+    return word
+
+
+def tokenize(text):
+    '''
+    Splits text into lowercase words, dropping stopwords and single characters.
+    '''
+    return [word for word in findall('[a-z0-9]+', text.lower()) if len(word) > 1 and word not in STOPWORDS]
+
+
+def edit_distance(a, b, limit):
+    '''
+    Levenshtein distance between two words, stopping early once it's more than limit.
+    '''
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def document_terms(recipe):
+    '''
+    Counts the terms in a recipe's searched fields, returns the counts and the document's length.
+    '''
+    counts = {}
+    for field, weight in SEARCH_FIELDS.items():
+        value = recipe.get(field)
+        if isinstance(value, list):
+            value = '\n'.join(value)
+        for word in tokenize(value or ''):
+            term = stem(word)
+            counts[term] = counts.get(term, 0) + weight
+    return counts, sum(counts.values())
+
+
+class Segment:
+    '''
+    Read only postings stored in a file, memory-mapped so postings are only read from disk when a term is searched.
+    The file starts with the length of a JSON header holding the urns, document lengths and each term's postings offset and count.
+    '''
+    def __init__(self, path):
+        with open(path, 'rb') as segment_file:
+            self.map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            header_length = HEADER_LENGTH.unpack_from(self.map, 0)[0]
+            header = json.loads(self.map[HEADER_LENGTH.size:HEADER_LENGTH.size + header_length].decode())
+            self.urns = header['urns']
+            self.lengths = dict(zip(self.urns, header['lengths']))
+            self.terms = header['terms']
+            self.last_change = int(header['last-change'])
+            self.built = datetime.strptime(header['built'], '%Y-%m-%d %H:%M:%S')
+        except Exception:
+            self.map.close()
+            raise
+        self.start = HEADER_LENGTH.size + header_length
+
+    def postings(self, term):
+        '''
+        Returns a dictionary of urn: term frequency for a term.
+        '''
+        entry = self.terms.get(term)
+        if entry is None:
+            return {}
+        offset, count = entry
+        start = self.start + offset
+        return {self.urns[number]: frequency
+                for number, frequency in POSTING.iter_unpack(self.map[start:start + count * POSTING.size])}
+
+    def close(self):
+        self.map.close()
+
+    @staticmethod
+    def write(path, postings, lengths, last_change, built):
+        '''
+        Writes postings to a new segment file, replacing any existing one once it is complete.
+        last_change is the number of the last change in the search_changes log the postings include, built when the index was built.
+        '''
+        urns = sorted(lengths)
+        numbers = {urn: number for number, urn in enumerate(urns)}
+        terms = {}
+        blob = bytearray()
+        for term in sorted(postings):
+            documents = postings[term]
+            terms[term] = [len(blob), len(documents)]
+            for urn in sorted(documents, key=numbers.get):
+                blob += POSTING.pack(numbers[urn], documents[urn])
+        header = json.dumps({'urns': urns, 'lengths': [lengths[urn] for urn in urns], 'terms': terms,
+                             'last-change': last_change or 0,
+                             'built': built.strftime('%Y-%m-%d %H:%M:%S')}).encode()
+        # Each writer uses its own temporary file, as workers may save at the same time when they shut down
+        descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        try:
+            with os.fdopen(descriptor, 'wb') as segment_file:
+                segment_file.write(HEADER_LENGTH.pack(len(header)))
+                segment_file.write(header)
+                segment_file.write(blob)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+
+class SearchIndex:
+    '''
+    Inverted index over recipe titles, ingredients and methods, ranking matches with BM25.
+    Recipes are read from a memory-mapped segment written when the index is built or saved, with recipes added or removed since
+    kept in memory until the next save. If path is None the index is only kept in memory.
+    '''
+    projection = SEARCH_PROJECTION
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = Lock()
+        self.refresh_lock = Lock()  # Held while loading, rebuilding or updating the index from the database
+        self.segment = None
+        self.postings = {}  # Term: {urn: frequency} for recipes added since the segment was written
+        self.lengths = {}  # Urn: length for recipes added since the segment was written
+        self.removed = set()  # Urns in the segment that have since been removed or replaced
+        self.built = None  # When the index was last built from the recipes collection, None until it has been
+        self.last_change = None  # Number of the last change in the search_changes log that has been applied
+        self.refreshed = 0  # Monotonic time changes were last applied
+        self.sorted_terms = None
+
+    def load(self):
+        '''
+        Loads the segment from disk, returns False if there isn't one or it can't be read, so the index is rebuilt.
+        '''
+        if self.path is None or not os.path.exists(self.path):
+            return False
+        try:
+            segment = Segment(self.path)
+        except (OSError, ValueError, KeyError, TypeError, struct.error):
+            logger.warning('Search index segment %s could not be read, rebuilding it', self.path, exc_info=True)
+            return False
+        with self.lock:
+            self._replace_segment(segment)
+            self.built, self.last_change = self.segment.built, self.segment.last_change
+        return True
+
+    def build(self, recipes, last_change=None):
+        '''
+        Rebuilds the index from an iterable of recipes, then saves it. last_change is the last change in the log before the recipes were read.
+        '''
+        built = datetime.utcnow().replace(microsecond=0)
+        postings, lengths = {}, {}
+        for recipe in recipes:
+            counts, lengths[recipe['urn']] = document_terms(recipe)
+            for term, frequency in counts.items():
+                postings.setdefault(term, {})[recipe['urn']] = frequency
+        with self.lock:
+            if self.path is not None:
+                Segment.write(self.path, postings, lengths, last_change, built)
+                self._replace_segment(Segment(self.path))
+            else:
+                self._replace_segment(None)
+                self.postings, self.lengths = postings, lengths
+            self.built, self.last_change = built, last_change
+
+    def save(self):
+        '''
+        Merges recipes added or removed since the segment was written into a new segment.
+        '''
+        if self.path is None or self.built is None:
+            return
+        with self.lock:
+            postings = {term: dict(documents) for term, documents in self.postings.items()}
+            lengths = dict(self.lengths)
+            if self.segment is not None:
+                for term in self.segment.terms:
+                    for urn, frequency in self.segment.postings(term).items():
+                        if urn not in self.removed:
+                            postings.setdefault(term, {})[urn] = frequency
+                lengths.update((urn, length) for urn, length in self.segment.lengths.items() if urn not in self.removed)
+            Segment.write(self.path, postings, lengths, self.last_change, self.built)
+            self._replace_segment(Segment(self.path))
+
+    def _replace_segment(self, segment):
+        if self.segment is not None:
+            self.segment.close()
+        self.segment = segment
+        self.postings, self.lengths, self.removed = {}, {}, set()
+        self.sorted_terms = None
+
+    def add(self, recipe):
+        '''
+        Adds or replaces a recipe in the index.
+        '''
+        counts, length = document_terms(recipe)
+        with self.lock:
+            self._remove(recipe['urn'])
+            for term, frequency in counts.items():
+                self.postings.setdefault(term, {})[recipe['urn']] = frequency
+            self.lengths[recipe['urn']] = length
+            self.sorted_terms = None
+
+    def remove(self, urn):
+        '''
+        Removes a recipe from the index.
+        '''
+        with self.lock:
+            self._remove(urn)
+
+    def _remove(self, urn):
+        if urn in self.lengths:
+            del self.lengths[urn]
+            for term in [term for term, documents in self.postings.items() if urn in documents]:
+                del self.postings[term][urn]
+                if len(self.postings[term]) == 0:
+                    del self.postings[term]
+                    self.sorted_terms = None
+        if self.segment is not None and urn in self.segment.lengths:
+            self.removed.add(urn)
+
+    def _terms(self):
+        if self.sorted_terms is None:
+            terms = set(self.postings)
+            if self.segment is not None:
+                terms.update(self.segment.terms)
+            self.sorted_terms = sorted(terms)
+        return self.sorted_terms
+
+    def _postings(self, term):
+        documents = {}
+        if self.segment is not None:
+            documents = {urn: frequency for urn, frequency in self.segment.postings(term).items() if urn not in self.removed}
+        documents.update(self.postings.get(term, {}))
+        return documents
+
+    def expand(self, word):
+        '''
+        Finds the terms matching a query word and their weights. The word's stem matches exactly, words of three or more
+        letters also match terms they start, and if nothing matches terms a typo away are used instead.
+        '''
+        terms = self._terms()
+        matches = {}
+        target = stem(word)
+        if len(word) >= 3:
+            index = bisect_left(terms, word)
+            while index < len(terms) and terms[index].startswith(word):
+                matches[terms[index]] = PREFIX_WEIGHT
+                index += 1
+        index = bisect_left(terms, target)
+        if index < len(terms) and terms[index] == target:
+            matches[target] = 1
+        if len(matches) == 0 and len(target) >= 4:
+            limit = 2 if len(target) >= 8 else 1
+            for term in terms:
+                if term[0] == target[0] and edit_distance(term, target, limit) <= limit:
+                    matches[term] = FUZZY_WEIGHT
+        return matches
+
+    def search(self, text, limit=None):
+        '''
+        Returns the urns of recipes matching every word in the text, best match first.
+        '''
+        words = tokenize(text)
+        if len(words) == 0:
+            return []
+        with self.lock:
+            total_length = sum(self.lengths.values())
+            documents = len(self.lengths)
+            if self.segment is not None:
+                total_length += sum(length for urn, length in self.segment.lengths.items() if urn not in self.removed)
+                documents += len(self.segment.lengths) - len(self.removed)
+            if documents == 0:
+                return []
+            average_length = total_length / documents
+            lengths = self.lengths
+            segment_lengths = self.segment.lengths if self.segment is not None else {}
+            scores = None
+            for word in words:
+                word_scores = {}
+                for term, weight in self.expand(word).items():
+                    postings = self._postings(term)
+                    idf = log(1 + (documents - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for urn, frequency in postings.items():
+                        length = lengths.get(urn, segment_lengths.get(urn, average_length))
+                        score = weight * idf * frequency * (K1 + 1) / (frequency + K1 * (1 - B + B * length / average_length))
+                        word_scores[urn] = max(word_scores.get(urn, 0), score)
+                if scores is None:
+                    scores = word_scores
+                else:  # Recipes must match every word
+                    scores = {urn: score + word_scores[urn] for urn, score in scores.items() if urn in word_scores}
+                if len(scores) == 0:
+                    return []
+        ranked = sorted(scores, key=lambda urn: (-scores[urn], urn))
+        return ranked if limit is None else ranked[:limit]
+
+
+class Suggestions:
+    '''
+    Prefix index of recipe titles, ingredient words and usernames, for suggesting searches as they are typed.
+    Keys are kept in a sorted array, so the keys starting with some text are found by bisection. Titles have a key for each
+    word, so they match from any word. Titles are ranked by views, ingredients by how many recipes use them and users by
+    how many recipes they've added. Suggestions aren't saved, they are built from the database when first used.
+    '''
+    projection = SUGGEST_PROJECTION
+
+    def __init__(self):
+        self.lock = Lock()
+        self.refresh_lock = Lock()  # Held while rebuilding or updating the suggestions from the database
+        self.keys = []  # Sorted (key, type, id) tuples
+        self.popularity = {}  # (type, id): popularity
+        self.recipes = {}  # Urn: title, username and ingredient words of each recipe
+        self.built = None
+        self.last_change = None
+        self.refreshed = 0
+
+    def load(self):
+        '''
+        Suggestions aren't saved, so there is never anything to load.
+        '''
+        return False
+
+    def build(self, recipes, last_change=None):
+        '''
+        Rebuilds the suggestions from an iterable of recipes.
+        '''
+        keys = []
+        with self.lock:
+            self.popularity, self.recipes = {}, {}
+            for recipe in recipes:
+                keys += self._add(recipe)
+            keys.sort()
+            self.keys = keys
+            self.built, self.last_change = datetime.utcnow(), last_change
+
+    def add(self, recipe):
+        '''
+        Adds or replaces a recipe's suggestions. Its views and username are kept from before if they aren't given, as edits don't change them.
+        '''
+        with self.lock:
+            previous = self.recipes.get(recipe['urn'])
+            if previous is not None:
+                recipe = dict(recipe)
+                recipe.setdefault('views', self.popularity.get(('recipe', recipe['urn']), 0))
+                recipe.setdefault('username', previous['username'])
+            self._remove(recipe['urn'])
+            for key in self._add(recipe):
+                insort(self.keys, key)
+
+    def remove(self, urn):
+        '''
+        Removes a recipe's suggestions.
+        '''
+        with self.lock:
+            self._remove(urn)
+
+    def _count(self, kind, name, change):
+        '''
+        Changes the number of recipes for an ingredient or user, returns True if its first recipe was added or its last removed.
+        '''
+        count = self.popularity.get((kind, name), 0) + change
+        if count > 0:
+            self.popularity[(kind, name)] = count
+        else:
+            self.popularity.pop((kind, name), None)
+        return count == 1 if change > 0 else count <= 0
+
+    def _add(self, recipe):
+        '''
+        Records a recipe's suggestions, returns the new keys.
+        '''
+        urn, title, username = recipe['urn'], recipe.get('title', ''), recipe.get('username')
+        ingredients = recipe.get('ingredients') or ''
+        if isinstance(ingredients, list):
+            ingredients = '\n'.join(ingredients)
+        words = {word for word in tokenize(ingredients) if len(word) > 2 and not word.isdigit()}
+        self.recipes[urn] = {'title': title, 'username': username, 'words': words}
+        self.popularity[('recipe', urn)] = recipe.get('views', 0) or 0
+        keys = [(key, 'recipe', urn) for key in title_keys(title)]
+        keys += [(word, 'ingredient', word) for word in words if self._count('ingredient', word, 1)]
+        if username is not None and self._count('user', username, 1):
+            keys.append((username.lower(), 'user', username))
+        return keys
+
+    def _remove(self, urn):
+        recipe = self.recipes.pop(urn, None)
+        if recipe is None:
+            return
+        self.popularity.pop(('recipe', urn), None)
+        keys = [(key, 'recipe', urn) for key in title_keys(recipe['title'])]
+        keys += [(word, 'ingredient', word) for word in recipe['words'] if self._count('ingredient', word, -1)]
+        if recipe['username'] is not None and self._count('user', recipe['username'], -1):
+            keys.append((recipe['username'].lower(), 'user', recipe['username']))
+        for key in keys:
+            index = bisect_left(self.keys, key)
+            if index < len(self.keys) and self.keys[index] == key:
+                del self.keys[index]
+
+    def suggest(self, text, limit=8):
+        '''
+        Returns up to limit of the most popular suggestions starting with the text, as dictionaries of type, text and urn for recipes.
+        '''
+        text = ' '.join(text.lower().split())
+        if text == '':
+            return []
+        with self.lock:
+            matches = set()
+            index = bisect_left(self.keys, (text,))
+            while index < len(self.keys) and self.keys[index][0].startswith(text):
+                matches.add(self.keys[index][1:])
+                index += 1
+            best = nlargest(limit, matches, key=lambda match: (self.popularity.get(match, 0), match))
+            return [{'type': kind, 'text': self.recipes[name]['title'], 'urn': name} if kind == 'recipe'
+                    else {'type': kind, 'text': name} for kind, name in best]
+
+
+def title_keys(title):
+    '''
+    Returns the keys for a title, the lowercase title from the start of each word.
+    '''
+    title = ' '.join(title.lower().split())
+    return {title[start:] for start in [0] + [i + 1 for i, char in enumerate(title) if char == ' ']}
+
+
+def record_change(db, urn):
+    '''
+    Logs that a recipe has been added, edited or deleted, so every process's index picks up the change.
+    Changes are numbered from a counter on the server, so every process reads them in the same order.
+    '''
+    number = db.counters.find_one_and_update({'_id': 'search_changes'}, {'$inc': {'number': 1}}, upsert=True,
+                                             return_document=ReturnDocument.AFTER)['number']
+    db.search_changes.insert_one({'number': number, 'urn': urn, 'time': datetime.utcnow()})
+
+
+def build_index(db, index):
+    '''
+    Rebuilds an index from every recipe that hasn't been deleted.
+    The last change number is read first, as the recipe writes of changes numbered up to it have already been made.
+    '''
+    counter = db.counters.find_one({'_id': 'search_changes'})
+    last_change = counter['number'] if counter is not None else 0
+    index.build(db.recipes.find({'deleted': {'$ne': True}}, index.projection), last_change)
+
+
+def apply_changes(db, index):
+    '''
+    Brings an index up to date with changes logged since it was built or last updated, re-reading each changed recipe.
+    A change can be inserted after later numbered ones are read, so last_change only moves past a missing number once the changes
+    after it are older than CHANGE_GAP_TIMEOUT. Changes after a gap are applied now and again next time, which gives the same result.
+    '''
+    index.refreshed = monotonic()
+    last_change = index.last_change or 0
+    changes = list(db.search_changes.find({'number': {'$gt': last_change}}).sort('number', 1))
+    if len(changes) == 0:
+        return
+    urns = {change['urn'] for change in changes}
+    recipes = {recipe['urn']: recipe for recipe in db.recipes.find({'urn': {'$in': list(urns)}, 'deleted': {'$ne': True}}, index.projection)}
+    for urn in urns:
+        if urn in recipes:
+            index.add(recipes[urn])
+        else:
+            index.remove(urn)
+    waited = datetime.utcnow() - CHANGE_GAP_TIMEOUT
+    for change in changes:
+        if change['number'] != last_change + 1 and change['time'] > waited:
+            break
+        last_change = change['number']
+    index.last_change = last_change
@@ -0,0 +1,39 @@
+from re import findall, escape as re_escape
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+
+def slugify(title):
+    '''
+    Creates a slug from a title, containing only lowercase letters and dashes.
+    '''
+    return '-'.join(findall('[a-z-]+', title.lower()))
+
+
+def seed_counter(db, slug):
+    '''
+    Returns how many urns have already been allocated for a slug by recipes created before it had a counter,
+    which is one more than the largest number added to the slug.
+    '''
+    existing = db.recipes.find({'urn': {'$regex': '^' + re_escape(slug) + '[0-9]*$'}}, {'urn': 1, '_id': 0})
+    suffixes = [int(recipe['urn'][len(slug):] or 0) for recipe in existing]
+    return max(suffixes) + 1 if suffixes else 0
+
+
+def allocate_urn(db, title):
+    '''
+    Allocates a unique urn for a recipe title using an atomic counter per slug in the slugs collection.
+    The first recipe gets the slug itself, and following recipes get the slug followed by a number.
+    '''
+    slug = slugify(title)
+    while True:
+        counter = db.slugs.find_one_and_update({'_id': slug}, {'$inc': {'count': 1}}, return_document=ReturnDocument.AFTER)
+        if counter is None:  # If there's no counter for this slug yet create one, allowing for any existing recipes
+            count = seed_counter(db, slug) + 1
+            try:
+                db.slugs.insert_one({'_id': slug, 'count': count})
+            except DuplicateKeyError:  # Another request created the counter first, so increment theirs
+                continue
+        else:
+            count = counter['count']
+        return slug if count == 1 else slug + str(count - 1)
@@ -33,67 +33,75 @@ function deleteComment() {
         if (this.status == 200) {
             var response = JSON.parse(this.responseText);
             if (response.success === true) {
-                jsonGet(commentUrl, reloadComments); // If a change has been made, reload the comments
+                $('#comment-' + response.id).remove(); // Only the deleted comment is removed, the others are left as they are
+                updateCommentCount(response.count);
             }
             response.messages.forEach(function(message) {
                 M.toast({ html: message });
             });
         } else M.toast({ html: 'Failed to delete comment!' });
+        $('.delete-comment .btn[type=submit]').removeClass('disabled');
     }
 }
 
 
-// Callback for loading comments
-function reloadComments() {
+// Add comment callback
+function addComment() {
     if (this.readyState == 4) {
         if (this.status == 200) {
             var response = JSON.parse(this.responseText);
-            renderComments(response.comments);
+            if (response.success === true) {
+                appendComment(response.comment); // The response holds just the new comment, so no pages of comments are reloaded
+                updateCommentCount(response.count);
+            }
             response.messages.forEach(function(message) {
                 M.toast({ html: message });
             });
-        }
+        } else M.toast({ html: 'Failed to add comment!' });
     }
 }
 
 
-// Renders all comments again to reflect changes
-function renderComments(comments) {
-    var count = comments.filter(function(comment) { return !comment.deleted }).length;
-    $('#comment-count').text(count + ' comments.'); // Update comment count.
+// Updates the comment counts shown
+function updateCommentCount(count) {
+    $('#comment-count').text(count + ' comments.');
     $('.comment-count').text(count);
-    // Empty the comments list and repopulate with retrived comments.
-    $('#comments-content').html('');
-    comments.forEach(function(comment) {
-        if (!comment.deleted) {
-            $('#comments-content').append('<div class="divider"></div>');
-            $('#comments-content').append('<p>By ' + comment.username + ' at ' + comment.time + '</p>');
-            var commentContent = '';
-            comment.comment.split('\n').forEach(function(line) { // Splits content on new line and renders as seperate paragraphs.
-                commentContent += '<p>' + line + '</p>';
-            });
-            $('#comments-content').append('<blockquote>' + commentContent + '</blockquote>');
-            // If there is the option to delete a comment add the delete button
-            if (comment.delete == true) {
-                var deleteForm = '<form action="';
-                deleteForm += deleteCommentUrl;
-                deleteForm += '" method="POST" class="delete-comment">';
-                deleteForm += '<input type="hidden" name="comment-index" value="' + comment.index + '">';
-                deleteForm += '<div class="delete-wrapper">';
-                deleteForm += '<button class="btn waves-effect waves-light red small right" type="submit"><i class="material-icons left">delete</i>Delete Comment</button>';
-                deleteForm += '</div>';
-                deleteForm += '</form>';
-                $('#comments-content').append(deleteForm);
-            }
-        }
-    });
-    // Attach event handler to new delete buttons
-    $('.delete-comment').on('submit', function(e) {
-        e.preventDefault();
-        $('.delete-comment .btn[type=submit]').addClass('disabled')
-        jsonPost($(this).attr('action'), { 'comment-index': $(this).find('input[name="comment-index"]').val() }, deleteComment);
+}
+
+
+// Adds a comment below those shown
+function appendComment(comment) {
+    $('#comments-content > .divider').last().remove(); // The closing divider is added again after the new comment
+    var commentHtml = '<div class="comment" id="comment-' + comment.id + '">';
+    commentHtml += '<div class="divider"></div>';
+    commentHtml += '<p>By ' + comment.username + ' at ' + comment.time + '</p>';
+    commentHtml += '<blockquote>';
+    comment.comment.split('\n').forEach(function(line) { // Splits content on new line and renders as seperate paragraphs.
+        commentHtml += '<p>' + line + '</p>';
     });
+    commentHtml += '</blockquote>';
+    // If there is the option to delete a comment add the delete button
+    if (comment.delete == true) {
+        commentHtml += '<form action="' + deleteCommentUrl + '" method="POST" class="delete-comment new-delete-comment">';
+        commentHtml += '<input type="hidden" name="comment-id" value="' + comment.id + '">';
+        commentHtml += '<div class="delete-wrapper">';
+        commentHtml += '<button class="btn waves-effect waves-light red small right" type="submit"><i class="material-icons left">delete</i>Delete Comment</button>';
+        commentHtml += '</div>';
+        commentHtml += '</form>';
+    }
+    commentHtml += '</div>';
+    $('#comments-content').append(commentHtml);
     $('#comments-content').append('<div class="divider"></div>');
+    // Attach event handler to the new delete button
+    $('.new-delete-comment').on('submit', submitDeleteComment).removeClass('new-delete-comment');
+}
+
+
+// Submits a delete comment form as json
+function submitDeleteComment(e) {
+    e.preventDefault();
+    $('.delete-comment .btn[type=submit]').addClass('disabled');
+    jsonPost($(this).attr('action'), { 'comment-id': $(this).find('input[name="comment-id"]').val() }, deleteComment);
 }
 
 
@@ -149,12 +157,8 @@ $(function() {
     });
     $('#add-comment').on('submit', function(e) {
         e.preventDefault();
-        jsonPost($(this).attr('action'), { comment: $('#comment').val() }, reloadComments);
+        jsonPost($(this).attr('action'), { comment: $('#comment').val() }, addComment);
         $('#comment').val('');
     });
-    $('.delete-comment').on('submit', function(e) {
-        e.preventDefault();
-        $('.delete-comment .btn[type=submit]').addClass('disabled')
-        jsonPost($(this).attr('action'), { 'comment-index': $(this).find('input[name="comment-index"]').val() }, deleteComment);
-    });
+    $('.delete-comment').on('submit', submitDeleteComment);
 });
\ No newline at end of file
@@ -24,6 +24,28 @@ function activateChips(chipContainer, tagString) {
 }
 
 
+// Fetches suggestions for the search text, and shows them if the text hasn't changed since
+var suggestions = {};
+function suggest(autocomplete, text) {
+    var xhr = new XMLHttpRequest();
+
+    xhr.open('GET', suggestUrl + '?q=' + encodeURIComponent(text), true);
+    xhr.onreadystatechange = function() {
+        if (this.readyState == 4 && this.status == 200 && $('#filter-search').val() == text) {
+            var data = {};
+            suggestions = {};
+            JSON.parse(this.responseText).suggestions.forEach(function(suggestion) {
+                suggestions[suggestion.text] = suggestion;
+                data[suggestion.text] = null;
+            });
+            autocomplete.updateData(data);
+            autocomplete.open();
+        }
+    };
+    xhr.send();
+}
+
+
 // Reset all chips to not active, submits the form to show updated results
 function resetChips(chipContainer) {
     $(chipContainer + ' .chip.active').removeClass('active');
@@ -57,6 +79,23 @@ $(function() {
         if (e.which == 13) $('#filters-form').trigger('submit');
     });
 
+    // Suggest recipes, ingredients and users as the search is typed, waiting for a pause in typing before fetching them
+    var autocomplete = M.Autocomplete.init($('#filter-search')[0], {
+        minLength: 2,
+        onAutocomplete: function(text) {
+            var suggestion = suggestions[text];
+            if (suggestion && suggestion.type == 'recipe') window.location = recipesUrl + '/' + suggestion.urn;
+            else if (suggestion && suggestion.type == 'user') window.location = usersUrl + '/' + suggestion.text;
+            else $('#filters-form').trigger('submit');
+        }
+    });
+    var suggestTimeout = null;
+    $('#filter-search').on('input', function() {
+        var text = $(this).val();
+        clearTimeout(suggestTimeout);
+        if (text.length >= 2) suggestTimeout = setTimeout(function() { suggest(autocomplete, text); }, 150);
+    });
+
     // On submit convert chips to strings and set the sort order depending on input.
     $('#filters-form').on('submit', function() {
         chipsToInput('#include-chips', '#tags')
@@ -1,12 +1,27 @@
 import os
 import unittest
 import app
+import images
+import projections
+import search
+import bitmaps
+import parallel
+import database
+import counters
+import feeds
+from pymongo import MongoClient, monitoring
+from pymongo.errors import BulkWriteError
+import tempfile
+import threading
+import warnings
 from flask import escape
 import base64
 import urllib.request
 import boto3
 from datetime import timedelta, datetime
 import json
+import re
+from types import SimpleNamespace
 
 s3 = boto3.client('s3')
 s3_bucket = os.getenv('AWS_BUCKET')
@@ -18,6 +33,18 @@ def flask_test_client():
     '''
     app.app.config['TESTING'] = True
     app.app.config['DEBUG'] = False
+    # Disable caching, as tests clear the database between tests
+    app.app.config['COUNT_CACHE_TIMEOUT'] = 0
+    app.app.config['HOME_CACHE_TIMEOUT'] = 0
+    app.app.config['PAGE_CACHE_TIMEOUT'] = 0
+    # Keep the search index in memory, and apply changes on every search
+    app.app.config['SEARCH_REFRESH_INTERVAL'] = 0
+    app.search_index = app.SearchIndex()
+    app.suggestions = app.Suggestions()
+    app.tag_bitmaps = app.TagBitmaps()
+    # Check the tags and meals versions on every render
+    app.app.config['VOCABULARY_REFRESH_INTERVAL'] = 0
+    app.vocabulary = app.Vocabulary()
     # Use the test database URI instead of the default
     app.mongo = app.PyMongo(app.app, uri=os.getenv('MONGO_TEST_URI'))
     client = app.app.test_client()
@@ -90,6 +117,8 @@ class TestUsers(TestClient):
         # Delete all records from the login and user collections
         self.mongo.db.logins.delete_many({})
         self.mongo.db.users.delete_many({})
+        self.mongo.db.follows.delete_many({})
+        self.mongo.db.feeds.delete_many({})
         self.logout_user()
 
     def test_new_user_page(self):
@@ -235,11 +264,15 @@ class TestPreferences(TestClient):
         # Delete all records from the login and user collections and create test user
         self.mongo.db.logins.delete_many({})
         self.mongo.db.users.delete_many({})
+        self.mongo.db.follows.delete_many({})
+        self.mongo.db.feeds.delete_many({})
         self.logout_user()
         self.create_user()
         self.login_user()
         # Delete all records from the recipe collection
         self.mongo.db.recipes.delete_many({})
+        self.mongo.db.slugs.delete_many({})
+        self.mongo.db.favourites.delete_many({})
 
     def test_preferences_not_logged_in(self):
         '''
@@ -399,11 +432,15 @@ class TestAddRecipe(TestClient):
         # Delete all records from the login and user collections and create test user
         self.mongo.db.logins.delete_many({})
         self.mongo.db.users.delete_many({})
+        self.mongo.db.follows.delete_many({})
+        self.mongo.db.feeds.delete_many({})
         self.logout_user()
         self.create_user()
         self.login_user()
         # Delete all records from the recipe collection
         self.mongo.db.recipes.delete_many({})
+        self.mongo.db.slugs.delete_many({})
+        self.mongo.db.favourites.delete_many({})
 
     def test_add_recipe_page(self):
         '''
@@ -455,7 +492,7 @@ class TestAddRecipe(TestClient):
         recipe_prep_time = '00:05'
         recipe_cook_time = '00:05'
         self.submit_recipe(recipe_title, recipe_ingredients, recipe_methods, prep_time=recipe_prep_time, cook_time=recipe_cook_time)
-        self.assertEqual(self.mongo.db.recipes.find_one({'title': recipe_title}).get('total-time'), '00:10')
+        self.assertEqual(self.mongo.db.recipes.find_one({'title': recipe_title}).get('total-time'), 10)
 
     def test_submit_recipe_has_tags_array(self):
         '''
@@ -506,8 +543,19 @@ class TestAddRecipe(TestClient):
                           'Cook until golden.']
         self.submit_recipe(recipe_title, recipe_ingredients, recipe_methods)
         self.assertNotEqual(self.mongo.db.recipes.find_one({'title': recipe_title}).get('date'), None)
-        self.assertRegex(self.mongo.db.recipes.find_one({'title': recipe_title}).get('date', ''),
-                         '[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}')
+        self.assertIsInstance(self.mongo.db.recipes.find_one({'title': recipe_title}).get('date'), datetime)
+
+    def test_submit_recipe_has_render_fields(self):
+        '''
+        Submitted recipes should store the lists and text shown on the recipe page
+        '''
+        self.submit_recipe('Pancakes', ['Flour', 'Eggs'], ['Mix.', 'Fry.'], prep_time='01:05', cook_time='00:01')
+        recipe = self.mongo.db.recipes.find_one({'title': 'Pancakes'})
+        self.assertEqual(recipe.get('ingredient-list'), ['Flour', 'Eggs'])
+        self.assertEqual(recipe.get('method-list'), ['Mix.', 'Fry.'])
+        self.assertEqual(recipe.get('prep-time-text'), '1 hour 5 minutes')
+        self.assertEqual(recipe.get('cook-time-text'), '1 minute')
+        self.assertRegex(recipe.get('date-text', ''), '[A-Z][a-z]{2} [0-9]{2} [A-Z][a-z]{2} \'[0-9]{2}')
 
     def test_submit_recipe_has_image_url(self):
         '''
@@ -516,8 +564,55 @@ class TestAddRecipe(TestClient):
         self.create_user()
         with open('tests/test-image.jpg', 'rb') as file:
             self.submit_recipe(image=base64.b64encode(file.read()))
+        app.image_jobs.wait()
         self.assertRegex(self.mongo.db.recipes.find_one({}).get('image'), '.+\.jpg$')
 
+    def test_submit_recipe_has_placeholder_until_image_processed(self):
+        '''
+        Recipes should have a placeholder image until their image has been processed
+        '''
+        self.create_user()
+        self.mongo.db.recipes.insert_one({'urn': 'pending-image', 'image': '/static/images/placeholder.jpg', 'image-job': 'job'})
+        with open('tests/test-image.jpg', 'rb') as file:
+            app.image_jobs.process('pending-image', 'job', file.read())
+        recipe = self.mongo.db.recipes.find_one({'urn': 'pending-image'})
+        self.assertRegex(recipe.get('image'), 'pending-image-job\.jpg$')
+        self.assertEqual(recipe.get('image-job'), None)
+
+    def test_submit_recipe_has_image_derivatives(self):
+        '''
+        Recipes with an image should have urls for smaller card and thumbnail versions
+        '''
+        self.create_user()
+        with open('tests/test-image.jpg', 'rb') as file:
+            self.submit_recipe(image=base64.b64encode(file.read()))
+        app.image_jobs.wait()
+        recipe_images = self.mongo.db.recipes.find_one({}).get('images')
+        self.assertRegex(recipe_images['card']['jpeg'], '-card\.jpg$')
+        self.assertRegex(recipe_images['thumb']['jpeg'], '-thumb\.jpg$')
+        if 'webp' in [image_format[0] for image_format in images.derivative_formats()]:
+            self.assertRegex(recipe_images['card']['webp'], '-card\.webp$')
+
+    def test_recipe_list_uses_image_derivatives(self):
+        '''
+        Recipe lists should offer the card and thumbnail images in a srcset
+        '''
+        self.create_user()
+        with open('tests/test-image.jpg', 'rb') as file:
+            self.submit_recipe(image=base64.b64encode(file.read()))
+        app.image_jobs.wait()
+        recipe_images = self.mongo.db.recipes.find_one({}).get('images')
+        response = self.client.get('/recipes')
+        self.assertIn('{} 300w, {} 600w'.format(recipe_images['thumb']['jpeg'], recipe_images['card']['jpeg']), response.data.decode())
+
+    def test_failed_image_job_removes_image(self):
+        '''
+        If an image can't be processed the recipe's placeholder image should be removed
+        '''
+        self.mongo.db.recipes.insert_one({'urn': 'broken-image', 'image': '/static/images/placeholder.jpg', 'image-job': 'job'})
+        app.image_jobs.process('broken-image', 'job', b'not an image')
+        self.assertEqual(self.mongo.db.recipes.find_one({'urn': 'broken-image'}).get('image'), None)
+
     def test_submit_recipe_has_no_image_url_if_file_not_correct_dimensions(self):
         '''
         If the uploaded file is not a of the correct dimensions, the image url should not be created
@@ -544,6 +639,7 @@ class TestAddRecipe(TestClient):
         with open('tests/test-image.jpg', 'rb') as file:
             image_data = file.read()
             self.submit_recipe(title='test image', image=base64.b64encode(image_data))
+        app.image_jobs.wait()
         url = self.mongo.db.recipes.find_one({}).get('image')
         if s3_bucket:
             response = urllib.request.urlopen(url)
@@ -613,6 +709,25 @@ class TestAddRecipe(TestClient):
         self.submit_recipe(recipe_title, recipe_ingredients, recipe_methods)
         self.assertEqual(self.mongo.db.recipes.count_documents({'urn': urn}), 1)
 
+    def test_submit_recipe_urns_are_numbered(self):
+        '''
+        Recipes with the same title should have the slug followed by a number
+        '''
+        self.submit_recipe('Pancakes')
+        self.submit_recipe('Pancakes')
+        self.submit_recipe('Pancakes')
+        urns = sorted(recipe['urn'] for recipe in self.mongo.db.recipes.find({}, {'urn': 1}))
+        self.assertEqual(urns, ['pancakes', 'pancakes1', 'pancakes2'])
+
+    def test_submit_recipe_urn_counter_allows_for_existing_recipes(self):
+        '''
+        The urn counter for a slug should start after any recipes created before it existed
+        '''
+        self.mongo.db.recipes.insert_one({'title': 'Pancakes', 'urn': 'pancakes'})
+        self.mongo.db.recipes.insert_one({'title': 'Pancakes', 'urn': 'pancakes3'})
+        self.submit_recipe('Pancakes')
+        self.assertNotEqual(self.mongo.db.recipes.find_one({'urn': 'pancakes4'}), None)
+
     def test_submit_recipe_fills_inputs_from_forked_recipe(self):
         '''
         Forking a recipe should return an add new recipe page with that recipe filled in
@@ -703,6 +818,7 @@ class TestAddRecipe(TestClient):
         with open('tests/test-image.jpg', 'rb') as file:
             image_data = file.read()
             self.submit_recipe(title='Parent recipe', image=base64.b64encode(image_data))
+        app.image_jobs.wait()
         parent_urn = self.mongo.db.recipes.find_one({}).get('urn')
         parent_image = self.mongo.db.recipes.find_one({}).get('image')
         self.submit_recipe(title='Child recipe', parent=parent_urn, old_image=parent_image)
@@ -757,6 +873,25 @@ class TestAddRecipe(TestClient):
         self.assertEqual(response.status_code, 302)
 
 
+class TestImageStorage(unittest.TestCase):
+    '''
+    Class for testing S3 image urls
+    '''
+    def test_s3_url_is_built_from_bucket_region_and_key(self):
+        '''
+        S3 image urls should be built from the bucket, region and key without signing
+        '''
+        storage = app.S3Storage(boto3.client('s3', region_name='eu-west-2'), 'forkit-images')
+        self.assertEqual(storage.url('pancakes-1234.jpg'), 'https://forkit-images.s3.eu-west-2.amazonaws.com/pancakes-1234.jpg')
+
+    def test_s3_url_for_bucket_with_dots(self):
+        '''
+        Buckets with dots in their name should use path style urls
+        '''
+        storage = app.S3Storage(boto3.client('s3', region_name='us-east-1'), 'images.fork.it')
+        self.assertEqual(storage.url('pancakes.jpg'), 'https://s3.amazonaws.com/images.fork.it/pancakes.jpg')
+
+
 class TestEditRecipe(TestClient):
     '''
     Class for testing the edit_recipe page
@@ -765,8 +900,12 @@ class TestEditRecipe(TestClient):
         # Delete all records from the login and user collections
         self.mongo.db.logins.delete_many({})
         self.mongo.db.users.delete_many({})
+        self.mongo.db.follows.delete_many({})
+        self.mongo.db.feeds.delete_many({})
         # Delete all records from the recipe collection
         self.mongo.db.recipes.delete_many({})
+        self.mongo.db.slugs.delete_many({})
+        self.mongo.db.favourites.delete_many({})
         self.logout_user()
 
     def test_page_not_user(self):
@@ -870,7 +1009,7 @@ class TestEditRecipe(TestClient):
         self.assertIn('Add cheese to sauce.', recipe_entry['methods'])
         self.assertEqual(recipe_entry['prep-time'], '00:10')
         self.assertEqual(recipe_entry['cook-time'], '00:55')
-        self.assertEqual(recipe_entry['total-time'], '01:05')
+        self.assertEqual(recipe_entry['total-time'], 65)
 
     def test_edit_recipe_delete_image(self):
         '''
@@ -880,6 +1019,7 @@ class TestEditRecipe(TestClient):
         self.login_user()
         with open('tests/test-image.jpg', 'rb') as file:
             self.submit_recipe(title='Test Image Replacement', image=base64.b64encode(file.read()))
+        app.image_jobs.wait()
         urn = self.mongo.db.recipes.find_one({}).get('urn')
         self.client.post('/edit-recipe/{}'.format(urn),
                          data={'title': 'Test Recipe',
@@ -906,6 +1046,7 @@ class TestEditRecipe(TestClient):
                                'methods': '\n'.join(['Boil macaroni in a pan.', 'Melt butter in a pan and whisk in flour before adding milk.',
                                                      'Add cheese to sauce.', 'Once mixture thickens add boiled macaroni.']),
                                'prep-time': '00:10', 'cook-time': '00:20', 'image': base64.b64encode(replacement_image_data)})
+        app.image_jobs.wait()
         url = self.mongo.db.recipes.find_one({}).get('image')
         if s3_bucket:
             response = urllib.request.urlopen(url)
@@ -915,13 +1056,34 @@ class TestEditRecipe(TestClient):
             self.assertEqual(replacement_image_data, response.data)
             response.close()
 
+    def test_edit_recipe_while_image_processing(self):
+        '''
+        Editing a recipe whose image is still being processed should keep its placeholder until the image replaces it
+        '''
+        self.create_user()
+        self.login_user()
+        self.submit_recipe()
+        urn = self.mongo.db.recipes.find_one({}).get('urn')
+        self.mongo.db.recipes.update_one({'urn': urn}, {'$set': {'image': '/static/images/placeholder.jpg', 'image-job': 'job'}})
+        self.client.post('/edit-recipe/{}'.format(urn),
+                         data={'title': 'Edited Recipe', 'ingredients': 'Flour', 'methods': 'Mix.', 'prep-time': '00:10',
+                               'cook-time': '00:20', 'old-image': '/static/images/placeholder.jpg'})
+        self.assertEqual(self.mongo.db.recipes.find_one({'urn': urn}).get('image-job'), 'job')
+        with open('tests/test-image.jpg', 'rb') as file:
+            app.image_jobs.process(urn, 'job', file.read())
+        self.assertRegex(self.mongo.db.recipes.find_one({'urn': urn}).get('image'), '{}-job\\.jpg$'.format(urn))
+
 
 class TestDeleteRecipe(TestClient):
     def setUp(self):
         self.mongo.db.logins.delete_many({})
         self.mongo.db.users.delete_many({})
+        self.mongo.db.follows.delete_many({})
+        self.mongo.db.feeds.delete_many({})
         # Delete all records from the recipe collection
         self.mongo.db.recipes.delete_many({})
+        self.mongo.db.slugs.delete_many({})
+        self.mongo.db.favourites.delete_many({})
         self.logout_user()
 
     def test_page_not_user(self):
@@ -1030,11 +1192,15 @@ class TestRecipes(TestClient):
         # Delete all records from the login and user collection and create test user
         self.mongo.db.logins.delete_many({})
         self.mongo.db.users.delete_many({})
+        self.mongo.db.follows.delete_many({})
+        self.mongo.db.feeds.delete_many({})
         self.logout_user()
         self.create_user()
         self.login_user()
         # Delete all records from the recipe collection
         self.mongo.db.recipes.delete_many({})
+        self.mongo.db.slugs.delete_many({})
+        self.mongo.db.favourites.delete_many({})
 
     def test_page(self):
         '''
@@ -1162,8 +1328,26 @@ class TestRecipes(TestClient):
         self.logout_user()
         urn = self.mongo.db.recipes.find_one({'title': recipe_title}).get('urn')
         self.client.get('/recipes/{}'.format(urn))
+        app.view_counter.flush()
         self.assertLess(0, self.mongo.db.recipes.find_one({'urn': urn}).get('views', 0))
 
+    def test_page_views_are_buffered(self):
+        '''
+        Views should be buffered and written to the recipe together when flushed.
+        '''
+        recipe_title = 'Test-recipe'
+        self.submit_recipe(title=recipe_title)
+        self.logout_user()
+        urn = self.mongo.db.recipes.find_one({'title': recipe_title}).get('urn')
+        app.view_counter.flush()
+        self.client.get('/recipes/{}'.format(urn))
+        self.client.get('/recipes/{}'.format(urn))
+        self.assertEqual(app.view_counter.pending(urn), 2)
+        self.assertEqual(0, self.mongo.db.recipes.find_one({'urn': urn}).get('views', 0))
+        app.view_counter.flush()
+        self.assertEqual(app.view_counter.pending(urn), 0)
+        self.assertEqual(2, self.mongo.db.recipes.find_one({'urn': urn}).get('views', 0))
+
     def test_page_view_by_author_does_not_increase_views(self):
         '''
         When a recipe page is viewed by the user that created it the number of views should not increase.
@@ -1173,8 +1357,348 @@ class TestRecipes(TestClient):
         self.submit_recipe(title=recipe_title)
         urn = self.mongo.db.recipes.find_one({'title': recipe_title}).get('urn')
         self.client.get('/recipes/{}'.format(urn))
+        app.view_counter.flush()
         self.assertEqual(0, self.mongo.db.recipes.find_one({'urn': urn}).get('views', 0))
 
+    def test_backfill_render_fields(self):
+        '''
+        The backfill-render-fields command should convert string dates and add rendered fields to existing recipes
+        '''
+        self.mongo.db.recipes.insert_one({'urn': 'old-pancakes', 'title': 'Old Pancakes', 'username': 'TestUser',
+                                          'date': '2019-04-01 12:00:00', 'ingredients': 'Flour\nEggs', 'methods': 'Mix.\nFry.',
+                                          'prep-time': '00:10', 'cook-time': '02:00'})
+        app.app.test_cli_runner().invoke(args=['backfill-render-fields'])
+        recipe = self.mongo.db.recipes.find_one({'urn': 'old-pancakes'})
+        self.assertEqual(recipe.get('date'), datetime(2019, 4, 1, 12))
+        self.assertEqual(recipe.get('ingredient-list'), ['Flour', 'Eggs'])
+        response = self.client.get('/recipes/old-pancakes')
+        self.assertIn(b'Mon 01 Apr', response.data)
+        self.assertIn(b'2 hours', response.data)
+
+    def test_migrate_datetimes(self):
+        '''
+        The migrate-datetimes command should convert string dates to datetimes and total times to minutes
+        '''
+        self.mongo.db.users.update_one({'username': 'TestUser'}, {'$set': {'joined': '2019-04-01 12:00:00'}})
+        self.mongo.db.recipes.insert_one({'urn': 'old-pancakes', 'title': 'Old Pancakes', 'username': 'TestUser',
+                                          'featured': '2019-04-02 12:00:00', 'total-time': '01:05'})
+        self.mongo.db.comments.insert_one({'urn': 'old-pancakes', 'username': 'TestUser', 'time': '2019-04-03 12:00:00',
+                                           'comment': 'Yum!'})
+        app.app.test_cli_runner().invoke(args=['migrate-datetimes'])
+        self.assertEqual(self.mongo.db.users.find_one({'username': 'TestUser'}).get('joined'), datetime(2019, 4, 1, 12))
+        recipe = self.mongo.db.recipes.find_one({'urn': 'old-pancakes'})
+        self.assertEqual(recipe.get('featured'), datetime(2019, 4, 2, 12))
+        self.assertEqual(recipe.get('total-time'), 65)
+        self.assertEqual(self.mongo.db.comments.find_one({'urn': 'old-pancakes'}).get('time'), datetime(2019, 4, 3, 12))
+        self.mongo.db.comments.delete_many({})
+
+    def test_pages_only_use_projected_fields(self):
+        '''
+        Recipe, edit, fork, delete and list pages should only read recipe fields that are in their projections
+        '''
+        self.submit_recipe(title='Pancakes', tags=['Vegan'])
+        urn = self.mongo.db.recipes.find_one({'title': 'Pancakes'}).get('urn')
+        app.app.config['PROJECTION_WARNINGS'] = True
+        try:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always', projections.ProjectionWarning)
+                self.client.get('/recipes/{}'.format(urn))
+                self.client.get('/edit-recipe/{}'.format(urn))
+                self.client.get('/delete-recipe/{}'.format(urn))
+                self.client.get('/add-recipe?fork={}'.format(urn))
+                self.client.get('/recipes')
+        finally:
+            app.app.config['PROJECTION_WARNINGS'] = False
+        self.assertEqual([str(warning.message) for warning in caught if warning.category is projections.ProjectionWarning], [])
+
+
+class TestProjections(unittest.TestCase):
+    '''
+    Class for testing the projection registry
+    '''
+    def test_projection_includes_extra_fields(self):
+        '''
+        Projections should include a view's fields and any extra fields
+        '''
+        self.assertEqual(projections.projection('card', 'views').get('views'), 1)
+        self.assertNotIn('ingredients', projections.projection('card'))
+
+    def test_reading_unprojected_field_warns(self):
+        '''
+        Reading a missing field outside a document's projection should warn
+        '''
+        recipe = projections.ProjectedDocument({'title': 'Pancakes'}, 'card')
+        with self.assertWarns(projections.ProjectionWarning):
+            recipe.get('ingredients')
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', projections.ProjectionWarning)
+            self.assertIsNone(recipe.get('image'))  # Fields in the projection can be missing from the document
+
+
+class TestSearchIndex(unittest.TestCase):
+    '''
+    Class for testing the search index
+    '''
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.index = search.SearchIndex(os.path.join(self.directory.name, 'search.seg'))
+        self.index.build([{'urn': 'apple-pie', 'title': 'Apple Pie', 'ingredients': 'Apples\nFlour', 'methods': 'Bake'},
+                          {'urn': 'pancakes', 'title': 'Pancakes', 'ingredients': 'Flour\nEggs\nMilk', 'methods': 'Whisk everything together\nFry in butter'}])
+
+    def tearDown(self):
+        self.index.segment.close()
+        self.directory.cleanup()
+
+    def test_plurals_match(self):
+        '''
+        Singular and plural words should match each other
+        '''
+        self.assertEqual(self.index.search('apple'), ['apple-pie'])
+        self.assertEqual(self.index.search('pancake'), ['pancakes'])
+
+    def test_every_word_must_match(self):
+        '''
+        Recipes should only match if they contain every word, ranked by how well they match
+        '''
+        self.assertEqual(self.index.search('flour eggs'), ['pancakes'])
+        self.assertEqual(self.index.search('flour apples pancakes'), [])
+        self.assertEqual(self.index.search('flour')[0], 'apple-pie')  # The shorter recipe ranks first
+
+    def test_changes_saved(self):
+        '''
+        Recipes added and removed since the index was built should be saved to the segment and loaded by other indexes
+        '''
+        self.index.add({'urn': 'apple-crumble', 'title': 'Apple Crumble', 'ingredients': 'Apples\nOats', 'methods': 'Bake'})
+        self.index.remove('apple-pie')
+        self.assertEqual(self.index.search('apple'), ['apple-crumble'])
+        self.index.save()
+        loaded = search.SearchIndex(self.index.path)
+        self.assertTrue(loaded.load())
+        self.assertEqual(loaded.search('apple'), ['apple-crumble'])
+        self.assertEqual(loaded.search('flour'), ['pancakes'])
+        loaded.segment.close()
+
+    def test_unreadable_segment(self):
+        '''
+        A segment that can't be read should be treated as missing, so the index is rebuilt, and saving shouldn't leave temporary files
+        '''
+        self.assertEqual(os.listdir(self.directory.name), ['search.seg'])
+        with open(self.index.path, 'wb') as segment_file:
+            segment_file.write(b'\x10\x00\x00\x00{"urns": [')
+        with self.assertLogs('search', 'WARNING'):
+            self.assertFalse(search.SearchIndex(self.index.path).load())
+
+
+class TestViewCounter(unittest.TestCase):
+    '''
+    Class for testing how buffered views are retried
+    '''
+    def test_only_failed_views_retried(self):
+        '''
+        When some updates in a flush fail, only their views should be kept, as the others have already been written
+        '''
+        class FailingCollection:
+            def bulk_write(self, requests, ordered=True):
+                raise BulkWriteError({'writeErrors': [{'index': 1, 'code': 1, 'errmsg': 'Failed'}]})
+
+        counter = counters.ViewCounter(lambda: FailingCollection(), flush_size=100, flush_interval=60)
+        counter.add('apple-pie', 2)
+        counter.add('pancakes', 3)
+        with self.assertLogs('counters', 'ERROR'):
+            counter.flush()
+        self.assertEqual(counter.pending('apple-pie'), 0)
+        self.assertEqual(counter.pending('pancakes'), 3)
+
+
+class TestQueryExecutor(unittest.TestCase):
+    '''
+    Class for testing the concurrent query executor
+    '''
+    def test_queries_run_concurrently(self):
+        '''
+        Queries in a group should run at the same time, and each should be timed
+        '''
+        executor = parallel.QueryExecutor(workers=2)
+        barrier = threading.Barrier(2, timeout=5)  # Only passes if both queries are running at once
+
+        def query(value):
+            barrier.wait()
+            return value
+
+        group = executor.group()
+        group.submit('first', query, 1)
+        group.submit('second', query, 2)
+        self.assertEqual(group.results(), {'first': 1, 'second': 2})
+        self.assertEqual(set(group.timings), {'first', 'second'})
+        self.assertIn(group.critical_path(), ('first', 'second'))
+        executor.shutdown()
+
+    def test_no_workers(self):
+        '''
+        Without workers queries should run one after another, and a failed query should raise its exception
+        '''
+        group = parallel.QueryExecutor(workers=0).group()
+        group.submit('sum', sum, [1, 2])
+        group.submit('fails', int, 'one')
+        with self.assertRaises(ValueError):
+            group.results()
+        self.assertEqual(group.futures['sum'].result(), 3)
+
+    def test_run_queries_without_request(self):
+        '''
+        Queries should run without the request, and see the session values read before they were submitted
+        '''
+        with app.app.test_request_context('/'):
+            app.session['username'] = 'TestUser'
+            app.session['preferences'] = 'vegetarian'
+            results = app.run_queries(query=lambda: (app.has_request_context(), app.viewer()))
+        self.assertEqual(results['query'], (False, {'username': 'TestUser', 'preferences': 'vegetarian', 'exclusions': None}))
+
+
+class TestDatabaseMetrics(unittest.TestCase):
+    '''
+    Class for testing MongoDB client options and metrics
+    '''
+    def test_client_options(self):
+        '''
+        Only options that are set should be passed to the client, with the metrics listeners
+        '''
+        metrics = database.Metrics()
+        options = database.client_options({'MONGO_MAX_POOL_SIZE': 10, 'MONGO_READ_PREFERENCE': None}, metrics)
+        self.assertEqual(options['maxPoolSize'], 10)
+        self.assertNotIn('readPreference', options)
+        self.assertIsInstance(options['event_listeners'][0], database.CommandMetrics)
+
+    def test_command_metrics(self):
+        '''
+        Commands should be recorded by name and route, and slow commands counted
+        '''
+        metrics = database.Metrics(route=lambda: 'recipes', slow_ms=100)
+        listener = database.CommandMetrics(metrics)
+        with self.assertLogs('database', 'WARNING'):
+            listener.succeeded(SimpleNamespace(command_name='find', duration_micros=2000))
+            listener.failed(SimpleNamespace(command_name='find', duration_micros=300000))
+        text = metrics.render()
+        self.assertIn('mongo_command_duration_seconds_bucket{command="find",le="0.0025"} 1', text)
+        self.assertIn('mongo_command_duration_seconds_count{command="find"} 2', text)
+        self.assertIn('mongo_command_failures_total{command="find"} 1', text)
+        self.assertIn('mongo_slow_commands_total{command="find"} 1', text)
+        self.assertIn('mongo_route_commands_total{route="recipes"} 2', text)
+
+    def test_pool_metrics(self):
+        '''
+        Checkouts should record their wait, failures should be counted by reason, and checked in connections should leave the gauge
+        '''
+        metrics = database.Metrics()
+        listener = database.PoolMetrics(metrics)
+        event = SimpleNamespace(address=('localhost', 27017), connection_id=1)
+        for _ in range(2):
+            listener.connection_check_out_started(event)
+            listener.connection_checked_out(event)
+        listener.connection_check_out_started(event)
+        listener.connection_check_out_failed(SimpleNamespace(address=('localhost', 27017), reason='timeout'))
+        listener.connection_checked_in(event)
+        text = metrics.render()
+        self.assertIn('mongo_pool_wait_seconds_count 2', text)
+        self.assertIn('mongo_pool_checkouts_total 2', text)
+        self.assertIn('mongo_pool_checkout_failures_total{reason="timeout"} 1', text)
+        self.assertIn('mongo_pool_checked_out 1', text)
+        self.assertIsInstance(database.client_options({}, metrics)['event_listeners'][1], database.PoolMetrics)
+
+    def test_metrics_store(self):
+        '''
+        Metrics saved by every process should be added up, keeping the counts of processes that have exited but not their checkouts
+        '''
+        with tempfile.TemporaryDirectory() as directory:
+            store = database.MetricsStore(directory)
+            exited = database.Metrics()
+            exited.command('find', 0.002)
+            exited.checkout(0.001)
+            store._write(store.path('999999999'), exited.state())  # Larger than any pid, so the process has exited
+            metrics = database.Metrics(route=lambda: 'recipes')
+            metrics.command('find', 0.002)
+            metrics.checkout(0.001)
+            for _ in range(2):  # Exited processes should only be counted once, after their file is folded into the others
+                text = store.combined(metrics).render()
+                self.assertIn('mongo_command_duration_seconds_count{command="find"} 2', text)
+                self.assertIn('mongo_pool_checkouts_total 2', text)
+                self.assertIn('mongo_pool_checked_out 1', text)
+                self.assertIn('mongo_route_commands_total{route="recipes"} 1', text)
+            self.assertNotIn('999999999.json', os.listdir(directory))
+
+
+class TestSuggestions(unittest.TestCase):
+    '''
+    Class for testing search suggestions
+    '''
+    def setUp(self):
+        self.suggestions = search.Suggestions()
+        self.suggestions.build([{'urn': 'apple-pie', 'title': 'Apple Pie', 'ingredients': 'Apples\nFlour', 'username': 'Alice', 'views': 3},
+                                {'urn': 'apple-crumble', 'title': 'Apple Crumble', 'ingredients': 'Apples\nOats', 'username': 'Alice', 'views': 5}])
+
+    def test_most_popular_first(self):
+        '''
+        Suggestions should be ordered by popularity, and titles should match from any word
+        '''
+        self.assertEqual([suggestion['text'] for suggestion in self.suggestions.suggest('apple')], ['Apple Crumble', 'Apple Pie', 'apples'])
+        self.assertEqual(self.suggestions.suggest('crum')[0]['urn'], 'apple-crumble')
+
+    def test_changes(self):
+        '''
+        Edited recipes should keep their views and author, and removed recipes and unused ingredients should no longer be suggested
+        '''
+        self.suggestions.add({'urn': 'apple-pie', 'title': 'Pear Pie', 'ingredients': 'Pears'})
+        self.assertEqual([suggestion['text'] for suggestion in self.suggestions.suggest('p')], ['Pear Pie', 'pears'])
+        self.assertEqual(self.suggestions.suggest('alice'), [{'type': 'user', 'text': 'Alice'}])
+        self.suggestions.remove('apple-crumble')
+        self.assertEqual(self.suggestions.suggest('a'), [{'type': 'user', 'text': 'Alice'}])
+
+
+class TestTagBitmaps(unittest.TestCase):
+    '''
+    Class for testing the tag and meal bitmaps
+    '''
+    def setUp(self):
+        self.bitmaps = bitmaps.TagBitmaps()
+        self.bitmaps.build([{'urn': 'salad', 'tags': ['Vegan', 'Vegetarian'], 'meals': ['Lunch']},
+                            {'urn': 'omelette', 'tags': ['Vegetarian'], 'meals': ['Breakfast', 'Lunch']},
+                            {'urn': 'bacon', 'meals': ['Breakfast']}])
+
+    def test_match(self):
+        '''
+        Recipes should match if they have every tag and meal and none of the excluded tags
+        '''
+        self.assertEqual(self.bitmaps.urns_of(self.bitmaps.match(tags=['Vegetarian'])), ['salad', 'omelette'])
+        self.assertEqual(self.bitmaps.urns_of(self.bitmaps.match(exclude=['Vegan'], meals=['Lunch'])), ['omelette'])
+        self.assertEqual(self.bitmaps.count(self.bitmaps.match(exclude=['Vegan', 'Vegetarian'])), 1)
+        self.assertEqual(self.bitmaps.match(tags=['Nuts']), 0)
+
+    def test_refresh_skipped_while_refreshing(self):
+        '''
+        Threads shouldn't wait for another thread that is already updating a loaded index
+        '''
+        self.bitmaps.last_change = 0
+        with self.bitmaps.refresh_lock:  # Another thread is updating the bitmaps, so the database shouldn't be queried
+            app.refresh_index(self.bitmaps, timedelta(days=1))
+        self.assertEqual(self.bitmaps.refreshed, 0)
+
+    def test_keep_matching(self):
+        '''
+        Lists of urns should be narrowed to those in a bitmap, in their order
+        '''
+        vegetarian = self.bitmaps.match(tags=['Vegetarian'])
+        self.assertEqual(self.bitmaps.keep_matching(vegetarian, ['omelette', 'bacon', 'missing', 'salad']), ['omelette', 'salad'])
+
+    def test_changes(self):
+        '''
+        Edited recipes should keep tags they weren't given, and removed recipes should no longer match
+        '''
+        self.bitmaps.add({'urn': 'bacon', 'meals': ['Breakfast', 'Lunch']})
+        self.bitmaps.add({'urn': 'omelette', 'tags': ['Vegetarian', 'Gluten-free']})
+        self.assertEqual(self.bitmaps.urns_of(self.bitmaps.match(meals=['Lunch'])), ['salad', 'omelette', 'bacon'])
+        self.bitmaps.remove('salad')
+        self.assertEqual(self.bitmaps.urns_of(self.bitmaps.match(tags=['Vegetarian'])), ['omelette'])
+
 
 class TestFavourite(TestClient):
     '''
@@ -1184,8 +1708,12 @@ class TestFavourite(TestClient):
         # Delete all records from the login and user collection and create test user
         self.mongo.db.logins.delete_many({})
         self.mongo.db.users.delete_many({})
+        self.mongo.db.follows.delete_many({})
+        self.mongo.db.feeds.delete_many({})
         # Delete all records from the recipe collection
         self.mongo.db.recipes.delete_many({})
+        self.mongo.db.slugs.delete_many({})
+        self.mongo.db.favourites.delete_many({})
         self.logout_user()
         self.create_user()
         self.login_user()
@@ -1235,13 +1763,13 @@ class TestFavourite(TestClient):
 
     def test_user_adds_recipe_to_favourites(self):
         '''
-        Favouriting users are added to the recipes list of favouriting users
+        Favouriting a recipe adds it to the user's favourites
         '''
         username = 'FavouritingUser'
         self.create_user(username)
         self.login_user(username)
         self.client.get('/recipes/{}/favourite'.format(self.urn))
-        self.assertEqual(self.mongo.db.recipes.find_one({'urn': self.urn}).get('favouriting-users'), ['FavouritingUser'])
+        self.assertEqual(self.mongo.db.favourites.count_documents({'username': 'FavouritingUser', 'urn': self.urn}), 1)
 
     def test_user_already_favourited_decreases_favourites(self):
         '''
@@ -1255,14 +1783,14 @@ class TestFavourite(TestClient):
 
     def test_user_already_favourited_removes_recipe_from_favourites(self):
         '''
-        If a user has already favourited a recipe remove their username from its list of favouriting users
+        If a user has already favourited a recipe remove it from their favourites
         '''
         username = 'FavouritingUser'
         self.create_user(username)
         self.login_user(username)
         self.client.get('/recipes/{}/favourite'.format(self.urn))
         self.client.get('/recipes/{}/favourite'.format(self.urn))
-        self.assertEqual(self.mongo.db.recipes.find_one({'urn': self.urn}).get('favouriting-users'), [])
+        self.assertEqual(self.mongo.db.favourites.count_documents({'urn': self.urn}), 0)
 
     def test_json_request_returns_200(self):
         '''
@@ -1301,8 +1829,12 @@ class TestFeature(TestClient):
         # Delete all records from the login and user collection and create test user
         self.mongo.db.logins.delete_many({})
         self.mongo.db.users.delete_many({})
+        self.mongo.db.follows.delete_many({})
+        self.mongo.db.feeds.delete_many({})
         # Delete all records from the recipe collection
         self.mongo.db.recipes.delete_many({})
+        self.mongo.db.slugs.delete_many({})
+        self.mongo.db.favourites.delete_many({})
         self.logout_user()
         self.create_user()
         self.login_user()
@@ -1337,8 +1869,7 @@ class TestFeature(TestClient):
         '''
         self.login_user('Admin')
         self.client.get('/recipes/{}/feature'.format(self.urn))
-        self.assertRegex(self.mongo.db.recipes.find_one({'urn': self.urn}).get('featured', ''),
-                         '[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}')
+        self.assertIsInstance(self.mongo.db.recipes.find_one({'urn': self.urn}).get('featured'), datetime)
 
     def test_removes_featured_from_featured_recipe(self):
         '''
@@ -1383,8 +1914,13 @@ class TestComments(TestClient):
         # Delete all records from the login and user collection and create test user
         self.mongo.db.logins.delete_many({})
         self.mongo.db.users.delete_many({})
+        self.mongo.db.follows.delete_many({})
+        self.mongo.db.feeds.delete_many({})
         # Delete all records from the recipe collection
         self.mongo.db.recipes.delete_many({})
+        self.mongo.db.slugs.delete_many({})
+        self.mongo.db.favourites.delete_many({})
+        self.mongo.db.comments.delete_many({})
         self.logout_user()
         self.create_user()
         self.login_user()
@@ -1399,6 +1935,15 @@ class TestComments(TestClient):
         response = self.client.get('/recipes/{}/comments'.format(self.urn))
         self.assertEqual(response.status_code, 200)
 
+    def test_recipe_comments_string_time(self):
+        '''
+        Comments with times stored as strings from before the migrate-datetimes command should still be shown.
+        '''
+        self.mongo.db.comments.insert_one({'urn': self.urn, 'username': 'TestUser', 'time': '2019-04-03 12:00:00', 'comment': 'Old comment'})
+        response = self.client.get('/recipes/{}/comments'.format(self.urn))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Old comment', response.data)
+
     def test_recipe_comments_page_doesnt_exist(self):
         '''
         The comments page should return 404 status if the recipe doesn't exist.
@@ -1420,7 +1965,7 @@ class TestComments(TestClient):
         self.create_user('Commenter')
         self.login_user('Commenter')
         self.client.post('/recipes/{}/comments'.format(self.urn), data={'comment': 'Great recipe!'})
-        self.assertEqual(len(self.mongo.db.recipes.find_one({'urn': self.urn}).get('comments')), 1)
+        self.assertEqual(self.mongo.db.comments.count_documents({'urn': self.urn}), 1)
 
     def test_posted_comment_contains_data(self):
         '''
@@ -1434,7 +1979,7 @@ class TestComments(TestClient):
         self.client.post('/recipes/{}/comments'.format(self.urn), data=json.dumps({'comment': ''}), content_type='application/json')
         self.client.post('/recipes/{}/comments'.format(self.urn), data=json.dumps({'comment': None}), content_type='application/json')
         self.client.post('/recipes/{}/comments'.format(self.urn), content_type='application/json')
-        self.assertEqual(len(self.mongo.db.recipes.find_one({'urn': self.urn}).get('comments', [])), 0)
+        self.assertEqual(self.mongo.db.comments.count_documents({'urn': self.urn}), 0)
 
     def test_comments_contain_username_time_comment(self):
         '''
@@ -1443,10 +1988,10 @@ class TestComments(TestClient):
         self.create_user('Commenter')
         self.login_user('Commenter')
         self.client.post('/recipes/{}/comments'.format(self.urn), data={'comment': 'Great recipe!'})
-        comment_doc = self.mongo.db.recipes.find_one({'urn': self.urn}).get('comments')[0]
+        comment_doc = self.mongo.db.comments.find_one({'urn': self.urn})
         self.assertEqual(comment_doc.get('username'), 'Commenter')
         self.assertEqual(comment_doc.get('comment'), 'Great recipe!')
-        self.assertRegex(comment_doc.get('time', ''), '[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}')
+        self.assertIsInstance(comment_doc.get('time'), datetime)
 
     def test_posted_comments_increase_comment_count(self):
         '''
@@ -1511,6 +2056,23 @@ class TestComments(TestClient):
         response = self.client.post('/recipes/{}/comments'.format(self.urn), data=json.dumps({'comment': 'Great recipe!'}), content_type='application/json')
         self.assertEqual(json.loads(response.get_data(as_text=True)).get('success'), True)
 
+    def test_json_response_to_post_comment_has_new_comment(self):
+        '''
+        Json response to posting a comment should hold just the new comment to add to those shown, and the new count
+        '''
+        self.mongo.db.comments.insert_many([{'urn': self.urn, 'username': 'Commenter', 'comment': 'Comment {}'.format(i),
+                                             'time': datetime(2019, 1, 1, 0, 0, i)} for i in range(25)])
+        self.mongo.db.recipes.update_one({'urn': self.urn}, {'$set': {'comment-count': 25}})
+        self.create_user('Commenter')
+        self.login_user('Commenter')
+        response = self.client.post('/recipes/{}/comments'.format(self.urn), data=json.dumps({'comment': '<b>New</b>'}), content_type='application/json')
+        data = json.loads(response.get_data(as_text=True))
+        comment_id = str(self.mongo.db.comments.find_one({'comment': '<b>New</b>'})['_id'])
+        self.assertEqual(data.get('comment'), {'id': comment_id, 'username': 'Commenter', 'time': data['comment']['time'],
+                                               'comment': '&lt;b&gt;New&lt;/b&gt;', 'delete': True})
+        self.assertEqual(data.get('count'), 26)
+        self.assertIsNone(data.get('comments'))
+
     def test_json_response_to_post_comment_failiure(self):
         '''
         Json response to failing to post a comment should include success: False
@@ -1520,6 +2082,46 @@ class TestComments(TestClient):
         response = self.client.post('/recipes/{}/comments'.format(self.urn), data=json.dumps({'comment': ''}), content_type='application/json')
         self.assertEqual(json.loads(response.get_data(as_text=True)).get('success'), False)
 
+    def test_comments_paginated(self):
+        '''
+        Comments should be returned 20 at a time, with a cursor to fetch the next page
+        '''
+        self.mongo.db.comments.insert_many([{'urn': self.urn, 'username': 'Commenter', 'comment': 'Comment {}'.format(i),
+                                             'time': datetime(2019, 1, 1, 0, 0, i)} for i in range(25)])
+        response = self.client.get('/recipes/{}/comments'.format(self.urn), content_type='application/json')
+        first_page = json.loads(response.get_data(as_text=True))
+        self.assertEqual(len(first_page.get('comments')), 20)
+        self.assertIsNotNone(first_page.get('next'))
+        response = self.client.get('/recipes/{}/comments?after={}'.format(self.urn, first_page['next']), content_type='application/json')
+        second_page = json.loads(response.get_data(as_text=True))
+        self.assertEqual([comment['comment'] for comment in second_page.get('comments')], ['Comment {}'.format(i) for i in range(20, 25)])
+        self.assertIsNone(second_page.get('next'))
+
+    def test_json_comments_have_ids(self):
+        '''
+        Json response should give each comment a stable id to delete it by
+        '''
+        self.create_user('Commenter')
+        self.login_user('Commenter')
+        self.client.post('/recipes/{}/comments'.format(self.urn), data={'comment': 'Great recipe!'})
+        response = self.client.get('/recipes/{}/comments'.format(self.urn), content_type='application/json')
+        comment_id = str(self.mongo.db.comments.find_one({'urn': self.urn})['_id'])
+        self.assertEqual(json.loads(response.get_data(as_text=True)).get('comments')[0].get('id'), comment_id)
+
+    def test_migrate_embedded_comments(self):
+        '''
+        The migrate-comments command should move embedded comments into the comments collection, skipping deleted ones
+        '''
+        self.mongo.db.recipes.update_one({'urn': self.urn}, {'$set': {'comment-count': 2, 'comments': [
+            {'username': 'Commenter', 'time': '2019-01-01 00:00:00', 'comment': 'First!'},
+            {'deleted': True},
+            {'username': 'Commenter', 'time': '2019-01-01 00:00:01', 'comment': 'Second!'}]}})
+        app.app.test_cli_runner().invoke(args=['migrate-comments'])
+        app.app.test_cli_runner().invoke(args=['migrate-comments'])
+        self.assertEqual([comment['comment'] for comment in self.mongo.db.comments.find({'urn': self.urn}).sort('time', 1)],
+                         ['First!', 'Second!'])
+        self.assertIsNone(self.mongo.db.recipes.find_one({'urn': self.urn}).get('comments'))
+
 
 class TestDeleteComment(TestClient):
     '''
@@ -1529,8 +2131,13 @@ class TestDeleteComment(TestClient):
         # Delete all records from the login and user collection and create test user
         self.mongo.db.logins.delete_many({})
         self.mongo.db.users.delete_many({})
+        self.mongo.db.follows.delete_many({})
+        self.mongo.db.feeds.delete_many({})
         # Delete all records from the recipe collection
         self.mongo.db.recipes.delete_many({})
+        self.mongo.db.slugs.delete_many({})
+        self.mongo.db.favourites.delete_many({})
+        self.mongo.db.comments.delete_many({})
         self.logout_user()
         self.create_user()
         self.login_user()
@@ -1543,6 +2150,7 @@ class TestDeleteComment(TestClient):
         self.client.post('/recipes/{}/comments'.format(self.urn), data=json.dumps({'comment': 'Comment 2!'}), content_type='application/json')
         self.client.post('/recipes/{}/comments'.format(self.urn), data=json.dumps({'comment': 'Comment 3!'}), content_type='application/json')
         self.logout_user()
+        self.comment_id = str(self.mongo.db.comments.find_one({'comment': 'Comment 2!'})['_id'])
 
     def test_get_forbidden(self):
         '''
@@ -1555,7 +2163,7 @@ class TestDeleteComment(TestClient):
         '''
         Delete comment should be forbidden to users who arent logged in
         '''
-        response = self.client.post('/recipes/{}/delete-comment'.format(self.urn), data={'comment-index': '1'})
+        response = self.client.post('/recipes/{}/delete-comment'.format(self.urn), data={'comment-id': self.comment_id})
         self.assertEqual(response.status_code, 403)
 
     def test_delete_comment_not_admin_or_user(self):
@@ -1564,7 +2172,7 @@ class TestDeleteComment(TestClient):
         '''
         self.create_user('OtherUser')
         self.login_user('OtherUser')
-        response = self.client.post('/recipes/{}/delete-comment'.format(self.urn), data={'comment-index': '1'})
+        response = self.client.post('/recipes/{}/delete-comment'.format(self.urn), data={'comment-id': self.comment_id})
         self.assertEqual(response.status_code, 403)
 
     def test_admin_deletes_comment(self):
@@ -1573,10 +2181,8 @@ class TestDeleteComment(TestClient):
         '''
         self.create_user('Admin')
         self.login_user('Admin')
-        self.client.post('/recipes/{}/delete-comment'.format(self.urn), data={'comment-index': '1'})
-        comments = self.mongo.db.recipes.find_one({'urn': self.urn}, {'comments': 1}).get('comments', [])
-        for comment in comments:
-            self.assertNotEqual(comment.get('comment'), 'Comment 2!')
+        self.client.post('/recipes/{}/delete-comment'.format(self.urn), data={'comment-id': self.comment_id})
+        self.assertIsNone(self.mongo.db.comments.find_one({'comment': 'Comment 2!'}))
 
     def test_delete_comment_reduces_count(self):
         '''
@@ -1584,7 +2190,7 @@ class TestDeleteComment(TestClient):
         '''
         self.create_user('Admin')
         self.login_user('Admin')
-        self.client.post('/recipes/{}/delete-comment'.format(self.urn), data={'comment-index': '1'})
+        self.client.post('/recipes/{}/delete-comment'.format(self.urn), data={'comment-id': self.comment_id})
         self.assertEqual(self.mongo.db.recipes.find_one({'urn': self.urn}, {'comment-count': 1}).get('comment-count'), 2)
 
     def test_author_deletes_comment(self):
@@ -1592,25 +2198,23 @@ class TestDeleteComment(TestClient):
         Comment authors should be able to delete their comments
         '''
         self.login_user('Commenter')
-        self.client.post('/recipes/{}/delete-comment'.format(self.urn), data={'comment-index': '1'})
-        comments = self.mongo.db.recipes.find_one({'urn': self.urn}, {'comments': 1}).get('comments', [])
-        for comment in comments:
-            self.assertNotEqual(comment.get('comment'), 'Comment 2!')
+        self.client.post('/recipes/{}/delete-comment'.format(self.urn), data={'comment-id': self.comment_id})
+        self.assertIsNone(self.mongo.db.comments.find_one({'comment': 'Comment 2!'}))
 
     def test_delete_comment_doesnt_exist(self):
         '''
         Attempting to delete a comment that does not exist should return forbidden
         '''
         self.login_user('Commenter')
-        response = self.client.post('/recipes/{}/delete-comment'.format(self.urn), data={'comment-index': '5'})
+        response = self.client.post('/recipes/{}/delete-comment'.format(self.urn), data={'comment-id': '0' * 24})
         self.assertEqual(response.status_code, 403)
 
     def test_delete_comment_nan(self):
         '''
-        Attempting to delete a comment with an invalid index should return forbidden
+        Attempting to delete a comment with an invalid id should return forbidden
         '''
         self.login_user('Commenter')
-        response = self.client.post('/recipes/{}/delete-comment'.format(self.urn), data={'comment-index': 'notanumber'})
+        response = self.client.post('/recipes/{}/delete-comment'.format(self.urn), data={'comment-id': 'notanid'})
         self.assertEqual(response.status_code, 403)
 
     def test_json_successful_delete(self):
@@ -1618,9 +2222,11 @@ class TestDeleteComment(TestClient):
         Json response to deleteing a comment should include success: True
         '''
         self.login_user('Commenter')
-        response = self.client.post('/recipes/{}/delete-comment'.format(self.urn), data=json.dumps({'comment-index': '1'}),
+        response = self.client.post('/recipes/{}/delete-comment'.format(self.urn), data=json.dumps({'comment-id': self.comment_id}),
                                     content_type='application/json')
         self.assertEqual(json.loads(response.get_data(as_text=True)).get('success'), True)
+        self.assertEqual(json.loads(response.get_data(as_text=True)).get('id'), self.comment_id)
+        self.assertEqual(json.loads(response.get_data(as_text=True)).get('count'), 2)
 
 
 class TestAdmin(TestClient):
@@ -1631,9 +2237,12 @@ class TestAdmin(TestClient):
         # Delete all records from the login and user collection
         self.mongo.db.logins.delete_many({})
         self.mongo.db.users.delete_many({})
+        self.mongo.db.follows.delete_many({})
+        self.mongo.db.feeds.delete_many({})
         # Delete all records from the tags and meals collections
         self.mongo.db.tags.delete_many({})
         self.mongo.db.meals.delete_many({})
+        app.vocabulary.clear()
         self.logout_user()
         self.create_user('Admin')
         self.logout_user()
@@ -1709,6 +2318,82 @@ class TestAdmin(TestClient):
         self.client.post('/admin', data={'add-meal': ''})
         self.assertEqual(self.mongo.db.meals.find_one({}), None)
 
+    def test_vocabulary_cached(self):
+        '''
+        Tags and meals should be kept in memory until their version changes, and the admin page should reload them after changing them
+        '''
+        self.login_user('Admin')
+        self.client.post('/admin', data={'add-tag': 'Vegan'})
+        self.mongo.db.tags.insert_one({'name': 'Spicy'})  # Without bumping the version, as the admin page does
+        response = self.client.get('/admin').get_data(as_text=True)
+        self.assertIn('Vegan', response)
+        self.assertNotIn('Spicy', response)
+        self.client.post('/admin', data={'add-meal': 'Lunch'})
+        response = self.client.get('/admin').get_data(as_text=True)
+        self.assertIn('Spicy', response)
+        self.assertIn('Lunch', response)
+
+    def test_vocabulary_version(self):
+        '''
+        Tags and meals changed by another process should be reloaded once their version is bumped
+        '''
+        self.login_user('Admin')
+        self.client.get('/recipes')
+        self.mongo.db.meals.insert_one({'name': 'Brunch'})
+        self.assertNotIn('Brunch', self.client.get('/recipes').get_data(as_text=True))
+        app.bump_versions(self.mongo.db, 'meals')
+        self.assertIn('Brunch', self.client.get('/recipes').get_data(as_text=True))
+
+
+class TestChangeLog(TestClient):
+    '''
+    Class for testing how in-memory indexes follow the search_changes log
+    '''
+    def setUp(self):
+        self.mongo.db.recipes.delete_many({})
+        self.mongo.db.search_changes.delete_many({})
+        self.mongo.db.counters.delete_many({})
+        self.bitmaps = bitmaps.TagBitmaps()
+        search.build_index(self.mongo.db, self.bitmaps)
+
+    def add_recipe(self, urn, tag):
+        self.mongo.db.recipes.insert_one({'urn': urn, 'tags': [tag], 'meals': []})
+        search.record_change(self.mongo.db, urn)
+
+    def test_changes_applied_in_order(self):
+        '''
+        Changes should be read by number, and the last change applied should be the highest number
+        '''
+        self.add_recipe('apple-pie', 'Vegan')
+        self.add_recipe('pancakes', 'Vegan')
+        search.apply_changes(self.mongo.db, self.bitmaps)
+        self.assertEqual(self.bitmaps.count(self.bitmaps.match(['Vegan'], [], [])), 2)
+        self.assertEqual(self.bitmaps.last_change, 2)
+
+    def test_late_change_not_missed(self):
+        '''
+        A change that becomes visible after a later numbered one has been read should still be applied
+        '''
+        self.add_recipe('apple-pie', 'Vegan')
+        late = self.mongo.db.search_changes.find_one_and_delete({'urn': 'apple-pie'})  # Numbered, but not yet visible
+        self.add_recipe('pancakes', 'Vegan')
+        search.apply_changes(self.mongo.db, self.bitmaps)
+        self.assertEqual(self.bitmaps.last_change, 0)  # Waiting for change 1
+        self.mongo.db.search_changes.insert_one(late)
+        search.apply_changes(self.mongo.db, self.bitmaps)
+        self.assertEqual(self.bitmaps.count(self.bitmaps.match(['Vegan'], [], [])), 2)
+        self.assertEqual(self.bitmaps.last_change, 2)
+
+    def test_abandoned_change_skipped(self):
+        '''
+        A missing change number should be skipped once the changes after it are older than the gap timeout
+        '''
+        self.mongo.db.counters.insert_one({'_id': 'search_changes', 'number': 1})  # Change 1 was never written
+        self.add_recipe('pancakes', 'Vegan')
+        self.mongo.db.search_changes.update_one({'number': 2}, {'$set': {'time': datetime.utcnow() - timedelta(minutes=5)}})
+        search.apply_changes(self.mongo.db, self.bitmaps)
+        self.assertEqual(self.bitmaps.last_change, 2)
+
 
 class TestRecipesList(TestClient):
     '''
@@ -1720,8 +2405,13 @@ class TestRecipesList(TestClient):
         # Delete all records from the login and user collection and create test user
         cls.mongo.db.logins.delete_many({})
         cls.mongo.db.users.delete_many({})
+        cls.mongo.db.follows.delete_many({})
+        cls.mongo.db.feeds.delete_many({})
         # Delete all records from the recipe collection
         cls.mongo.db.recipes.delete_many({})
+        cls.mongo.db.slugs.delete_many({})
+        cls.mongo.db.favourites.delete_many({})
+        cls.mongo.db.search_changes.delete_many({})
 
         # Create plenty of fake recipes and users
         cls.logout_user()
@@ -1820,6 +2510,34 @@ class TestRecipesList(TestClient):
         response = self.client.get('/recipes?tags=Vegetarian&exclude=Gluten-free%20Vegetarian')
         self.assertIn(b'Found 9', response.data)
 
+    def test_number_of_tagged_recipes_counted_by_bitmaps(self):
+        '''
+        Where too many recipes match the tags to look them up by urn, the tag bitmaps should count them
+        '''
+        app.app.config['TAG_BITMAP_LIMIT'] = 0
+        try:
+            response = self.client.get('/recipes?tags=Vegetarian')
+            self.assertIn(b'Found 11', response.data)
+            response = self.client.get('/recipes?exclude=Gluten-free%20Vegan')
+            self.assertIn(b'Found 53', response.data)
+        finally:
+            app.app.config['TAG_BITMAP_LIMIT'] = 1000
+
+    def test_excluded_tags_kept_when_most_match(self):
+        '''
+        Where most recipes match, the excluded tags should stay in the query, and the count should come from the bitmaps
+        '''
+        app.app.config['TAG_BITMAP_LIMIT'] = 10
+        try:
+            query = {'deleted': {'$ne': True}, 'tags': {'$nin': ['Gluten-free', 'Vegan']}}
+            self.assertEqual(app.filter_by_tags(query), 53)
+            self.assertEqual(query, {'deleted': {'$ne': True}, 'tags': {'$nin': ['Gluten-free', 'Vegan']}})
+            self.assertEqual(self.mongo.db.recipes.count_documents(query), 53)
+            response = self.client.get('/recipes?exclude=Gluten-free%20Vegan')
+            self.assertIn(b'Found 53', response.data)
+        finally:
+            app.app.config['TAG_BITMAP_LIMIT'] = 1000
+
     def test_number_of_recipes_by_author(self):
         '''
         Recipes page should show how many recipes by the requested user
@@ -1955,6 +2673,7 @@ class TestRecipesList(TestClient):
         self.client.get('recipes/alice-s-apple-pie')
         self.client.get('recipes/charlie-s-cottage-pie')
         self.client.get('recipes/charlie-s-cottage-pie')
+        app.view_counter.flush()
         response = self.client.get('/recipes?page=1')
         self.assertLess(response.data.decode().index('recipes/ben-s-beef-curry'), response.data.decode().index('recipes/alice-s-apple-pie'))
         self.assertLess(response.data.decode().index('recipes/alice-s-apple-pie'), response.data.decode().index('recipes/charlie-s-cottage-pie'))
@@ -1965,8 +2684,8 @@ class TestRecipesList(TestClient):
         '''
         old_time = datetime.utcnow() - timedelta(1)
         new_time = datetime.utcnow() + timedelta(1)
-        self.mongo.db.recipes.update_one({'urn': 'ben-s-beef-curry'}, {'$set': {'date': old_time.strftime("%Y-%m-%d %H:%M:%S")}})
-        self.mongo.db.recipes.update_one({'urn': 'alice-s-anzac-biscuits'}, {'$set': {'date': new_time.strftime("%Y-%m-%d %H:%M:%S")}})
+        self.mongo.db.recipes.update_one({'urn': 'ben-s-beef-curry'}, {'$set': {'date': old_time}})
+        self.mongo.db.recipes.update_one({'urn': 'alice-s-anzac-biscuits'}, {'$set': {'date': new_time}})
         response = self.client.get('/recipes?sort=date')
         self.assertIn(b'alice-s-anzac-biscuits', response.data)
         self.assertNotIn(b'ben-s-beef-curry', response.data)
@@ -1977,8 +2696,8 @@ class TestRecipesList(TestClient):
         '''
         old_time = datetime.utcnow() - timedelta(2)
         new_time = datetime.utcnow() + timedelta(2)
-        self.mongo.db.recipes.update_one({'urn': 'charlie-s-cherry-bakewells'}, {'$set': {'date': old_time.strftime("%Y-%m-%d %H:%M:%S")}})
-        self.mongo.db.recipes.update_one({'urn': 'alice-s-avocado-salad'}, {'$set': {'date': new_time.strftime("%Y-%m-%d %H:%M:%S")}})
+        self.mongo.db.recipes.update_one({'urn': 'charlie-s-cherry-bakewells'}, {'$set': {'date': old_time}})
+        self.mongo.db.recipes.update_one({'urn': 'alice-s-avocado-salad'}, {'$set': {'date': new_time}})
         response = self.client.get('/recipes?sort=date&order=1')
         self.assertIn(b'charlie-s-cherry-bakewells', response.data)
         self.assertNotIn(b'alice-s-avocado-salad', response.data)
@@ -2041,6 +2760,49 @@ class TestRecipesList(TestClient):
         response = self.client.get('/recipes?search=%22apple%20pie%22')
         self.assertIn(str.encode(escape('"apple pie"')), response.data)
 
+    def test_text_search_prefix_and_typos(self):
+        '''
+        Search words should match words they start, and words a typo away if nothing else matches
+        '''
+        response = self.client.get('/recipes?search=avoc')
+        self.assertIn(str.encode('{}</a>'.format(escape('Alice\'s Avocado Salad'))), response.data)
+        response = self.client.get('/recipes?search=coleslow')
+        self.assertIn(str.encode('{}</a>'.format(escape('Alice\'s Apple Coleslaw'))), response.data)
+
+    def test_text_search_ranked(self):
+        '''
+        Searches should be sorted by best match unless another sort is chosen
+        '''
+        response = self.client.get('/recipes?search=apple')
+        self.assertLess(response.data.index(str.encode(escape('Alice\'s Apple Pie'))),
+                        response.data.index(str.encode(escape('Ben\'s Bannana Smoothie'))))
+        self.assertIn(b'Found 4', response.data)
+        response = self.client.get('/recipes?search=salad&sort=date')
+        self.assertLess(response.data.index(str.encode(escape('Charlie\'s Chicken Caesar Salad'))),
+                        response.data.index(str.encode(escape('Alice\'s Avocado Salad'))))
+
+    def test_suggest(self):
+        '''
+        Suggestions should include recipe titles, ingredients and users starting with the query
+        '''
+        response = self.client.get('/api/suggest?q=ap')
+        suggestions = json.loads(response.get_data(as_text=True)).get('suggestions')
+        self.assertIn({'type': 'recipe', 'text': 'Alice\'s Apple Pie', 'urn': 'alice-s-apple-pie'}, suggestions)
+        self.assertIn({'type': 'ingredient', 'text': 'apples'}, suggestions)
+        response = self.client.get('/api/suggest?q=ben')
+        suggestions = json.loads(response.get_data(as_text=True)).get('suggestions')
+        self.assertIn({'type': 'user', 'text': 'Benjamin'}, suggestions)
+        response = self.client.get('/api/suggest?q=')
+        self.assertEqual(json.loads(response.get_data(as_text=True)).get('suggestions'), [])
+
+    def test_text_search_with_filters(self):
+        '''
+        Searches should be combined with other filters
+        '''
+        response = self.client.get('/recipes?search=pie&meals=Dinner')
+        self.assertIn(str.encode('{}</a>'.format(escape('Charlie\'s Cottage Pie'))), response.data)
+        self.assertNotIn(str.encode('{}</a>'.format(escape('Alice\'s Apple Pie'))), response.data)
+
     def test_show_following(self):
         '''
         Filtering by following should show recipes from those you follow.
@@ -2086,6 +2848,317 @@ class TestRecipesList(TestClient):
         ideal_response = self.client.get('/recipes?page=1')
         self.assertEqual(ideal_response.data, response.data)
 
+    def test_pagination_links_include_cursor(self):
+        '''
+        The next page link should include a cursor for the last recipe on the page
+        '''
+        response = self.client.get('/recipes?page=1')
+        self.assertRegex(response.data.decode(), '/recipes\?page=2&amp;after=[A-Za-z0-9_=-]+')
+
+    def test_max_time_filter(self):
+        '''
+        Filtering by max_time should only return recipes that take at most that many minutes
+        '''
+        self.mongo.db.recipes.update_one({'urn': 'alice-s-aromatic-duck'}, {'$set': {'total-time': 90}})
+        try:
+            response = self.client.get('/recipes?meals=Dinner&max_time=30')
+            self.assertNotIn(b'alice-s-aromatic-duck', response.data)
+            self.assertIn(b'ben-s-bean-chilli', response.data)
+            response = self.client.get('/recipes?meals=Dinner&max_time=120')
+            self.assertIn(b'alice-s-aromatic-duck', response.data)
+        finally:
+            self.mongo.db.recipes.update_one({'urn': 'alice-s-aromatic-duck'}, {'$set': {'total-time': 2}})
+
+    def test_since_filter(self):
+        '''
+        Filtering by since should only return recipes added in that many days
+        '''
+        self.mongo.db.recipes.update_one({'urn': 'ben-s-bean-chilli'}, {'$set': {'date': datetime.utcnow() - timedelta(30)}})
+        try:
+            response = self.client.get('/recipes?meals=Dinner&since=7')
+            self.assertNotIn(b'ben-s-bean-chilli', response.data)
+            self.assertIn(b'alice-s-aromatic-duck', response.data)
+            response = self.client.get('/recipes?meals=Dinner&since=60')
+            self.assertIn(b'ben-s-bean-chilli', response.data)
+        finally:
+            self.mongo.db.recipes.update_one({'urn': 'ben-s-bean-chilli'}, {'$set': {'date': datetime.utcnow()}})
+
+    def test_pagination_cursor(self):
+        '''
+        Following the next page cursor should return the same recipes as the page number
+        '''
+        for query in ['sort=date&order=-1', 'sort=views&order=-1', 'sort=total-time&order=1']:
+            response = self.client.get('/recipes?page=2&' + query)
+            after = re.search('after=([A-Za-z0-9_=-]+)', response.data.decode()).group(1)
+            ideal_response = self.client.get('/recipes?page=3&' + query)
+            response = self.client.get('/recipes?page=3&after={}&'.format(after) + query)
+            self.assertEqual(re.findall('/recipes/[a-z0-9-]+', ideal_response.data.decode()),
+                             re.findall('/recipes/[a-z0-9-]+', response.data.decode()))
+
+    def test_pagination_invalid_cursor(self):
+        '''
+        If the cursor is invalid the page number should be used instead
+        '''
+        response = self.client.get('/recipes?page=2&after=notacursor')
+        ideal_response = self.client.get('/recipes?page=2')
+        self.assertEqual(re.findall('/recipes/[a-z0-9-]+', ideal_response.data.decode()),
+                         re.findall('/recipes/[a-z0-9-]+', response.data.decode()))
+
+
+class TestHomePage(TestClient):
+    '''
+    Class for testing the home page recipe lists and their cache
+    '''
+    def setUp(self):
+        # Delete all records from the login, user and recipe collections and create test user
+        self.mongo.db.logins.delete_many({})
+        self.mongo.db.users.delete_many({})
+        self.mongo.db.follows.delete_many({})
+        self.mongo.db.feeds.delete_many({})
+        self.mongo.db.recipes.delete_many({})
+        self.mongo.db.slugs.delete_many({})
+        self.mongo.db.favourites.delete_many({})
+        self.logout_user()
+        self.create_user()
+        self.login_user()
+        # Enable the home page cache
+        app.app.config['HOME_CACHE_TIMEOUT'] = 60
+        app.home_recipes_cache.clear()
+
+    def tearDown(self):
+        app.app.config['HOME_CACHE_TIMEOUT'] = 0
+
+    def test_recent_recipes_on_home_page(self):
+        '''
+        The home page should list recent recipes
+        '''
+        self.submit_recipe(title='Pancakes')
+        response = self.client.get('/')
+        self.assertIn(b'Pancakes', response.data)
+
+    def test_home_page_lists_are_cached(self):
+        '''
+        The home page lists should be served from the cache until a recipe changes
+        '''
+        self.client.get('/')
+        self.mongo.db.recipes.insert_one({'title': 'Uncached Recipe', 'urn': 'uncached-recipe', 'username': 'TestUser'})
+        response = self.client.get('/')
+        self.assertNotIn(b'Uncached Recipe', response.data)
+
+    def test_writes_invalidate_home_page(self):
+        '''
+        Adding a recipe should clear the home page cache
+        '''
+        self.client.get('/')
+        self.submit_recipe(title='Pancakes')
+        response = self.client.get('/')
+        self.assertIn(b'Pancakes', response.data)
+
+    def test_home_page_query_timings(self):
+        '''
+        The home page lists should be found concurrently, and their timings sent in the Server-Timing header
+        '''
+        timing = self.client.get('/').headers.get('Server-Timing')
+        for name in ('featured', 'recent', 'popular', 'following'):
+            self.assertIn(name + ';', timing)
+
+    def test_home_page_cache_respects_preferences(self):
+        '''
+        Users with different preferences should not share cached lists
+        '''
+        self.submit_recipe(title='Vegan Pancakes', tags=['Vegan'])
+        self.submit_recipe(title='Bacon Pancakes')
+        self.client.get('/')
+        self.client.post('/preferences', data={'tags': 'Vegan', 'exclude': ''})
+        response = self.client.get('/')
+        self.assertNotIn(b'Bacon Pancakes', response.data)
+
+    def test_new_recipes_fan_out_to_followers(self):
+        '''
+        Recipes added by a followed user should be added to the follower's feed and shown on their home page
+        '''
+        self.logout_user()
+        self.create_user('Follower')
+        self.login_user('Follower')
+        self.client.get('/follow/TestUser')
+        self.logout_user()
+        self.login_user()
+        self.submit_recipe(title='Pancakes')
+        self.assertEqual(self.mongo.db.feeds.count_documents({'owner': 'Follower'}), 1)
+        self.logout_user()
+        self.login_user('Follower')
+        response = self.client.get('/')
+        self.assertIn(b'My Feed', response.data)
+        self.assertIn(b'Pancakes', response.data)
+
+    def test_follow_backfills_feed(self):
+        '''
+        Following a user should add their existing recipes to the follower's feed, and unfollowing should remove them
+        '''
+        self.submit_recipe(title='Pancakes')
+        self.logout_user()
+        self.create_user('Follower')
+        self.login_user('Follower')
+        self.client.get('/follow/TestUser')
+        self.assertEqual(self.mongo.db.feeds.count_documents({'owner': 'Follower', 'username': 'TestUser'}), 1)
+        self.client.get('/follow/TestUser')
+        self.assertEqual(self.mongo.db.feeds.count_documents({'owner': 'Follower'}), 0)
+
+    def test_feeds_capped(self):
+        '''
+        Feeds should only keep their newest FEED_SIZE entries
+        '''
+        self.submit_recipe(title='Pancakes')
+        self.submit_recipe(title='Waffles')
+        self.logout_user()
+        self.create_user('Follower')
+        self.login_user('Follower')
+        app.app.config['FEED_SIZE'] = 2
+        try:
+            self.client.get('/follow/TestUser')
+            self.logout_user()
+            self.login_user()
+            self.submit_recipe(title='Crumpets')
+        finally:
+            app.app.config['FEED_SIZE'] = 500
+        entries = self.mongo.db.feeds.find({'owner': 'Follower'}).sort('date', -1)
+        self.assertEqual([entry['urn'] for entry in entries], ['crumpets', 'waffles'])
+        self.assertEqual(self.mongo.db.users.find_one({'username': 'Follower'})['feed-count'], 2)
+
+    def test_fan_out_queries(self):
+        '''
+        Adding a recipe to its followers' feeds should take the same number of queries however many followers its author has
+        '''
+        class Commands(monitoring.CommandListener):
+            def __init__(self):
+                self.names = []
+
+            def started(self, event):
+                self.names.append(event.command_name)
+
+            def succeeded(self, event):
+                pass
+
+            def failed(self, event):
+                pass
+
+        commands = Commands()
+        db = MongoClient(os.getenv('MONGO_TEST_URI'), event_listeners=[commands]).get_database()
+        queries = []
+        for followers in (1, 50):
+            db.users.delete_many({'username': {'$ne': 'TestUser'}})
+            db.follows.delete_many({})
+            db.users.insert_many([{'username': 'Follower{}'.format(i)} for i in range(followers)])
+            db.follows.insert_many([{'follower': 'Follower{}'.format(i), 'followee': 'TestUser'} for i in range(followers)])
+            del commands.names[:]
+            feeds.fan_out(db, {'urn': 'recipe-{}'.format(followers), 'username': 'TestUser', 'date': datetime.utcnow()}, 500)
+            queries.append(len(commands.names))
+        self.assertEqual(queries[0], queries[1])
+        self.assertEqual(self.mongo.db.feeds.count_documents({'urn': 'recipe-50'}), 50)
+
+    def test_deleted_recipes_removed_from_feeds(self):
+        '''
+        Deleting a recipe should remove it from its author's followers' feeds
+        '''
+        self.logout_user()
+        self.create_user('Follower')
+        self.login_user('Follower')
+        self.client.get('/follow/TestUser')
+        self.logout_user()
+        self.login_user()
+        self.submit_recipe(title='Pancakes')
+        urn = self.mongo.db.recipes.find_one({'title': 'Pancakes'})['urn']
+        self.client.post('/delete-recipe/{}'.format(urn), data={'confirm': 'Pancakes'})
+        self.assertEqual(self.mongo.db.feeds.count_documents({}), 0)
+
+
+class TestIndexes(TestClient):
+    '''
+    Class for testing the ensure-indexes command
+    '''
+    def setUp(self):
+        self.mongo.db.recipes.delete_many({})
+        self.mongo.db.slugs.delete_many({})
+        self.mongo.db.favourites.delete_many({})
+        self.runner = app.app.test_cli_runner()
+
+    def test_creates_unique_urn_index(self):
+        '''
+        The command should create a unique index on recipe urns
+        '''
+        self.runner.invoke(args=['ensure-indexes'])
+        unique_indexes = [index['key'] for index in self.mongo.db.recipes.list_indexes() if index.get('unique')]
+        self.assertIn({'urn': 1}, [dict(key) for key in unique_indexes])
+
+    def test_no_collection_scans(self):
+        '''
+        Once the indexes exist none of the app's queries should scan whole collections
+        '''
+        result = self.runner.invoke(args=['ensure-indexes'])
+        self.assertIn('No queries are doing collection scans.', result.output)
+
+
+class TestRecipeCounts(TestClient):
+    '''
+    Class for testing the recipe count cache
+    '''
+    def setUp(self):
+        # Delete all records from the login, user and recipe collections and create test user
+        self.mongo.db.logins.delete_many({})
+        self.mongo.db.users.delete_many({})
+        self.mongo.db.follows.delete_many({})
+        self.mongo.db.feeds.delete_many({})
+        self.mongo.db.recipes.delete_many({})
+        self.mongo.db.slugs.delete_many({})
+        self.mongo.db.favourites.delete_many({})
+        self.logout_user()
+        self.create_user()
+        self.login_user()
+        # Enable the count cache
+        app.app.config['COUNT_CACHE_TIMEOUT'] = 60
+        app.recipe_counts.clear()
+
+    def tearDown(self):
+        app.app.config['COUNT_CACHE_TIMEOUT'] = 0
+
+    def test_counts_are_cached(self):
+        '''
+        Repeating a query should use the cached count. Author filters are counted by the database rather than the tag bitmaps.
+        '''
+        self.submit_recipe()
+        self.client.get('/recipes?username=TestUser')
+        self.assertEqual(len(app.recipe_counts), 1)
+        self.mongo.db.recipes.insert_one({'title': 'Uncounted', 'urn': 'uncounted', 'username': 'TestUser'})
+        response = self.client.get('/recipes?username=TestUser')
+        self.assertIn(b'Found 1 ', response.data)
+
+    def test_writes_invalidate_counts(self):
+        '''
+        Adding a recipe should clear the cached counts
+        '''
+        self.submit_recipe()
+        self.client.get('/recipes')
+        self.submit_recipe()
+        response = self.client.get('/recipes')
+        self.assertIn(b'Found 2 ', response.data)
+
+    def test_unfiltered_count_excludes_deleted(self):
+        '''
+        The estimated count for all recipes should not include deleted recipes
+        '''
+        self.submit_recipe(title='Kept')
+        self.submit_recipe(title='Deleted')
+        self.client.post('/delete-recipe/deleted', data={'confirm': 'Deleted'})
+        response = self.client.get('/recipes')
+        self.assertIn(b'Found 1 ', response.data)
+
+    def test_query_key_normalised(self):
+        '''
+        Queries that differ only in key or tag order should share a cache key
+        '''
+        self.assertEqual(app.query_key({'deleted': {'$ne': True}, 'tags': {'$all': ['Vegan', 'Nuts']}}),
+                         app.query_key({'tags': {'$all': ['Nuts', 'Vegan']}, 'deleted': {'$ne': True}}))
+
 
 class TestUserPage(TestClient):
     '''
@@ -2095,8 +3168,12 @@ class TestUserPage(TestClient):
         # Delete all records from the login and user collection and create test user
         self.mongo.db.logins.delete_many({})
         self.mongo.db.users.delete_many({})
+        self.mongo.db.follows.delete_many({})
+        self.mongo.db.feeds.delete_many({})
         # Delete all records from the recipe collection
         self.mongo.db.recipes.delete_many({})
+        self.mongo.db.slugs.delete_many({})
+        self.mongo.db.favourites.delete_many({})
         self.logout_user()
         self.username = 'TestUser'
         self.create_user(self.username)
@@ -2124,6 +3201,14 @@ class TestUserPage(TestClient):
         response = self.client.get('/users/{}'.format(self.username))
         self.assertIn(str.encode(escape(today.strftime('%b \'%y'))), response.data)
 
+    def test_user_since_string(self):
+        '''
+        Page should still show the month a user joined if it is stored as a string from before the migrate-datetimes command.
+        '''
+        self.mongo.db.users.update_one({'username': self.username}, {'$set': {'joined': '2019-04-03 12:00:00'}})
+        response = self.client.get('/users/{}'.format(self.username))
+        self.assertIn(str.encode(escape('Apr \'19')), response.data)
+
     def test_follower_count(self):
         '''
         Page should show number of followers a user has.
@@ -2211,8 +3296,12 @@ class TestUserList(TestClient):
         # Delete all records from the login and user collection and create test user
         cls.mongo.db.logins.delete_many({})
         cls.mongo.db.users.delete_many({})
+        cls.mongo.db.follows.delete_many({})
+        cls.mongo.db.feeds.delete_many({})
         # Delete all records from the recipe collection
         cls.mongo.db.recipes.delete_many({})
+        cls.mongo.db.slugs.delete_many({})
+        cls.mongo.db.favourites.delete_many({})
 
         cls.create_user('Alice')
         cls.login_user('Alice')
@@ -2338,8 +3427,8 @@ class TestUserList(TestClient):
         '''
         old_time = datetime.utcnow() - timedelta(1)
         new_time = datetime.utcnow() + timedelta(1)
-        self.mongo.db.users.update_one({'username': 'Alice'}, {'$set': {'joined': old_time.strftime("%Y-%m-%d %H:%M:%S")}})
-        self.mongo.db.users.update_one({'username': 'Bob'}, {'$set': {'joined': new_time.strftime("%Y-%m-%d %H:%M:%S")}})
+        self.mongo.db.users.update_one({'username': 'Alice'}, {'$set': {'joined': old_time}})
+        self.mongo.db.users.update_one({'username': 'Bob'}, {'$set': {'joined': new_time}})
         response = self.client.get('/users')
         self.assertIn(b'Bob', response.data)
         self.assertNotIn(b'Alice', response.data)
@@ -2382,6 +3471,8 @@ class TestFollowUser(TestClient):
         # Delete all records from the login and user collection and create test user
         self.mongo.db.logins.delete_many({})
         self.mongo.db.users.delete_many({})
+        self.mongo.db.follows.delete_many({})
+        self.mongo.db.feeds.delete_many({})
         # Delete all records from the recipe collection
         self.logout_user()
         self.create_user('Followee')
@@ -2437,19 +3528,20 @@ class TestFollowUser(TestClient):
 
     def test_adds_user_to_following(self):
         '''
-        User being followed should be added to the followers list of users they are following
+        Following a user should add a follow from the follower to the followee
         '''
         self.login_user('Follower')
         self.client.get('/follow/Followee')
-        self.assertEqual(self.mongo.db.users.find_one({'username': 'Follower'}).get('following'), ['Followee'])
+        self.assertEqual(list(self.mongo.db.follows.find({}, {'_id': 0})), [{'follower': 'Follower', 'followee': 'Followee'}])
 
-    def test_adds_user_to_followers(self):
+    def test_follow_shown_on_user_page(self):
         '''
-        Following users should be added to the followees list of users they are being followed by
+        The user page should offer to un-follow users that are already followed
         '''
         self.login_user('Follower')
         self.client.get('/follow/Followee')
-        self.assertEqual(self.mongo.db.users.find_one({'username': 'Followee'}).get('followers'), ['Follower'])
+        response = self.client.get('/users/Followee')
+        self.assertIn(b'Un-Follow Followee', response.data)
 
     def test_user_already_followed_unfollows(self):
         '''
@@ -2460,8 +3552,7 @@ class TestFollowUser(TestClient):
         self.client.get('/follow/Followee')
         self.assertEqual(self.mongo.db.users.find_one({'username': 'Followee'}).get('follower-count'), 0)
         self.assertEqual(self.mongo.db.users.find_one({'username': 'Follower'}).get('following-count'), 0)
-        self.assertNotIn('Followee', self.mongo.db.users.find_one({'username': 'Follower'}).get('following'))
-        self.assertNotIn('Follower', self.mongo.db.users.find_one({'username': 'Followee'}).get('followers'))
+        self.assertEqual(self.mongo.db.follows.count_documents({}), 0)
 
     def test_json_request_returns_200(self):
         '''
@@ -2488,6 +3579,233 @@ class TestFollowUser(TestClient):
         response = self.client.get('/follow/Followee', content_type='application/json')
         self.assertEqual(json.loads(response.get_data(as_text=True)).get('following'), False)
 
+    def test_migrate_follower_arrays(self):
+        '''
+        The migrate-edges command should turn follower and following arrays into follows, adding each follow once
+        '''
+        self.mongo.db.users.update_one({'username': 'Followee'}, {'$set': {'followers': ['Follower']}})
+        self.mongo.db.users.update_one({'username': 'Follower'}, {'$set': {'following': ['Followee']}})
+        app.app.test_cli_runner().invoke(args=['migrate-edges'])
+        self.assertEqual(list(self.mongo.db.follows.find({}, {'_id': 0})), [{'follower': 'Follower', 'followee': 'Followee'}])
+        self.assertIsNone(self.mongo.db.users.find_one({'username': 'Followee'}).get('followers'))
+
+
+class TestApi(TestClient):
+    '''
+    Class for testing the JSON API
+    '''
+    def setUp(self):
+        # Delete all records from the login, user and recipe collections and create test user with a recipe
+        self.mongo.db.logins.delete_many({})
+        self.mongo.db.users.delete_many({})
+        self.mongo.db.follows.delete_many({})
+        self.mongo.db.feeds.delete_many({})
+        self.mongo.db.recipes.delete_many({})
+        self.mongo.db.slugs.delete_many({})
+        self.mongo.db.favourites.delete_many({})
+        self.logout_user()
+        self.create_user()
+        self.login_user()
+        self.submit_recipe(title='Pancakes')
+        self.logout_user()
+
+    def test_recipes(self):
+        '''
+        The recipes API should return compact recipe cards
+        '''
+        response = self.client.get('/api/v1/recipes?sort=date')
+        data = json.loads(response.get_data(as_text=True))
+        self.assertEqual(data.get('count'), 1)
+        self.assertEqual(data['recipes'][0].get('urn'), 'pancakes')
+        self.assertIn('date', data['recipes'][0])
+        self.assertNotIn('ingredients', data['recipes'][0])
+
+    def test_users(self):
+        '''
+        The users API should return users and their follow counts
+        '''
+        response = self.client.get('/api/v1/users')
+        data = json.loads(response.get_data(as_text=True))
+        self.assertEqual(data.get('count'), 1)
+        self.assertEqual(data['users'][0].get('username'), 'TestUser')
+
+    def test_not_modified(self):
+        '''
+        Requests with the current ETag should get 304 Not Modified, until the data changes
+        '''
+        etag = self.client.get('/api/v1/recipes?sort=date').headers.get('ETag')
+        self.assertIsNotNone(etag)
+        response = self.client.get('/api/v1/recipes?sort=date', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get('/api/v1/recipes?sort=favourites', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.login_user()
+        self.submit_recipe(title='Waffles')
+        response = self.client.get('/api/v1/recipes?sort=date', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_views_dont_change_etag(self):
+        '''
+        Written views shouldn't change the recipes ETag, and view counts shouldn't be in the response
+        '''
+        response = self.client.get('/api/v1/recipes?sort=date')
+        self.assertNotIn('views', json.loads(response.get_data(as_text=True))['recipes'][0])
+        etag = response.headers.get('ETag')
+        app.view_counter.add('pancakes')
+        app.view_counter.flush()
+        self.assertEqual(self.client.get('/api/v1/recipes?sort=date', headers={'If-None-Match': etag}).status_code, 304)
+
+    def test_views_sorted_lists_not_tagged(self):
+        '''
+        Lists sorted by views should have no ETag, as written views change them without changing the recipes version
+        '''
+        self.assertIsNone(self.client.get('/api/v1/recipes').headers.get('ETag'))
+        self.assertIsNone(self.client.get('/api/v1/recipes?sort=views').headers.get('ETag'))
+        self.assertEqual(self.client.get('/api/v1/recipes', headers={'If-None-Match': '*'}).status_code, 200)
+
+    def test_errors_are_json(self):
+        '''
+        Errors from the API should be returned as JSON rather than an error page
+        '''
+        response = self.client.get('/api/v1/recipes?page=99')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(json.loads(response.get_data(as_text=True)), {'error': 'Not Found', 'status': 404})
+
+    def test_users_not_modified(self):
+        '''
+        Users ETags should change when a user is added
+        '''
+        etag = self.client.get('/api/v1/users').headers.get('ETag')
+        self.assertEqual(self.client.get('/api/v1/users', headers={'If-None-Match': etag}).status_code, 304)
+        self.create_user('NewUser')
+        self.assertEqual(self.client.get('/api/v1/users', headers={'If-None-Match': etag}).status_code, 200)
+
+
+class TestMetrics(TestClient):
+    '''
+    Class for testing the /metrics endpoint
+    '''
+    def setUp(self):
+        app.app.config['METRICS_TOKEN'] = 'secret'
+
+    def tearDown(self):
+        app.app.config['METRICS_TOKEN'] = None
+
+    def test_metrics(self):
+        '''
+        Metrics should be returned in the Prometheus text format
+        '''
+        response = self.client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE mongo_command_duration_seconds histogram', response.data)
+
+    def test_metrics_token(self):
+        '''
+        Metrics should only be returned to requests with the token, and not at all if no token is set
+        '''
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code, 403)
+        app.app.config['METRICS_TOKEN'] = None
+        self.assertEqual(self.client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code, 404)
+
+
+class TestPageCache(TestClient):
+    '''
+    Class for testing cache headers and the page cache
+    '''
+    def setUp(self):
+        # Delete all records from the login, user and recipe collections and create test user with a recipe
+        self.mongo.db.logins.delete_many({})
+        self.mongo.db.users.delete_many({})
+        self.mongo.db.follows.delete_many({})
+        self.mongo.db.feeds.delete_many({})
+        self.mongo.db.recipes.delete_many({})
+        self.mongo.db.slugs.delete_many({})
+        self.mongo.db.favourites.delete_many({})
+        self.logout_user()
+        self.create_user()
+        self.login_user()
+        self.submit_recipe(title='Pancakes')
+        self.logout_user()
+        # Enable the page cache
+        app.app.config['PAGE_CACHE_TIMEOUT'] = 60
+        app.page_cache.clear()
+
+    def tearDown(self):
+        app.app.config['PAGE_CACHE_TIMEOUT'] = 0
+        app.page_cache.clear()
+
+    def test_anonymous_pages_public(self):
+        '''
+        Pages for anonymous users should be cacheable, and vary on the session cookie
+        '''
+        response = self.client.get('/about')
+        self.assertIn('public', response.headers.get('Cache-Control'))
+        self.assertIn('max-age=3600', response.headers.get('Cache-Control'))
+        self.assertIn('Cookie', response.headers.get('Vary'))
+
+    def test_logged_in_pages_private(self):
+        '''
+        Pages for logged in users should be private, and not have a Last-Modified date
+        '''
+        self.login_user()
+        response = self.client.get('/recipes/pancakes')
+        self.assertIn('private', response.headers.get('Cache-Control'))
+        self.assertIn('no-cache', response.headers.get('Cache-Control'))
+        self.assertIsNone(response.headers.get('Last-Modified'))
+
+    def test_pages_cached_until_write(self):
+        '''
+        Anonymous pages should be served from the page cache until recipes are written to
+        '''
+        self.client.get('/recipes/pancakes')
+        self.mongo.db.recipes.update_one({'urn': 'pancakes'}, {'$set': {'title': 'Crepes'}})
+        response = self.client.get('/recipes/pancakes')
+        self.assertIn(b'Pancakes', response.data)
+        app.recipes_changed()
+        response = self.client.get('/recipes/pancakes')
+        self.assertIn(b'Crepes', response.data)
+
+    def test_cached_pages_count_views(self):
+        '''
+        Recipe pages served from the page cache should still count views
+        '''
+        views = app.view_counter.pending('pancakes')
+        self.client.get('/recipes/pancakes')
+        self.client.get('/recipes/pancakes')
+        self.assertEqual(app.view_counter.pending('pancakes'), views + 2)
+
+    def test_not_modified(self):
+        '''
+        Recipe pages should have a Last-Modified date, and return 304 Not Modified if they haven't changed since
+        '''
+        response = self.client.get('/recipes/pancakes')
+        last_modified = response.headers.get('Last-Modified')
+        self.assertIsNotNone(last_modified)
+        response = self.client.get('/recipes/pancakes', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+
+    def test_string_dated_recipe(self):
+        '''
+        Recipes from before the modified time was kept, whose date is still a string, should use their date as Last-Modified
+        '''
+        self.mongo.db.recipes.update_one({'urn': 'pancakes'}, {'$set': {'date': '2019-04-03 12:00:00'}, '$unset': {'modified': ''}})
+        response = self.client.get('/recipes/pancakes')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get('Last-Modified'), 'Wed, 03 Apr 2019 12:00:00 GMT')
+
+    def test_recipe_pages_revalidated(self):
+        '''
+        Recipe pages should be revalidated on every request rather than reused, and revalidations should count views
+        '''
+        response = self.client.get('/recipes/pancakes')
+        self.assertIn('public', response.headers.get('Cache-Control'))
+        self.assertIn('no-cache', response.headers.get('Cache-Control'))
+        self.assertNotIn('max-age', response.headers.get('Cache-Control'))
+        views = app.view_counter.pending('pancakes')
+        self.client.get('/recipes/pancakes', headers={'If-Modified-Since': response.headers.get('Last-Modified')})
+        self.assertEqual(app.view_counter.pending('pancakes'), views + 1)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,18 @@
+# Each collection that API responses are built from has a change version, incremented on every write that changes what they show.
+# ETags are computed from the versions, so they change as soon as any process writes, without reading the data itself.
+
+
+def bump_versions(db, *collections):
+    '''
+    Increments the change version of each collection, should be called after writing to it.
+    '''
+    for collection in collections:
+        db.versions.update_one({'_id': collection}, {'$inc': {'version': 1}}, upsert=True)
+
+
+def get_versions(db, *collections):
+    '''
+    Returns a dictionary of the change version of each collection, 0 if it has never been changed.
+    '''
+    versions = {version['_id']: version['version'] for version in db.versions.find({'_id': {'$in': list(collections)}})}
+    return {collection: versions.get(collection, 0) for collection in collections}
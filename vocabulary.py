@@ -0,0 +1,38 @@
+from threading import Lock
+from time import monotonic
+from versions import get_versions
+
+VOCABULARY_COLLECTIONS = ('tags', 'meals')
+
+
+class Vocabulary:
+    '''
+    In-memory copy of the tags and meals collections, which only change through the Admin page.
+    Their change versions are checked at most every refresh_interval seconds, and they are only reloaded when a version has changed,
+    so changes made by other processes are picked up without querying the collections on every render.
+    '''
+    def __init__(self):
+        self.lock = Lock()
+        self.lists = None  # (tags, meals), each a list of {'name': ...} documents
+        self.versions = None
+        self.checked = 0
+
+    def get(self, db, refresh_interval):
+        '''
+        Returns a tuple of the lists of all tags and all meals.
+        '''
+        with self.lock:
+            if self.lists is None or monotonic() - self.checked >= refresh_interval:
+                versions = get_versions(db, *VOCABULARY_COLLECTIONS)  # Read before the lists, so a write in between is reloaded next time
+                if self.lists is None or versions != self.versions:
+                    self.lists = tuple(list(db[collection].find({}, {'name': 1, '_id': 0})) for collection in VOCABULARY_COLLECTIONS)
+                    self.versions = versions
+                self.checked = monotonic()
+            return self.lists
+
+    def clear(self):
+        '''
+        Discards the lists, so they are reloaded the next time they are used.
+        '''
+        with self.lock:
+            self.lists = None